@@ -0,0 +1,459 @@
+import json
+import time
+import asyncio
+import logging
+import functools
+import inspect
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, AsyncIterator
+import httpx
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+import database
+import db_metrics
+
+logger = logging.getLogger(__name__)
+
+# Contraparte assíncrona do módulo database: mesmos nomes, mesmos retornos.
+# As funções do caminho quente falam direto com o PostgREST por um
+# httpx.AsyncClient compartilhado (HTTP/2, pool do database.SUPABASE_POOL_*).
+# Qualquer outra função do database é exposta aqui via __getattr__ rodando
+# em thread, para o painel nunca bloquear o loop em consultas raras.
+
+_client: Optional[AsyncClient] = None
+_http_client: Optional[httpx.AsyncClient] = None
+_transport: Optional[httpx.AsyncHTTPTransport] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_client_lock: Optional[asyncio.Lock] = None
+
+_pool_stats = {"clients_created": 0, "requests": 0, "errors": 0, "in_flight": 0}
+
+class _CountingTransport(httpx.AsyncHTTPTransport):
+    """AsyncHTTPTransport that keeps request counters for get_pool_stats()."""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        _pool_stats["requests"] += 1
+        _pool_stats["in_flight"] += 1
+        started = time.perf_counter()
+        response = None
+        try:
+            response = await super().handle_async_request(request)
+            await response.aread()
+            return response
+        except Exception:
+            _pool_stats["errors"] += 1
+            raise
+        finally:
+            _pool_stats["in_flight"] -= 1
+            db_metrics.record_http(request, response, (time.perf_counter() - started) * 1000)
+
+def _build_http_client() -> httpx.AsyncClient:
+    global _transport
+    limits = httpx.Limits(
+        max_connections=database.SUPABASE_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=database.SUPABASE_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=database.SUPABASE_POOL_KEEPALIVE_EXPIRY,
+    )
+    try:
+        _transport = _CountingTransport(limits=limits, http2=database.SUPABASE_HTTP2)
+    except ImportError:
+        logger.warning("h2 package not installed, async Supabase pool falling back to HTTP/1.1")
+        _transport = _CountingTransport(limits=limits)
+    return httpx.AsyncClient(
+        transport=_transport,
+        timeout=httpx.Timeout(database.SUPABASE_HTTP_TIMEOUT, connect=database.SUPABASE_CONNECT_TIMEOUT),
+        follow_redirects=True,
+    )
+
+async def get_supabase() -> Optional[AsyncClient]:
+    """Returns the async Supabase client bound to the running event loop."""
+    global _client, _http_client, _client_loop, _client_lock
+    loop = asyncio.get_running_loop()
+    if _client is not None and _client_loop is loop:
+        return _client
+    if not database.SUPABASE_URL or not database.SUPABASE_KEY:
+        logger.error("❌ CRITICAL: SUPABASE_URL or SUPABASE_KEY not set in environment!")
+        return None
+    if _client_loop is not loop:
+        # Conexões httpx ficam presas ao loop em que foram abertas
+        _client, _http_client, _client_loop = None, None, loop
+        _client_lock = asyncio.Lock()
+    async with _client_lock:
+        if _client is not None:
+            return _client
+        try:
+            http_client = _build_http_client()
+            client = await acreate_client(database.SUPABASE_URL, database.SUPABASE_KEY, options=AsyncClientOptions(httpx_client=http_client))
+            client.postgrest
+            _http_client = http_client
+            _client = client
+            _pool_stats["clients_created"] += 1
+            logger.info(f"Async Supabase pool ready (max_connections={database.SUPABASE_POOL_MAX_CONNECTIONS})")
+            return _client
+        except Exception as e:
+            logger.error(f"❌ Error creating async Supabase client: {e}")
+            return None
+
+async def close_supabase():
+    """Closes the async pool. The next call builds a new one."""
+    global _client, _http_client, _transport
+    if _http_client is not None:
+        try:
+            await _http_client.aclose()
+        except Exception as e:
+            logger.error(f"Error closing async Supabase pool: {e}")
+    _client = None
+    _http_client = None
+    _transport = None
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Snapshot of the async connection pool."""
+    stats = dict(_pool_stats)
+    stats["open_connections"] = 0
+    stats["idle_connections"] = 0
+    pool = getattr(_transport, "_pool", None)
+    for conn in list(getattr(pool, "connections", None) or []):
+        stats["open_connections"] += 1
+        try:
+            if conn.is_idle():
+                stats["idle_connections"] += 1
+        except Exception:
+            pass
+    return stats
+
+def _native(func):
+    """Supabase-only implementation; other backends run the sync function in a thread."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if database.DATABASE_BACKEND != "supabase":
+            return await asyncio.to_thread(getattr(database, func.__name__), *args, **kwargs)
+        return await func(*args, **kwargs)
+    return wrapper
+
+def __getattr__(name: str):
+    # Funções sem versão nativa: mesma assinatura, executadas fora do loop
+    target = getattr(database, name, None)
+    if name.startswith("_") or not callable(target):
+        raise AttributeError(f"module 'adatabase' has no attribute '{name}'")
+
+    @functools.wraps(target)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.to_thread(getattr(database, name), *args, **kwargs)
+    globals()[name] = wrapper
+    return wrapper
+
+# --- Bulk Writes ---
+@_native
+async def insert_rows(table: str, rows: List[Dict[str, Any]]):
+    """Bulk insert in a single request. Raises on failure so buffered writers can retry."""
+    if not rows: return
+    supabase = await get_supabase()
+    if not supabase:
+        raise RuntimeError("Supabase not configured")
+    await database._q_insert_rows(supabase, table, rows).execute()
+
+# --- User & Transaction Helpers ---
+@_native
+async def log_user(user_id: int, username: str, full_name: str, tracking_data: Optional[Dict[str, Any]] = None, bot_id: str = None):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_log_user(supabase, user_id, username, full_name, tracking_data, bot_id).execute()
+    except Exception as e:
+        logger.error(f"Error logging user {user_id}: {e}")
+
+@_native
+async def get_user(user_id: int) -> Optional[Dict[str, Any]]:
+    supabase = await get_supabase()
+    if not supabase: return None
+    try:
+        response = await database._q_get_user(supabase, user_id).execute()
+        return response.data if response else None
+    except Exception as e:
+        logger.error(f"Error fetching user {user_id}: {e}")
+        return None
+
+@_native
+async def log_transaction(identifier: str, user_id: int, product_id: str, amount: float, status: str = 'pending', payment_method: str = 'PIX', client_email: str = None, metadata: Optional[Dict[str, Any]] = None, created_at: str = None, bot_id: str = None):
+    supabase = await get_supabase()
+    if not supabase: return
+    await database._q_log_transaction(supabase, identifier, user_id, product_id, amount, status, payment_method, client_email, metadata, created_at, bot_id).execute()
+
+@_native
+async def update_transaction_status(identifier: str, status: str, oasyfy_id: str = None):
+    supabase = await get_supabase()
+    if not supabase: return
+    await database._q_update_transaction_status(supabase, identifier, status, oasyfy_id).execute()
+
+async def confirm_transaction(identifier: str):
+    await update_transaction_status(identifier, 'confirmed')
+
+@_native
+async def get_transaction_user(identifier: str) -> Optional[int]:
+    supabase = await get_supabase()
+    if not supabase: return None
+    response = await database._q_get_transaction_user(supabase, identifier).execute()
+    return response.data['user_id'] if response and response.data else None
+
+@_native
+async def get_transaction(identifier: str) -> Optional[Dict[str, Any]]:
+    supabase = await get_supabase()
+    if not supabase: return None
+    response = await database._q_get_transaction(supabase, identifier).execute()
+    return response.data if response and response.data else None
+
+# --- Settings ---
+async def get_setting(key: str, default: str = "") -> str:
+    """Served from database's settings cache; only a miss goes to the database."""
+    cached = database.peek_setting(key, default)
+    if cached is not None:
+        return cached
+    return await asyncio.to_thread(database.get_setting, key, default)
+
+# --- Funnel / AI history ---
+@_native
+async def track_event(user_id: int, event_type: str, bot_id: str = None):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_track_event(supabase, user_id, event_type, bot_id).execute()
+    except Exception as e:
+        logger.error(f"Error tracking event: {e}")
+
+@_native
+async def get_ai_history(bot_id: str, user_id: int, limit: int = 10):
+    supabase = await get_supabase()
+    if not supabase: return []
+    try:
+        response = await database._q_get_ai_history(supabase, bot_id, user_id, limit).execute()
+        return sorted(response.data, key=lambda x: x['created_at']) if response.data else []
+    except Exception as e:
+        logger.error(f"Error fetching AI history: {e}")
+        return []
+
+@_native
+async def add_ai_history(bot_id: str, user_id: int, role: str, content: str):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_add_ai_history(supabase, bot_id, user_id, role, content).execute()
+    except Exception as e:
+        logger.error(f"Error adding AI history: {e}")
+
+# --- Gateways & Bots ---
+@_native
+async def get_active_gateway():
+    supabase = await get_supabase()
+    if not supabase: return None
+    try:
+        response = await database._q_get_active_gateway(supabase).execute()
+        return response.data[0] if response and response.data else None
+    except Exception as e:
+        logger.error(f"Error fetching active gateway: {e}")
+        return None
+
+@_native
+async def get_all_managed_bots():
+    supabase = await get_supabase()
+    if not supabase: return []
+    try:
+        response = await database._q_get_all_managed_bots(supabase).execute()
+        return response.data or []
+    except Exception as e:
+        logger.error(f"Error fetching managed bots: {e}")
+        return []
+
+# --- Abandoned Checkouts ---
+@_native
+async def log_abandoned_checkout(user_id: int, product_id: str, bot_id: str, metadata: dict = None):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_log_abandoned_checkout(supabase, user_id, product_id, bot_id, metadata).execute()
+    except Exception as e:
+        logger.error(f"Error logging abandoned checkout: {e}")
+
+@_native
+async def update_abandoned_checkout(user_id: int, bot_id: str, status: str = None, last_stage: int = None):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_update_abandoned_checkout(supabase, user_id, bot_id, status, last_stage).execute()
+    except Exception as e:
+        logger.error(f"Error updating abandoned checkout: {e}")
+
+@_native
+async def get_pending_abandoned(bot_id: str):
+    supabase = await get_supabase()
+    if not supabase: return []
+    try:
+        res = await database._q_get_pending_abandoned(supabase, bot_id).execute()
+        return res.data if res.data else []
+    except Exception as e:
+        logger.error(f"Error fetching pending abandoned: {e}")
+        return []
+
+@_native
+async def get_due_abandoned(bot_ids: List[str], now: Optional[datetime] = None, limit: int = database.RECOVERY_DUE_BATCH):
+    supabase = await get_supabase()
+    if not supabase or not bot_ids: return []
+    try:
+        res = await database._q_get_due_abandoned(supabase, bot_ids, now, limit).execute()
+        return res.data if res.data else []
+    except Exception as e:
+        logger.error(f"Error fetching due abandoned: {e}")
+        return []
+
+@_native
+async def count_due_abandoned(bot_ids: List[str], now: Optional[datetime] = None) -> int:
+    supabase = await get_supabase()
+    if not supabase or not bot_ids: return 0
+    try:
+        res = await database._q_count_due_abandoned(supabase, bot_ids, now).execute()
+        return res.count or 0
+    except Exception as e:
+        logger.error(f"Error counting due abandoned: {e}")
+        return 0
+
+@_native
+async def update_abandoned_checkouts(ids: List[int], status: str = None, last_stage: int = None, retry_at: datetime = None, attempts: int = None):
+    supabase = await get_supabase()
+    if not supabase: return False
+    if not ids: return True
+    try:
+        await database._q_update_abandoned_checkouts(supabase, ids, status, last_stage, retry_at, attempts).execute()
+        return True
+    except Exception as e:
+        logger.error(f"Error updating abandoned checkouts: {e}")
+        return False
+
+# --- Reminders ---
+@_native
+async def save_reminder(bot_id: str, user_id: int, chat_id: int, stage: int, due_at: datetime):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_save_reminder(supabase, bot_id, user_id, chat_id, stage, due_at).execute()
+    except Exception as e:
+        logger.error(f"Error saving reminder: {e}")
+
+@_native
+async def delete_reminder(bot_id: str, user_id: int):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_delete_reminder(supabase, bot_id, user_id).execute()
+    except Exception as e:
+        logger.error(f"Error deleting reminder: {e}")
+
+@_native
+async def get_reminders(bot_id: str, after_user_id: int = None, limit: int = database.REMINDER_LOAD_BATCH) -> List[Dict[str, Any]]:
+    supabase = await get_supabase()
+    if not supabase: return []
+    try:
+        res = await database._q_get_reminders(supabase, bot_id, after_user_id, limit).execute()
+        return res.data if res.data else []
+    except Exception as e:
+        logger.error(f"Error fetching reminders: {e}")
+        return []
+
+# --- Telegram file_id cache ---
+@_native
+async def get_media_file_ids(bot_id: str) -> List[Dict[str, Any]]:
+    supabase = await get_supabase()
+    if not supabase: return []
+    try:
+        res = await database._q_get_media_file_ids(supabase, bot_id).execute()
+        return res.data if res.data else []
+    except Exception as e:
+        logger.error(f"Error fetching media file ids: {e}")
+        return []
+
+@_native
+async def save_media_file_id(bot_id: str, content_hash: str, media_type: str, file_id: str):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_save_media_file_id(supabase, bot_id, content_hash, media_type, file_id).execute()
+    except Exception as e:
+        logger.error(f"Error saving media file id: {e}")
+
+@_native
+async def delete_media_file_id(bot_id: str, content_hash: str):
+    supabase = await get_supabase()
+    if not supabase: return
+    try:
+        await database._q_delete_media_file_id(supabase, bot_id, content_hash).execute()
+    except Exception as e:
+        logger.error(f"Error deleting media file id: {e}")
+
+# --- Keyset Pagination ---
+async def _keyset_page(table: str, cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Dict[str, Any]:
+    """Async database._keyset_page. Raises on bad cursors and database errors."""
+    if database.DATABASE_BACKEND != "supabase":
+        import database_sqlite
+        return await asyncio.to_thread(database_sqlite._keyset_page, table, cursor, limit, bot_id, since, until)
+    limit = database.page_limit(limit)
+    supabase = await get_supabase()
+    if not supabase: return {"items": [], "next_cursor": None}
+    query = supabase.table(table).select(database.PAGE_SELECTS[table]).order("created_at", desc=True).order("id", desc=True).limit(limit + 1)
+    if bot_id:
+        query = query.eq("bot_id", bot_id)
+    if since:
+        query = query.gte("created_at", database._pg_ts(since))
+    if until:
+        query = query.lt("created_at", database._pg_ts(until))
+    if cursor:
+        created_at, row_id = database.decode_cursor(cursor)
+        ts, rid = json.dumps(created_at), json.dumps(str(row_id))
+        query = query.or_(f"created_at.lt.{ts},and(created_at.eq.{ts},id.lt.{rid})")
+    rows = (await query.execute()).data or []
+    if table == "transactions":
+        rows = [database._flatten_user(row) for row in rows]
+    return database.page_result(rows, limit)
+
+async def _safe_page(table: str, cursor: Optional[str], limit: int, bot_id: str) -> Dict[str, Any]:
+    try:
+        return await _keyset_page(table, cursor, limit, bot_id)
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching {table} page: {e}")
+        return {"items": [], "next_cursor": None}
+
+async def get_transactions_page(cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return await _safe_page("transactions", cursor, limit, bot_id)
+
+async def get_users_page(cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return await _safe_page("users", cursor, limit, bot_id)
+
+async def get_abandoned_checkouts_page(cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return await _safe_page("abandoned_checkouts", cursor, limit, bot_id)
+
+async def _iter_keyset(table: str, batch_size: int, bot_id: str, since: datetime = None, until: datetime = None) -> AsyncIterator[Dict[str, Any]]:
+    cursor = None
+    while True:
+        with db_metrics.label(f"adatabase.iter_{table}"):
+            page = await _keyset_page(table, cursor, batch_size, bot_id, since, until)
+        for row in page["items"]:
+            yield row
+        cursor = page["next_cursor"]
+        if not cursor:
+            return
+
+def iter_transactions(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> AsyncIterator[Dict[str, Any]]:
+    return _iter_keyset("transactions", batch_size, bot_id, since, until)
+
+def iter_users(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> AsyncIterator[Dict[str, Any]]:
+    return _iter_keyset("users", batch_size, bot_id, since, until)
+
+def iter_abandoned_checkouts(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> AsyncIterator[Dict[str, Any]]:
+    return _iter_keyset("abandoned_checkouts", batch_size, bot_id, since, until)
+
+def iter_funnel_events(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> AsyncIterator[Dict[str, Any]]:
+    return _iter_keyset("funnel_events", batch_size, bot_id, since, until)
+
+# Latência por função (db_metrics); as funções sem versão nativa já são medidas no database
+db_metrics.instrument(globals(), "adatabase", [
+    name for name, func in list(globals().items())
+    if inspect.iscoroutinefunction(func) and func.__module__ == __name__ and name not in ("get_supabase", "close_supabase")
+])
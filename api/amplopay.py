@@ -9,6 +9,25 @@ logger = logging.getLogger(__name__)
 AMPLOPAY_BASE_URL = "https://app.amplopay.com/api/v1/gateway/pix/receive"
 
 
+def build_headers(credentials: Optional[Dict[str, Any]]) -> Optional[Dict[str, str]]:
+    """Validates AmploPay credentials and returns the request headers (None if incomplete)."""
+    if not credentials:
+        logger.error("AmploPay credentials not provided.")
+        return None
+
+    public_key = credentials.get("public_key")
+    secret_key = credentials.get("secret_key")
+
+    if not public_key or not secret_key:
+        logger.error("AmploPay public_key or secret_key missing from credentials.")
+        return None
+
+    return {
+        "x-public-key": public_key,
+        "x-secret-key": secret_key,
+        "Content-Type": "application/json"
+    }
+
 async def create_pix_payment(
     identifier: str,
     amount: float,
@@ -19,29 +38,19 @@ async def create_pix_payment(
     product_title: str = "Acesso Premium",
     callback_url: Optional[str] = None,
     metadata: Optional[Dict[str, Any]] = None,
-    credentials: Optional[Dict[str, Any]] = None
+    credentials: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None
 ) -> Optional[Dict[str, Any]]:
     """
     Creates a Pix payment using AmploPay API.
     Returns standardized format: {"pix": {"code": ..., "image": ...}}
+    headers, when given, are the precomputed result of build_headers().
     """
-    if not credentials:
-        logger.error("AmploPay credentials not provided.")
+    if headers is None:
+        headers = build_headers(credentials)
+    if not headers:
         return None
 
-    public_key = credentials.get("public_key")
-    secret_key = credentials.get("secret_key")
-
-    if not public_key or not secret_key:
-        logger.error("AmploPay public_key or secret_key missing from credentials.")
-        return None
-
-    headers = {
-        "x-public-key": public_key,
-        "x-secret-key": secret_key,
-        "Content-Type": "application/json"
-    }
-
     # Clean phone (remove non-digits)
     phone_clean = "".join(filter(str.isdigit, client_phone))
     if not phone_clean:
@@ -10,6 +10,24 @@ logger = logging.getLogger(__name__)
 
 BABYLON_BASE_URL = "https://api.bancobabylon.com/functions/v1/transactions"
 
+def build_headers(credentials: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, str]]:
+    """Basic Auth headers from credentials["api_key"], falling back to BABYLON_API_KEY."""
+    api_key = (credentials or {}).get("api_key") or os.getenv("BABYLON_API_KEY")
+
+    if not api_key:
+        logger.error("Babylon API Key (BABYLON_API_KEY) not found.")
+        return None
+
+    # Basic Auth: api_key as username, password empty
+    auth_str = f"{api_key}:"
+    auth_bytes = auth_str.encode("ascii")
+    auth_base64 = base64.b64encode(auth_bytes).decode("ascii")
+
+    return {
+        "Authorization": f"Basic {auth_base64}",
+        "Content-Type": "application/json"
+    }
+
 async def create_pix_payment(
     identifier: str,
     amount: float,
@@ -19,27 +37,18 @@ async def create_pix_payment(
     client_document: str,
     product_title: str = "Acesso Premium",
     callback_url: Optional[str] = None,
-    metadata: Optional[Dict[str, Any]] = None
+    metadata: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None
 ) -> Optional[Dict[str, Any]]:
     """
     Creates a Pix payment using Banco Babylon API.
+    headers, when given, are the precomputed result of build_headers().
     """
-    api_key = os.getenv("BABYLON_API_KEY")
-
-    if not api_key:
-        logger.error("Babylon API Key (BABYLON_API_KEY) not found.")
+    if headers is None:
+        headers = build_headers()
+    if not headers:
         return None
 
-    # Basic Auth: api_key as username, password empty
-    auth_str = f"{api_key}:"
-    auth_bytes = auth_str.encode("ascii")
-    auth_base64 = base64.b64encode(auth_bytes).decode("ascii")
-
-    headers = {
-        "Authorization": f"Basic {auth_base64}",
-        "Content-Type": "application/json"
-    }
-
     # Babylon expects amount in cents (integer)
     amount_in_cents = int(round(amount * 100))
 
@@ -1,13 +1,113 @@
 import os
+import json
+import time
+import asyncio
 import logging
 from typing import Optional, Dict, Any
-import database
+import adatabase
 from api import babylon, oasyfy, amplopay, genesys
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Registro de gateways em memória: credenciais já parseadas e headers de
+# autenticação prontos, para o checkout só esperar a chamada ao provedor.
+# O painel grava "gateway_version" em settings a cada alteração; os outros
+# processos recarregam quando percebem a troca.
+GATEWAY_CACHE_TTL = float(os.getenv("GATEWAY_CACHE_TTL", "30"))
+GATEWAY_VERSION_KEY = "gateway_version"
+
+PROVIDERS = {
+    "babylon": babylon,
+    "oasyfy": oasyfy,
+    "amplopay": amplopay,
+    "genesys": genesys,
+}
+
+class ResolvedGateway:
+    """A gateways row with its credentials parsed and auth headers built once."""
+    __slots__ = ("id", "name", "provider", "module", "credentials", "headers", "is_active")
+
+    def __init__(self, row: Dict[str, Any]):
+        self.id = row.get("id")
+        self.provider = (row.get("provider") or "").lower()
+        self.name = row.get("name") or self.provider
+        self.is_active = bool(row.get("is_active"))
+        credentials = row.get("credentials") or {}
+        if isinstance(credentials, str):
+            try:
+                credentials = json.loads(credentials)
+            except ValueError:
+                logger.error(f"Gateway {self.id}: credentials are not valid JSON")
+                credentials = {}
+        self.credentials = credentials
+        self.module = PROVIDERS.get(self.provider)
+        # Só o gateway ativo recebe pagamentos: um inativo com credenciais incompletas
+        # não deve registrar erro do build_headers a cada refresh
+        self.headers = self.module.build_headers(credentials) if self.module and self.is_active else None
+
+_registry: Dict[str, ResolvedGateway] = {}
+_active: Optional[ResolvedGateway] = None
+_version: Optional[str] = None
+_loaded_at = 0.0
+_loaded = False
+_refresh_lock: Optional[asyncio.Lock] = None
+_refresh_task: Optional[asyncio.Task] = None
+
+def _lock() -> asyncio.Lock:
+    global _refresh_lock
+    if _refresh_lock is None:
+        _refresh_lock = asyncio.Lock()
+    return _refresh_lock
+
+async def refresh(only_if_stale: bool = False):
+    """Reloads every gateway and swaps the registry in one assignment."""
+    global _registry, _active, _version, _loaded_at, _loaded
+    async with _lock():
+        version = await adatabase.get_setting(GATEWAY_VERSION_KEY)
+        # Quem esperou o lock enquanto outro recarregava não repete a consulta
+        if only_if_stale and _loaded and version == _version and time.monotonic() - _loaded_at <= GATEWAY_CACHE_TTL:
+            return
+        rows = await adatabase.get_all_gateways()
+        # Lista vazia com a mesma versão costuma ser falha de rede: mantém o registro atual
+        if not rows and _registry and _loaded and version == _version:
+            _loaded_at = time.monotonic()
+            return
+        registry = {}
+        for row in rows:
+            try:
+                gw = ResolvedGateway(row)
+                registry[gw.id] = gw
+            except Exception as e:
+                logger.error(f"Error loading gateway {row.get('id')}: {e}")
+        _registry = registry
+        _active = next((gw for gw in registry.values() if gw.is_active), None)
+        _version = version
+        _loaded_at = time.monotonic()
+        _loaded = True
+
+def _refresh_in_background():
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(refresh())
+
+async def get_active_gateway() -> Optional[ResolvedGateway]:
+    """
+    Active gateway from memory. A version bump from the panel reloads before
+    answering; a plain TTL expiry reloads in the background.
+    """
+    if not _loaded or await adatabase.get_setting(GATEWAY_VERSION_KEY) != _version:
+        await refresh(only_if_stale=True)
+    elif time.monotonic() - _loaded_at > GATEWAY_CACHE_TTL:
+        _refresh_in_background()
+    return _active
+
+async def invalidate():
+    """Called by the panel after gateway edits: drops the registry everywhere."""
+    global _loaded
+    _loaded = False
+    await adatabase.set_setting(GATEWAY_VERSION_KEY, str(time.time_ns()))
 
 async def create_payment(
     identifier: str,
@@ -21,82 +121,40 @@ async def create_payment(
     metadata: Optional[Dict[str, Any]] = None
 ) -> Optional[Dict[str, Any]]:
     """
-    Gateway dispatcher: reads the active gateway from DB and routes
-    to the correct provider module.
+    Gateway dispatcher: resolves the active gateway from the in-memory
+    registry and routes to the correct provider module.
     Returns standardized format: {"pix": {"code": ..., "image": ...}}
     """
-    gw = database.get_active_gateway()
+    gw = await get_active_gateway()
 
     if not gw:
         logger.error("No active gateway configured! Cannot process payment.")
         return None
 
-    provider = gw.get("provider", "").lower()
-    credentials = gw.get("credentials", {})
-    gw_name = gw.get("name", provider)
-
-    logger.info(f"Processing payment via [{gw_name}] (provider: {provider})")
-
-    if provider == "babylon":
-        # Babylon uses env vars for auth (legacy), but we can also pass from credentials
-        # Set env var temporarily if credentials have api_key
-        if credentials.get("api_key"):
-            os.environ["BABYLON_API_KEY"] = credentials["api_key"]
-
-        return await babylon.create_pix_payment(
-            identifier=identifier,
-            amount=amount,
-            client_name=client_name,
-            client_email=client_email,
-            client_phone=client_phone,
-            client_document=client_document,
-            product_title=product_title,
-            callback_url=callback_url,
-            metadata=metadata
-        )
-
-    elif provider == "oasyfy":
-        return await oasyfy.create_pix_payment(
-            identifier=identifier,
-            amount=amount,
-            client_name=client_name,
-            client_email=client_email,
-            client_phone=client_phone,
-            client_document=client_document,
-            product_title=product_title,
-            callback_url=callback_url,
-            metadata=metadata,
-            credentials=credentials
-        )
-
-    elif provider == "amplopay":
-        return await amplopay.create_pix_payment(
-            identifier=identifier,
-            amount=amount,
-            client_name=client_name,
-            client_email=client_email,
-            client_phone=client_phone,
-            client_document=client_document,
-            product_title=product_title,
-            callback_url=callback_url,
-            metadata=metadata,
-            credentials=credentials
-        )
-
-    elif provider == "genesys":
-        return await genesys.create_pix_payment(
-            identifier=identifier,
-            amount=amount,
-            client_name=client_name,
-            client_email=client_email,
-            client_phone=client_phone,
-            client_document=client_document,
-            product_title=product_title,
-            callback_url=callback_url,
-            metadata=metadata,
-            credentials=credentials
-        )
-
-    else:
-        logger.error(f"Unknown gateway provider: {provider}")
+    if not gw.module:
+        logger.error(f"Unknown gateway provider: {gw.provider}")
+        return None
+
+    if not gw.headers:
+        logger.error(f"Gateway [{gw.name}] has incomplete credentials. Cannot process payment.")
         return None
+
+    logger.info(f"Processing payment via [{gw.name}] (provider: {gw.provider})")
+
+    kwargs = dict(
+        identifier=identifier,
+        amount=amount,
+        client_name=client_name,
+        client_email=client_email,
+        client_phone=client_phone,
+        client_document=client_document,
+        product_title=product_title,
+        callback_url=callback_url,
+        metadata=metadata,
+        headers=gw.headers
+    )
+    # Babylon não recebe credentials (a chave já está nos headers)
+    if gw.module is not babylon:
+        kwargs["credentials"] = gw.credentials
+
+    return await gw.module.create_pix_payment(**kwargs)
@@ -9,6 +9,22 @@ logger = logging.getLogger(__name__)
 GENESYS_BASE_URL = "https://api.genesys.finance/v1/transactions"
 
 
+def build_headers(credentials: Optional[Dict[str, Any]]) -> Optional[Dict[str, str]]:
+    """Validates Genesys credentials and returns the request headers (None if incomplete)."""
+    if not credentials:
+        logger.error("Genesys credentials not provided.")
+        return None
+
+    api_secret = credentials.get("api_secret")
+    if not api_secret:
+        logger.error("Genesys api_secret missing from credentials.")
+        return None
+
+    return {
+        "api-secret": api_secret,
+        "Content-Type": "application/json"
+    }
+
 async def create_pix_payment(
     identifier: str,
     amount: float,
@@ -19,26 +35,19 @@ async def create_pix_payment(
     product_title: str = "Acesso Premium",
     callback_url: Optional[str] = None,
     metadata: Optional[Dict[str, Any]] = None,
-    credentials: Optional[Dict[str, Any]] = None
+    credentials: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None
 ) -> Optional[Dict[str, Any]]:
     """
     Creates a Pix payment using Genesys Finance API.
     Returns standardized format: {"pix": {"code": ..., "image": ...}}
+    headers, when given, are the precomputed result of build_headers().
     """
-    if not credentials:
-        logger.error("Genesys credentials not provided.")
-        return None
-
-    api_secret = credentials.get("api_secret")
-    if not api_secret:
-        logger.error("Genesys api_secret missing from credentials.")
+    if headers is None:
+        headers = build_headers(credentials)
+    if not headers:
         return None
 
-    headers = {
-        "api-secret": api_secret,
-        "Content-Type": "application/json"
-    }
-
     # Clean phone (remove non-digits)
     phone_clean = "".join(filter(str.isdigit, client_phone))
     if not phone_clean:
@@ -49,7 +58,7 @@ async def create_pix_payment(
     doc_type = "CPF" if len(doc_clean) <= 11 else "CNPJ"
 
     # Build webhook URL from credentials or use painel URL
-    webhook_url = credentials.get("webhook_url", "")
+    webhook_url = (credentials or {}).get("webhook_url", "")
     if not webhook_url:
         import os
         base_url = os.getenv("PAINEL_URL", "https://kamycontrol.onrender.com")
@@ -2,7 +2,7 @@ import hashlib
 import time
 import httpx
 import logging
-import database
+import adatabase
 from typing import Optional, Dict, Any
 
 # Configure logging
@@ -27,8 +27,8 @@ async def send_tiktok_event(
     """
     Sends a server-side event to TikTok Ads API.
     """
-    access_token = database.get_setting("tiktok_api_token")
-    pixel_id = database.get_setting("tiktok_pixel_id")
+    access_token = await adatabase.get_setting("tiktok_api_token")
+    pixel_id = await adatabase.get_setting("tiktok_pixel_id")
 
     if not access_token or not pixel_id:
         logger.warning("TikTok Ads API not configured. Skipping event.")
@@ -3,7 +3,7 @@ import httpx
 import logging
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List
-import database
+import adatabase
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -49,7 +49,7 @@ async def send_order(
     Sends order information to UTMfy Orders API.
     """
     # Fetch token dynamically from database
-    token = database.get_setting("utmfy_api_token") or os.getenv("UTMFY_API_TOKEN")
+    token = await adatabase.get_setting("utmfy_api_token") or os.getenv("UTMFY_API_TOKEN")
     
     if not token:
         logger.warning("UTMFY_API_TOKEN not configured in DB or ENV. Skipping event.")
@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional
+import adatabase
+
+logger = logging.getLogger(__name__)
+
+# Registro compartilhado de managed_bots: uma leitura da tabela por processo,
+# versão local incrementada a cada mudança e espera por notificação em vez
+# de cada instância de bot consultar a tabela em loop.
+# O painel grava "bots_version" em settings ao alterar bots; o refresher
+# percebe a troca (cache de settings com TTL curto) e recarrega na hora.
+BOT_REGISTRY_TTL = float(os.getenv("BOT_REGISTRY_TTL", "60"))
+BOT_REGISTRY_POLL = float(os.getenv("BOT_REGISTRY_POLL", "5"))
+BOTS_VERSION_KEY = "bots_version"
+
+_bots: Dict[str, Dict[str, Any]] = {}
+_version = 0
+_shared_version: Optional[str] = None
+_loaded_at = 0.0
+_loaded = False
+_changed: Optional[asyncio.Condition] = None
+_refresher: Optional[asyncio.Task] = None
+
+def _condition() -> asyncio.Condition:
+    global _changed
+    if _changed is None:
+        _changed = asyncio.Condition()
+    return _changed
+
+async def refresh() -> bool:
+    """Reloads managed_bots in one query. Returns True (and wakes waiters) if anything changed."""
+    global _bots, _version, _shared_version, _loaded_at, _loaded
+    shared = await adatabase.get_setting(BOTS_VERSION_KEY)
+    rows = await adatabase.get_all_managed_bots()
+    _loaded_at = time.monotonic()
+    # Lista vazia sem troca de versão costuma ser falha de rede: mantém o registro atual
+    if not rows and _bots and shared == _shared_version:
+        return False
+    _shared_version = shared
+    bots = {row['id']: row for row in rows}
+    if _loaded and bots == _bots:
+        return False
+    _bots = bots
+    _version += 1
+    _loaded = True
+    cond = _condition()
+    async with cond:
+        cond.notify_all()
+    return True
+
+def get(bot_id: str) -> Optional[Dict[str, Any]]:
+    return _bots.get(bot_id)
+
+def active() -> List[Dict[str, Any]]:
+    return [bot for bot in _bots.values() if bot.get('is_active')]
+
+def version() -> int:
+    return _version
+
+async def wait_for_change(since: int, timeout: Optional[float] = None) -> int:
+    """Blocks until the registry version differs from `since` (or timeout). Returns the current version."""
+    cond = _condition()
+    async with cond:
+        try:
+            await asyncio.wait_for(cond.wait_for(lambda: _version != since), timeout)
+        except asyncio.TimeoutError:
+            pass
+    return _version
+
+async def _run():
+    while True:
+        await asyncio.sleep(BOT_REGISTRY_POLL)
+        try:
+            stale = time.monotonic() - _loaded_at > BOT_REGISTRY_TTL
+            if stale or await adatabase.get_setting(BOTS_VERSION_KEY) != _shared_version:
+                await refresh()
+        except Exception as e:
+            logger.error(f"Bot registry refresh error: {e}")
+
+async def start():
+    """Loads the registry and starts the background refresher (idempotent)."""
+    global _refresher
+    if not _loaded:
+        await refresh()
+    if _refresher is None or _refresher.done():
+        _refresher = asyncio.create_task(_run())
+
+async def stop():
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        try:
+            await _refresher
+        except (asyncio.CancelledError, Exception):
+            pass
+        _refresher = None
+
+async def invalidate():
+    """Called after bot edits: bumps the shared version and reloads locally if in use."""
+    await adatabase.set_setting(BOTS_VERSION_KEY, str(time.time_ns()))
+    if _loaded:
+        await refresh()
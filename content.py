@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, List, Optional
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import database
+import adatabase
+
+logger = logging.getLogger(__name__)
+
+# Snapshot em memória de bot_content + content_product_links + products.
+# O painel grava "content_version" em settings a cada edição; os outros
+# processos percebem a troca pelo cache de settings (sem consulta extra).
+CONTENT_CACHE_TTL = float(os.getenv("CONTENT_CACHE_TTL", "300"))
+CONTENT_VERSION_KEY = "content_version"
+
+WELCOME_TEXT_DEFAULT = "Olá! Escolha seu plano e comece agora:"
+WELCOME_MEDIA_DEFAULT = os.path.join("imgs", "3banner.mp4")
+
+class Screen:
+    """Pre-rendered message: text, keyboard and resolved media path."""
+    __slots__ = ("text", "reply_markup", "media_path")
+
+    def __init__(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, media_path: Optional[str] = None):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.media_path = media_path
+
+def resolve_media_path(value: Optional[str], default_rel_path: str) -> str:
+    """Maps a /media/... content value to the file under painel/, or the default."""
+    if value and value.startswith("/media/"):
+        full_path = os.path.join("painel", value.lstrip("/"))
+        if os.path.exists(full_path):
+            return full_path
+    return default_rel_path
+
+class ContentSnapshot:
+    """Immutable view of the bot content tables with every screen compiled up front."""
+
+    def __init__(self, rows: Dict[str, List[Dict[str, Any]]], version: str = ""):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.content = {row['key']: row for row in rows.get("content", [])}
+        self.links: Dict[str, List[str]] = {}
+        for link in rows.get("links", []):
+            self.links.setdefault(link['content_key'], []).append(link['product_id'])
+        self.all_products = rows.get("products", [])
+        self.products = {
+            row['id']: {"name": row['name'], "price": row['price'], "desc": row['description']}
+            for row in self.all_products if row.get('active') == 1
+        }
+
+        self.welcome = self._compile_welcome()
+        self.catalog = self._compile_catalog()
+        self.product_screens = {pid: self._compile_product(pid, p) for pid, p in self.products.items()}
+
+    def get(self, key: str, default: str = "") -> str:
+        row = self.content.get(key)
+        return row['value'] if row and row.get('value') is not None else default
+
+    def products_for(self, key: str) -> List[str]:
+        return self.links.get(key, [])
+
+    def content_for_product(self, key: str, product_id: str, default: str = "") -> str:
+        return self.get(key, default)
+
+    def media_path(self, key: str, default_rel_path: str) -> str:
+        return resolve_media_path(self.get(key), default_rel_path)
+
+    def _compile_welcome(self) -> Screen:
+        keyboard = []
+        for prod_id in self.products_for("welcome_text"):
+            product = self.products.get(prod_id)
+            if product:
+                btn_label = f"🔥 {product['name']} POR R${product['price']:.2f}"
+                keyboard.append([InlineKeyboardButton(btn_label, callback_data=f"buy_{prod_id}")])
+        return Screen(
+            self.get("welcome_text", WELCOME_TEXT_DEFAULT),
+            InlineKeyboardMarkup(keyboard) if keyboard else None,
+            self.media_path("welcome_photo", WELCOME_MEDIA_DEFAULT)
+        )
+
+    def _compile_catalog(self) -> Screen:
+        keyboard = [[InlineKeyboardButton(f"{details['name']} - R${details['price']:.2f}", callback_data=f'prod_{pid}')] for pid, details in self.products.items()]
+        keyboard.append([InlineKeyboardButton("🔙 Voltar ao Menu", callback_data='main_menu')])
+        return Screen("🔥 **Catálogo de Conteúdos** 🔥", InlineKeyboardMarkup(keyboard))
+
+    def _compile_product(self, pid: str, product: Dict[str, Any]) -> Screen:
+        btn = [[InlineKeyboardButton("💳 Comprar", callback_data=f'buy_{pid}')], [InlineKeyboardButton("🔙 Voltar", callback_data='list_products')]]
+        return Screen(f"🔞 **{product['name']}**\n\n{product['desc']}\n💰 R${product['price']:.2f}", InlineKeyboardMarkup(btn))
+
+_snapshot: Optional[ContentSnapshot] = None
+_refresh_lock = threading.Lock()
+
+def refresh() -> ContentSnapshot:
+    """Reloads the tables and swaps the snapshot in one assignment."""
+    global _snapshot
+    with _refresh_lock:
+        version = database.get_setting(CONTENT_VERSION_KEY)
+        rows = database.get_content_snapshot()
+        if rows is not None:
+            try:
+                _snapshot = ContentSnapshot(rows, version)
+            except Exception as e:
+                logger.error(f"Error compiling content snapshot: {e}")
+        # Sem banco e sem snapshot anterior: devolve um vazio (defaults) sem fixá-lo
+        return _snapshot or ContentSnapshot({})
+
+def _stale(snap: Optional[ContentSnapshot], version: str) -> bool:
+    if snap is None:
+        return True
+    if time.monotonic() - snap.loaded_at > CONTENT_CACHE_TTL:
+        return True
+    return version != snap.version
+
+def is_stale() -> bool:
+    """Sync check; may read the setting from the database on a cache miss (not for the event loop)."""
+    return _stale(_snapshot, database.get_setting(CONTENT_VERSION_KEY))
+
+def snapshot() -> ContentSnapshot:
+    """The snapshot in memory as is, with no freshness check or database access (defaults before the first load)."""
+    return _snapshot or ContentSnapshot({})
+
+def current() -> ContentSnapshot:
+    """Current snapshot; loads synchronously only if it is stale. For threads and sync callers."""
+    if is_stale():
+        return refresh()
+    return _snapshot
+
+async def load() -> ContentSnapshot:
+    """Async variant of current(): the version check and any reload stay off the event loop."""
+    snap = _snapshot
+    if snap is not None and time.monotonic() - snap.loaded_at <= CONTENT_CACHE_TTL:
+        version = await adatabase.get_setting(CONTENT_VERSION_KEY)
+        if not _stale(snap, version):
+            return snap
+    return await asyncio.to_thread(refresh)
+
+def invalidate():
+    """Called after panel edits: bumps the shared version and rebuilds locally."""
+    database.set_setting(CONTENT_VERSION_KEY, str(time.time_ns()))
+    refresh()
@@ -1,10 +1,16 @@
 import os
 import json
-from datetime import datetime, timezone
-from typing import Dict, Any, List, Optional
-from supabase import create_client, Client
+import base64
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
+from typing import Dict, Any, List, Optional, Iterator
+import httpx
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 import logging
+import db_metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -20,15 +26,120 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 if SUPABASE_URL and SUPABASE_URL.count("https://") > 1:
     SUPABASE_URL = "https://" + SUPABASE_URL.split("https://")[-1]
 
+# Connection pool configuration (shared by every helper in this module)
+SUPABASE_POOL_MAX_CONNECTIONS = int(os.getenv("SUPABASE_POOL_MAX_CONNECTIONS", "20"))
+SUPABASE_POOL_MAX_KEEPALIVE = int(os.getenv("SUPABASE_POOL_MAX_KEEPALIVE", "10"))
+SUPABASE_POOL_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_POOL_KEEPALIVE_EXPIRY", "60"))
+SUPABASE_HTTP_TIMEOUT = float(os.getenv("SUPABASE_HTTP_TIMEOUT", "10"))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5"))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "true").lower() == "true"
+
+_client: Optional[Client] = None
+_http_client: Optional[httpx.Client] = None
+_transport: Optional[httpx.HTTPTransport] = None
+_client_lock = threading.Lock()
+
+_pool_stats = {"clients_created": 0, "requests": 0, "errors": 0, "in_flight": 0}
+_pool_stats_lock = threading.Lock()
+
+class _CountingTransport(httpx.HTTPTransport):
+    """HTTPTransport that keeps request counters for get_pool_stats()."""
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        with _pool_stats_lock:
+            _pool_stats["requests"] += 1
+            _pool_stats["in_flight"] += 1
+        started = time.perf_counter()
+        response = None
+        try:
+            response = super().handle_request(request)
+            # Lê o corpo aqui para a latência e o tamanho incluírem o download
+            response.read()
+            return response
+        except Exception:
+            with _pool_stats_lock:
+                _pool_stats["errors"] += 1
+            raise
+        finally:
+            with _pool_stats_lock:
+                _pool_stats["in_flight"] -= 1
+            db_metrics.record_http(request, response, (time.perf_counter() - started) * 1000)
+
+def _build_http_client() -> httpx.Client:
+    global _transport
+    limits = httpx.Limits(
+        max_connections=SUPABASE_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=SUPABASE_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=SUPABASE_POOL_KEEPALIVE_EXPIRY,
+    )
+    try:
+        _transport = _CountingTransport(limits=limits, http2=SUPABASE_HTTP2)
+    except ImportError:
+        # h2 não instalado: segue em HTTP/1.1 com keep-alive
+        logger.warning("h2 package not installed, Supabase pool falling back to HTTP/1.1")
+        _transport = _CountingTransport(limits=limits)
+    return httpx.Client(
+        transport=_transport,
+        timeout=httpx.Timeout(SUPABASE_HTTP_TIMEOUT, connect=SUPABASE_CONNECT_TIMEOUT),
+        follow_redirects=True,
+    )
+
 def get_supabase() -> Optional[Client]:
+    """Returns the process-wide Supabase client (created once, thread-safe)."""
+    global _client, _http_client
+    if _client is not None:
+        return _client
     if not SUPABASE_URL or not SUPABASE_KEY:
         logger.error("❌ CRITICAL: SUPABASE_URL or SUPABASE_KEY not set in environment!")
         return None
-    try:
-        return create_client(SUPABASE_URL, SUPABASE_KEY)
-    except Exception as e:
-        logger.error(f"❌ Error creating Supabase client: {e}")
-        return None
+    with _client_lock:
+        if _client is not None:
+            return _client
+        try:
+            http_client = _build_http_client()
+            client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
+            # Instancia o PostgREST aqui dentro do lock (a property é lazy e não é thread-safe)
+            client.postgrest
+            _http_client = http_client
+            _client = client
+            with _pool_stats_lock:
+                _pool_stats["clients_created"] += 1
+            logger.info(f"Supabase pool ready (max_connections={SUPABASE_POOL_MAX_CONNECTIONS}, keepalive={SUPABASE_POOL_MAX_KEEPALIVE})")
+            return _client
+        except Exception as e:
+            logger.error(f"❌ Error creating Supabase client: {e}")
+            return None
+
+def close_supabase():
+    """Closes the shared pool. The next get_supabase() call builds a new one."""
+    global _client, _http_client, _transport
+    with _client_lock:
+        if _http_client is not None:
+            try:
+                _http_client.close()
+            except Exception as e:
+                logger.error(f"Error closing Supabase pool: {e}")
+        _client = None
+        _http_client = None
+        _transport = None
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Snapshot of the shared Supabase connection pool."""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats["max_connections"] = SUPABASE_POOL_MAX_CONNECTIONS
+    stats["max_keepalive"] = SUPABASE_POOL_MAX_KEEPALIVE
+    stats["open_connections"] = 0
+    stats["idle_connections"] = 0
+    pool = getattr(_transport, "_pool", None)
+    for conn in list(getattr(pool, "connections", None) or []):
+        stats["open_connections"] += 1
+        try:
+            if conn.is_idle():
+                stats["idle_connections"] += 1
+        except Exception:
+            pass
+    return stats
 
 def init_db():
     """
@@ -37,10 +148,52 @@ def init_db():
     """
     pass
 
-# --- User & Transaction Helpers ---
-def log_user(user_id: int, username: str, full_name: str, tracking_data: Optional[Dict[str, Any]] = None, bot_id: str = None):
+# --- Bulk Loaders ---
+def load_related(parent_table: str, child_table: str, fk: str, parent_key: str = "id", child_columns: str = "*", parent_columns: str = "*") -> List[Dict[str, Any]]:
+    """
+    Loads every row of parent_table with its child_table rows attached under
+    row[child_table], in a constant number of round trips: one embedded select
+    when PostgREST knows the FK, otherwise two set-based queries joined here.
+    Raises on database errors; callers decide the fallback.
+    """
     supabase = get_supabase()
-    if not supabase: return
+    if not supabase: return []
+    try:
+        response = supabase.table(parent_table).select(f"{parent_columns}, {child_table}({child_columns})").execute()
+        rows = response.data or []
+        for row in rows:
+            row[child_table] = row.get(child_table) or []
+        return rows
+    except Exception as e:
+        logger.warning(f"Embedded select {parent_table}->{child_table} failed, using two queries: {e}")
+
+    parents = supabase.table(parent_table).select(parent_columns).execute().data or []
+    children_by_key: Dict[Any, List[Dict[str, Any]]] = {}
+    if parents:
+        select_cols = child_columns if child_columns == "*" else f"{child_columns}, {fk}"
+        children = supabase.table(child_table).select(select_cols).execute().data or []
+        for child in children:
+            children_by_key.setdefault(child.get(fk), []).append(child)
+    for row in parents:
+        row[child_table] = children_by_key.get(row.get(parent_key), [])
+    return parents
+
+# Consultas compartilhadas com adatabase: cada _q_* monta o request PostgREST
+# (tabela, filtros, payload) num client sync ou async, sem executar — a API de
+# encadeamento do postgrest é a mesma nos dois; quem chama faz .execute().
+def _q_insert_rows(db, table: str, rows: List[Dict[str, Any]]):
+    return db.table(table).insert(rows)
+
+def insert_rows(table: str, rows: List[Dict[str, Any]]):
+    """Bulk insert in a single request. Raises on failure so buffered writers can retry."""
+    if not rows: return
+    supabase = get_supabase()
+    if not supabase:
+        raise RuntimeError("Supabase not configured")
+    _q_insert_rows(supabase, table, rows).execute()
+
+# --- User & Transaction Helpers ---
+def _q_log_user(db, user_id: int, username: str, full_name: str, tracking_data: Optional[Dict[str, Any]] = None, bot_id: str = None):
     data = {
         "id": user_id,
         "username": username,
@@ -48,32 +201,36 @@ def log_user(user_id: int, username: str, full_name: str, tracking_data: Optiona
         "created_at": datetime.now(timezone.utc).isoformat(),
         "bot_id": bot_id
     }
-    
     if tracking_data:
         # Standard UTMs + ttclid
         for key in ["utm_source", "utm_medium", "utm_campaign", "utm_content", "utm_term", "ttclid"]:
             if key in tracking_data:
                 data[key] = tracking_data[key]
-    
+    return db.table("users").upsert(data)
+
+def log_user(user_id: int, username: str, full_name: str, tracking_data: Optional[Dict[str, Any]] = None, bot_id: str = None):
+    supabase = get_supabase()
+    if not supabase: return
     try:
-        supabase.table("users").upsert(data).execute()
+        _q_log_user(supabase, user_id, username, full_name, tracking_data, bot_id).execute()
     except Exception as e:
         logger.error(f"Error logging user {user_id}: {e}")
                 
+def _q_get_user(db, user_id: int):
+    return db.table("users").select("*").eq("id", user_id).maybe_single()
+
 def get_user(user_id: int) -> Optional[Dict[str, Any]]:
     supabase = get_supabase()
     if not supabase: return None
     try:
-        response = supabase.table("users").select("*").eq("id", user_id).maybe_single().execute()
-        return response.data
+        response = _q_get_user(supabase, user_id).execute()
+        return response.data if response else None
     except Exception as e:
         logger.error(f"Error fetching user {user_id}: {e}")
         return None
 
-def log_transaction(identifier: str, user_id: int, product_id: str, amount: float, status: str = 'pending', payment_method: str = 'PIX', client_email: str = None, metadata: Optional[Dict[str, Any]] = None, created_at: str = None, bot_id: str = None):
-    supabase = get_supabase()
-    if not supabase: return
-    data = {
+def _q_log_transaction(db, identifier: str, user_id: int, product_id: str, amount: float, status: str = 'pending', payment_method: str = 'PIX', client_email: str = None, metadata: Optional[Dict[str, Any]] = None, created_at: str = None, bot_id: str = None):
+    return db.table("transactions").insert({
         "id": identifier,
         "user_id": user_id,
         "product_id": product_id,
@@ -84,11 +241,14 @@ def log_transaction(identifier: str, user_id: int, product_id: str, amount: floa
         "created_at": created_at or datetime.now(timezone.utc).isoformat(),
         "metadata": metadata or {},
         "bot_id": bot_id
-    }
-    supabase.table("transactions").insert(data).execute()
+    })
 
-def update_transaction_status(identifier: str, status: str, oasyfy_id: str = None):
+def log_transaction(identifier: str, user_id: int, product_id: str, amount: float, status: str = 'pending', payment_method: str = 'PIX', client_email: str = None, metadata: Optional[Dict[str, Any]] = None, created_at: str = None, bot_id: str = None):
     supabase = get_supabase()
+    if not supabase: return
+    _q_log_transaction(supabase, identifier, user_id, product_id, amount, status, payment_method, client_email, metadata, created_at, bot_id).execute()
+
+def _q_update_transaction_status(db, identifier: str, status: str, oasyfy_id: str = None):
     update_data = {"status": status}
     if status == 'confirmed':
         update_data["confirmed_at"] = datetime.now(timezone.utc).isoformat()
@@ -96,19 +256,60 @@ def update_transaction_status(identifier: str, status: str, oasyfy_id: str = Non
         update_data["oasyfy_id"] = oasyfy_id
 
     # Update by ID or oasyfy_id
-    query = supabase.table("transactions").update(update_data)
+    query = db.table("transactions").update(update_data)
     if oasyfy_id:
-        query.or_(f"id.eq.{identifier},oasyfy_id.eq.{oasyfy_id}").execute()
-    else:
-        query.eq("id", identifier).execute()
+        return query.or_(f"id.eq.{identifier},oasyfy_id.eq.{oasyfy_id}")
+    return query.eq("id", identifier)
+
+def update_transaction_status(identifier: str, status: str, oasyfy_id: str = None):
+    # A trigger transactions_utm_rollup (migrations/0005) lança a venda no
+    # rollup de UTM na mesma instrução quando o status vira/deixa 'confirmed'.
+    supabase = get_supabase()
+    if not supabase: return
+    _q_update_transaction_status(supabase, identifier, status, oasyfy_id).execute()
 
 def confirm_transaction(identifier: str):
     update_transaction_status(identifier, 'confirmed')
 
 # --- Data Fetching for Metrics/Admin ---
-def get_metrics():
+# Funções SQL em migrations/. Se uma RPC não existir no projeto, o helper
+# volta para o caminho em Python e só tenta de novo depois de RPC_RETRY_SECONDS.
+RPC_RETRY_SECONDS = 600
+METRICS_ESTIMATED_COUNTS = os.getenv("METRICS_ESTIMATED_COUNTS", "false").lower() == "true"
+_rpc_unavailable_until: Dict[str, float] = {}
+
+def _call_rpc(fn: str, params: Optional[Dict[str, Any]] = None):
+    """Calls a Postgres function; returns None (and backs off) when it is not installed."""
+    if _rpc_unavailable_until.get(fn, 0) > time.monotonic():
+        return None
     supabase = get_supabase()
-    if not supabase: return {"total_users": 0, "total_sales": 0, "total_revenue": 0.0, "pending_pix": 0}
+    if not supabase: return None
+    try:
+        return supabase.rpc(fn, params or {}).execute().data
+    except Exception as e:
+        logger.warning(f"RPC {fn} unavailable, using fallback: {e}")
+        _rpc_unavailable_until[fn] = time.monotonic() + RPC_RETRY_SECONDS
+        return None
+
+def get_metrics(estimated: bool = None):
+    empty = {"total_users": 0, "total_sales": 0, "total_revenue": 0.0, "pending_pix": 0}
+    if estimated is None:
+        estimated = METRICS_ESTIMATED_COUNTS
+    data = _call_rpc("dashboard_metrics", {"estimated": estimated})
+    if isinstance(data, list):
+        data = data[0] if data else None
+    if data:
+        return {
+            "total_users": data.get("total_users") or 0,
+            "total_sales": data.get("total_sales") or 0,
+            "total_revenue": float(data.get("total_revenue") or 0.0),
+            "pending_pix": data.get("pending_pix") or 0
+        }
+    return _get_metrics_fallback() or empty
+
+def _get_metrics_fallback():
+    supabase = get_supabase()
+    if not supabase: return None
     
     try:
         total_users = supabase.table("users").select("id", count="exact").execute().count or 0
@@ -127,7 +328,13 @@ def get_metrics():
         }
     except Exception as e:
         logger.error(f"Error fetching metrics: {e}")
-        return {"total_users": 0, "total_sales": 0, "total_revenue": 0.0, "pending_pix": 0}
+        return None
+
+def _flatten_user(row: Dict[str, Any]) -> Dict[str, Any]:
+    user_info = row.pop('users', {}) or {}
+    row['username'] = user_info.get('username')
+    row['full_name'] = user_info.get('full_name')
+    return row
 
 def get_all_transactions(limit: int = 100):
     supabase = get_supabase()
@@ -135,13 +342,7 @@ def get_all_transactions(limit: int = 100):
     try:
         response = supabase.table("transactions").select("*, users(username, full_name)").order("created_at", desc=True).limit(limit).execute()
         
-        results = []
-        for row in response.data:
-            user_info = row.pop('users', {}) or {}
-            row['username'] = user_info.get('username')
-            row['full_name'] = user_info.get('full_name')
-            results.append(row)
-        return results
+        return [_flatten_user(row) for row in response.data]
     except Exception as e:
         logger.error(f"Error fetching transactions: {e}")
         return []
@@ -187,67 +388,276 @@ def update_product(p_id: str, name: str, price: float, description: str, active:
     }).eq("id", p_id).execute()
 
 # --- Settings ---
-def get_setting(key: str, default: str = "") -> str:
+# Cache em memória da tabela settings: {key: (value | _MISSING, expires_at)}
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "60"))
+# TTL por chave (segundos). 0 = sempre lê do banco.
+SETTINGS_TTL_OVERRIDES: Dict[str, float] = {
+    "maintenance_mode": 10,
+    "bot_last_heartbeat": 0,
+    # Chaves de versão gravadas pelo painel: a invalidação chega aos outros processos em segundos
+    "bots_version": 5,  # bot_registry
+    "gateway_version": 5,  # api/gateway.py
+    "content_version": 5,  # content.py
+    "media_version": 5,  # media_store.py
+}
+
+_MISSING = object()
+_settings_cache: Dict[str, tuple] = {}
+_settings_lock = threading.Lock()
+_settings_preload_expires = 0.0
+
+def _setting_ttl(key: str) -> float:
+    return SETTINGS_TTL_OVERRIDES.get(key, SETTINGS_CACHE_TTL)
+
+def _cache_setting(key: str, value: Any, now: float):
+    ttl = _setting_ttl(key)
+    if ttl > 0:
+        _settings_cache[key] = (value, now + ttl)
+
+# Leituras/escritas cruas da tabela settings, trocadas pelo backend (BACKEND_API);
+# o cache acima e as funções abaixo valem para qualquer backend
+def _fetch_settings() -> List[Dict[str, Any]]:
+    """Every settings row (key, value). Raises on failure."""
     supabase = get_supabase()
-    if not supabase: return default
+    if not supabase: raise RuntimeError("Supabase not configured")
+    response = supabase.table("settings").select("key, value").execute()
+    return response.data or []
+
+def _fetch_setting(key: str) -> Any:
+    """The stored value of key, or _MISSING. Raises on failure."""
+    supabase = get_supabase()
+    if not supabase: raise RuntimeError("Supabase not configured")
+    response = supabase.table("settings").select("value").eq("key", key).limit(1).execute()
+    return response.data[0]['value'] if response and response.data and len(response.data) > 0 else _MISSING
+
+def _store_setting(key: str, value: str):
+    supabase = get_supabase()
+    if not supabase: return
+    supabase.table("settings").upsert({"key": key, "value": value}).execute()
+
+def preload_settings() -> bool:
+    """Loads the whole settings table in one query and refreshes the cache."""
+    global _settings_preload_expires
     try:
-        response = supabase.table("settings").select("value").eq("key", key).limit(1).execute()
-        if response and response.data and len(response.data) > 0:
-            return response.data[0]['value']
-        return default
+        rows = _fetch_settings()
+        now = time.monotonic()
+        with _settings_lock:
+            _settings_cache.clear()
+            for row in rows:
+                _cache_setting(row['key'], row['value'], now)
+            _settings_preload_expires = now + SETTINGS_CACHE_TTL
+        return True
+    except Exception as e:
+        logger.error(f"Error preloading settings: {e}")
+        return False
+
+def invalidate_setting(key: str = None):
+    """Drops one key (or the whole cache when key is None)."""
+    global _settings_preload_expires
+    with _settings_lock:
+        if key is None:
+            _settings_cache.clear()
+            _settings_preload_expires = 0.0
+        else:
+            # Entrada expirada força releitura mesmo com o snapshot válido
+            _settings_cache[key] = (_MISSING, 0.0)
+
+def _lookup_setting(key: str, now: float):
+    with _settings_lock:
+        entry = _settings_cache.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+        # Com o snapshot completo válido, chave ausente = negativo
+        if entry is None and _settings_preload_expires > now and _setting_ttl(key) > 0:
+            return _MISSING
+    return None
+
+def get_setting(key: str, default: str = "") -> str:
+    now = time.monotonic()
+    cached = _lookup_setting(key, now)
+    if cached is None and _setting_ttl(key) > 0 and _settings_preload_expires <= now:
+        preload_settings()
+        cached = _lookup_setting(key, time.monotonic())
+    if cached is not None:
+        return default if cached is _MISSING else cached
+
+    try:
+        value = _fetch_setting(key)
+        with _settings_lock:
+            _cache_setting(key, value, time.monotonic())
+        return default if value is _MISSING else value
     except Exception as e:
         logger.error(f"Error getting setting {key}: {e}")
         return default
 
+def peek_setting(key: str, default: str = "") -> Optional[str]:
+    """Cache-only lookup: the value (or default) if the cache can answer, else None."""
+    cached = _lookup_setting(key, time.monotonic())
+    if cached is None:
+        return None
+    return default if cached is _MISSING else cached
+
 def set_setting(key: str, value: Any):
-    supabase = get_supabase()
-    if not supabase: return
     try:
-        supabase.table("settings").upsert({"key": key, "value": str(value)}).execute()
+        _store_setting(key, str(value))
     except Exception as e:
         logger.error(f"Error setting {key}: {e}")
+    finally:
+        invalidate_setting(key)
 
 # --- Stats for Charts ---
-def get_revenue_stats(days: int = 7):
-    supabase = get_supabase()
-    if not supabase: return []
+REPORT_TIMEZONE = os.getenv("REPORT_TIMEZONE", "America/Sao_Paulo")
+REVENUE_GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+def _truncate(dt: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return dt.replace(minute=0, second=0, microsecond=0)
+    dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == "week":
+        dt -= timedelta(days=dt.weekday())
+    return dt
+
+def _bucket_label(dt: datetime, granularity: str) -> str:
+    return dt.strftime("%Y-%m-%d %H:00") if granularity == "hour" else dt.strftime("%Y-%m-%d")
+
+def _parse_ts(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def get_revenue_series(start: Optional[datetime] = None, end: Optional[datetime] = None, granularity: str = "day", tz: str = None, bot_id: str = None, product_id: str = None, periods: int = 7) -> List[Dict[str, Any]]:
+    """
+    Confirmed revenue bucketed by hour/day/week in `tz` (default REPORT_TIMEZONE).
+    Only rows inside [start, end) are read; without start, the last `periods`
+    buckets up to now are returned. Empty buckets come back as zero.
+    """
+    if granularity not in REVENUE_GRANULARITIES:
+        raise ValueError(f"Invalid granularity: {granularity}")
     try:
-        response = supabase.table("transactions").select("created_at, amount").eq("status", "confirmed").order("created_at", desc=True).execute()
-        
-        stats = {}
-        for row in response.data:
-            day = row['created_at'].split("T")[0]
-            stats[day] = stats.get(day, 0) + row['amount']
-            if len(stats) >= days: break
-            
-        return [{"day": d, "total": v} for d, v in sorted(stats.items())]
-    except Exception as e:
-        logger.error(f"Error fetching revenue stats: {e}")
-        return []
+        zone = ZoneInfo(tz or REPORT_TIMEZONE)
+    except Exception:
+        logger.error(f"Invalid timezone {tz}, using {REPORT_TIMEZONE}")
+        zone = ZoneInfo(REPORT_TIMEZONE)
+    step = REVENUE_GRANULARITIES[granularity]
+
+    end = (end or datetime.now(timezone.utc)).astimezone(zone)
+    if start is None:
+        start = _truncate(end, granularity) - step * (periods - 1)
+    start = _truncate(start.astimezone(zone), granularity)
+
+    totals: Dict[str, Dict[str, Any]] = {}
+    rows = _call_rpc("revenue_series", {
+        "p_start": start.isoformat(), "p_end": end.isoformat(),
+        "p_granularity": granularity, "p_tz": zone.key,
+        "p_bot_id": bot_id, "p_product_id": product_id
+    })
+    if rows is not None:
+        for row in rows:
+            label = _bucket_label(datetime.fromisoformat(row['bucket']), granularity)
+            totals[label] = {"total": float(row['total'] or 0), "sales": row['sales']}
+    else:
+        supabase = get_supabase()
+        if not supabase: return []
+        try:
+            query = supabase.table("transactions").select("created_at, amount").eq("status", "confirmed").gte("created_at", start.isoformat()).lt("created_at", end.isoformat())
+            if bot_id:
+                query = query.eq("bot_id", bot_id)
+            if product_id:
+                query = query.eq("product_id", product_id)
+            for row in query.execute().data or []:
+                label = _bucket_label(_truncate(_parse_ts(row['created_at']).astimezone(zone), granularity), granularity)
+                bucket = totals.setdefault(label, {"total": 0.0, "sales": 0})
+                bucket["total"] += row['amount'] or 0
+                bucket["sales"] += 1
+        except Exception as e:
+            logger.error(f"Error fetching revenue series: {e}")
+            return []
+
+    series = []
+    cursor = start
+    while cursor <= end:
+        label = _bucket_label(cursor, granularity)
+        bucket = totals.get(label, {"total": 0.0, "sales": 0})
+        series.append({"bucket": label, "total": bucket["total"], "sales": bucket["sales"]})
+        # Soma no relógio de parede para atravessar mudanças de horário sem deslocar o bucket
+        cursor = _truncate((cursor.replace(tzinfo=None) + step).replace(tzinfo=zone), granularity)
+    return series
+
+def get_revenue_stats(days: int = 7):
+    """Daily revenue for the last `days` days (kept for older callers)."""
+    return [{"day": b["bucket"], "total": b["total"]} for b in get_revenue_series(granularity="day", periods=days)]
 
 # --- V3: Funnel & Analytics ---
+def _q_track_event(db, user_id: int, event_type: str, bot_id: str = None):
+    return db.table("funnel_events").insert({
+        "user_id": user_id,
+        "event_type": event_type,
+        "bot_id": bot_id
+    })
+
 def track_event(user_id: int, event_type: str, bot_id: str = None):
     supabase = get_supabase()
     if not supabase: return
     try:
-        supabase.table("funnel_events").insert({
-            "user_id": user_id,
-            "event_type": event_type,
-            "bot_id": bot_id
-        }).execute()
+        _q_track_event(supabase, user_id, event_type, bot_id).execute()
     except Exception as e:
         logger.error(f"Error tracking event: {e}")
 
-def get_funnel_stats():
+FUNNEL_STAGES = ['start', 'view_plans', 'checkout', 'payment_success']
+
+FUNNEL_SCAN_PAGE = 1000  # max-rows padrão do PostgREST
+
+def _funnel_query(supabase, columns: str, stage: str, start: Optional[datetime], end: Optional[datetime], bot_id: Optional[str], count: Optional[str] = None):
+    query = supabase.table("funnel_events").select(columns, count=count).eq("event_type", stage)
+    if start:
+        query = query.gte("created_at", start.isoformat())
+    if end:
+        query = query.lt("created_at", end.isoformat())
+    if bot_id:
+        query = query.eq("bot_id", bot_id)
+    return query
+
+def _count_funnel_users(supabase, stage: str, start: Optional[datetime], end: Optional[datetime], bot_id: Optional[str]) -> int:
+    # Sem a RPC: percorre os user_id do estágio em ordem, por keyset (user_id >
+    # último da página). Um select único seria cortado no max-rows do PostgREST
+    # e o painel mostraria um número errado sem aviso.
+    users, after = 0, None
+    while True:
+        query = _funnel_query(supabase, "user_id", stage, start, end, bot_id).order("user_id").limit(FUNNEL_SCAN_PAGE)
+        if after is not None:
+            query = query.gt("user_id", after)
+        rows = query.execute().data or []
+        if not rows:
+            return users
+        # Páginas não se sobrepõem: as repetições do último user_id ficam para trás
+        users += len({r['user_id'] for r in rows})
+        after = rows[-1]['user_id']
+
+def get_funnel_stats(start: Optional[datetime] = None, end: Optional[datetime] = None, bot_id: str = None, unique: bool = False) -> Dict[str, int]:
+    """
+    Counts per funnel stage inside [start, end), optionally for one bot.
+    unique=True counts distinct users per stage instead of raw events.
+    """
+    stats = {stage: 0 for stage in FUNNEL_STAGES}
+    rows = _call_rpc("funnel_stats", {
+        "p_stages": FUNNEL_STAGES,
+        "p_start": start.isoformat() if start else None,
+        "p_end": end.isoformat() if end else None,
+        "p_bot_id": bot_id
+    })
+    if rows is not None:
+        for row in rows:
+            if row['event_type'] in stats:
+                stats[row['event_type']] = (row['users'] if unique else row['events']) or 0
+        return stats
+
     supabase = get_supabase()
-    stages = ['start', 'view_plans', 'checkout', 'payment_success']
-    stats = {stage: 0 for stage in stages}
     if not supabase: return stats
-    
     try:
-        for stage in stages:
-            response = supabase.table("funnel_events").select("user_id", count="exact").eq("event_type", stage).execute()
-            stats[stage] = response.count or 0
+        for stage in FUNNEL_STAGES:
+            if unique:
+                stats[stage] = _count_funnel_users(supabase, stage, start, end, bot_id)
+                continue
+            query = _funnel_query(supabase, "user_id", stage, start, end, bot_id, count="exact")
+            stats[stage] = query.limit(1).execute().count or 0
         return stats
     except Exception as e:
         logger.error(f"Error fetching funnel stats: {e}")
@@ -266,6 +676,19 @@ def get_bot_content(key: str, default: str = "") -> str:
         logger.error(f"Error getting bot content {key}: {e}")
         return default
 
+def get_content_snapshot() -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """Loads bot_content (with its product links) and products in two round trips."""
+    supabase = get_supabase()
+    if not supabase: return None
+    try:
+        content = load_related("bot_content", "content_product_links", "content_key", parent_key="key", child_columns="product_id")
+        links = [{"content_key": item['key'], "product_id": link['product_id']} for item in content for link in item.pop("content_product_links")]
+        products = supabase.table("products").select("*").execute().data or []
+        return {"content": content, "links": links, "products": products}
+    except Exception as e:
+        logger.error(f"Error loading content snapshot: {e}")
+        return None
+
 def update_bot_content(key: str, value: str):
     supabase = get_supabase()
     if not supabase: return
@@ -275,15 +698,9 @@ def update_bot_content(key: str, value: str):
         logger.error(f"Error updating bot content {key}: {e}")
 
 def get_all_content():
-    supabase = get_supabase()
-    response = supabase.table("bot_content").select("*").execute()
-    
-    content_list = []
-    for item in response.data:
-        key = item['key']
-        links = supabase.table("content_product_links").select("product_id").eq("content_key", key).execute()
-        item['products'] = [r['product_id'] for r in links.data]
-        content_list.append(item)
+    content_list = load_related("bot_content", "content_product_links", "content_key", parent_key="key", child_columns="product_id")
+    for item in content_list:
+        item['products'] = [r['product_id'] for r in item.pop("content_product_links")]
     return content_list
 
 def get_products_for_content(content_key: str):
@@ -338,49 +755,110 @@ def update_automation_rule(rule_id: int, delay: int, message: str, active: int):
         "active": active
     }).eq("id", rule_id).execute()
 
+AUTOMATION_WINDOW_MINUTES = 15
+
+def _pg_ts(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
 def get_pending_automations():
     """Retorna Pix pendentes que precisam de automação (Postgres version)"""
-    # Note: Complex cross-join logic is better handled via a RPC function in Supabase if needed,
-    # but let's implement a core version here using filters.
     supabase = get_supabase()
-    
-    rules = get_automation_rules()
-    pending = []
-    
+    if not supabase: return []
+
+    rules = [r for r in get_automation_rules() if r['active']]
+    if not rules: return []
+
+    # Uma única consulta: só transações cujo created_at cai na janela
+    # [delay, delay+15) de alguma regra (usa o índice status, created_at).
+    now = datetime.now(timezone.utc)
+    windows = []
     for rule in rules:
-        if not rule['active']: continue
-        
-        # We need to filter transactions by date range. 
-        # created_at <= now - delay and created_at > now - (delay + 15)
-        # For simplicity in API, we'll fetch and filter if not too many, 
-        # or use specialized where clause.
-        response = supabase.table("transactions").select("*, users!inner(username, full_name)").eq("status", "pending").execute()
-        
-        for t in response.data:
-            created = datetime.fromisoformat(t['created_at'].replace('Z', '+00:00'))
-            diff = (datetime.now(timezone.utc) - created).total_seconds() / 60
-            
-            if rule['delay_minutes'] <= diff < (rule['delay_minutes'] + 15):
-                t['message'] = rule['message']
-                user_info = t.pop('users', {})
-                t['username'] = user_info.get('username')
-                t['full_name'] = user_info.get('full_name')
-                pending.append(t)
-                
+        newest = now - timedelta(minutes=rule['delay_minutes'])
+        oldest = now - timedelta(minutes=rule['delay_minutes'] + AUTOMATION_WINDOW_MINUTES)
+        windows.append((rule, oldest, newest))
+    window_filter = ",".join(f"and(created_at.gt.{_pg_ts(oldest)},created_at.lte.{_pg_ts(newest)})" for _, oldest, newest in windows)
+
+    try:
+        response = supabase.table("transactions").select("*, users!inner(username, full_name)").eq("status", "pending").or_(window_filter).execute()
+    except Exception as e:
+        logger.error(f"Error fetching pending automations: {e}")
+        return []
+
+    pending = []
+    for t in response.data or []:
+        created = _parse_ts(t['created_at'])
+        user_info = t.pop('users', {}) or {}
+        for rule, oldest, newest in windows:
+            if oldest < created <= newest:
+                item = dict(t)
+                item['message'] = rule['message']
+                item['username'] = user_info.get('username')
+                item['full_name'] = user_info.get('full_name')
+                pending.append(item)
     return pending
 
+def _q_get_transaction_user(db, identifier: str):
+    return db.table("transactions").select("user_id").eq("id", identifier).maybe_single()
+
 def get_transaction_user(identifier: str) -> Optional[int]:
     supabase = get_supabase()
-    response = supabase.table("transactions").select("user_id").eq("id", identifier).maybe_single().execute()
-    return response.data['user_id'] if response.data else None
+    if not supabase: return None
+    response = _q_get_transaction_user(supabase, identifier).execute()
+    return response.data['user_id'] if response and response.data else None
+
+def _q_get_transaction(db, identifier: str):
+    return db.table("transactions").select("*").eq("id", identifier).maybe_single()
 
 def get_transaction(identifier: str) -> Optional[Dict[str, Any]]:
     supabase = get_supabase()
-    response = supabase.table("transactions").select("*").eq("id", identifier).maybe_single().execute()
-    return response.data if response.data else None
+    if not supabase: return None
+    response = _q_get_transaction(supabase, identifier).execute()
+    return response.data if response and response.data else None
 
 # --- Analytics v3: UTM & CRM ---
+UTM_DIMENSIONS = ["utm_source", "utm_medium", "utm_campaign"]
+DIRECT_TRAFFIC_LABEL = "Direto / Orgânico"
+
+def get_revenue_by_utm(group_by: str = "utm_source", start_day: Optional[str] = None, end_day: Optional[str] = None, bot_id: str = None, filters: Optional[Dict[str, str]] = None) -> Optional[List[Dict[str, Any]]]:
+    """
+    Drill-down over the utm_revenue_daily rollup (migrations/0005).
+    group_by is one of UTM_DIMENSIONS; filters pins the parent levels, e.g.
+    {"utm_source": "tiktok"} to break that source down by medium.
+    Days are inclusive YYYY-MM-DD strings. Returns None if the rollup is unavailable.
+    """
+    if group_by not in UTM_DIMENSIONS:
+        raise ValueError(f"Invalid UTM dimension: {group_by}")
+    supabase = get_supabase()
+    if not supabase: return None
+    try:
+        query = supabase.table("utm_revenue_daily").select(f"{group_by}, sales, revenue")
+        if start_day:
+            query = query.gte("day", start_day)
+        if end_day:
+            query = query.lte("day", end_day)
+        if bot_id:
+            query = query.eq("bot_id", bot_id)
+        for dim, value in (filters or {}).items():
+            if dim in UTM_DIMENSIONS and value is not None:
+                query = query.eq(dim, "" if value == DIRECT_TRAFFIC_LABEL else value)
+        rows = query.execute().data or []
+    except Exception as e:
+        logger.error(f"Error reading UTM rollup: {e}")
+        return None
+
+    groups: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        label = row[group_by] or DIRECT_TRAFFIC_LABEL
+        g = groups.setdefault(label, {"key": label, "sales": 0, "total": 0.0})
+        g["sales"] += row['sales'] or 0
+        g["total"] += float(row['revenue'] or 0)
+    return sorted((g for g in groups.values() if g["sales"] or g["total"]), key=lambda g: g["total"], reverse=True)
+
 def get_revenue_by_source():
+    rollup = get_revenue_by_utm("utm_source")
+    if rollup is not None:
+        return [{"source": g["key"], "total": g["total"]} for g in rollup]
+
     supabase = get_supabase()
     if not supabase: return []
     try:
@@ -389,7 +867,7 @@ def get_revenue_by_source():
         
         sources = {}
         for row in response.data:
-            src = row['users'].get('utm_source') or "Direto / Orgânico"
+            src = row['users'].get('utm_source') or DIRECT_TRAFFIC_LABEL
             sources[src] = sources.get(src, 0.0) + row['amount']
             
         return [{"source": s, "total": v} for s, v in sorted(sources.items(), key=lambda x: x[1], reverse=True)]
@@ -428,14 +906,15 @@ def get_all_gateways():
         logger.error(f"Error fetching gateways: {e}")
         return []
 
+def _q_get_active_gateway(db):
+    return db.table("gateways").select("*").eq("is_active", True).limit(1)
+
 def get_active_gateway():
     supabase = get_supabase()
     if not supabase: return None
     try:
-        response = supabase.table("gateways").select("*").eq("is_active", True).limit(1).execute()
-        if response and response.data and len(response.data) > 0:
-            return response.data[0]
-        return None
+        response = _q_get_active_gateway(supabase).execute()
+        return response.data[0] if response and response.data else None
     except Exception as e:
         logger.error(f"Error fetching active gateway: {e}")
         return None
@@ -494,11 +973,15 @@ def delete_gateway(gw_id: str):
     except Exception as e:
         logger.error(f"Error deleting gateway: {e}")
         return False
+
+def _q_get_all_managed_bots(db):
+    return db.table("managed_bots").select("*").order("created_at")
+
 def get_all_managed_bots():
     supabase = get_supabase()
     if not supabase: return []
     try:
-        response = supabase.table("managed_bots").select("*").order("created_at").execute()
+        response = _q_get_all_managed_bots(supabase).execute()
         return response.data or []
     except Exception as e:
         logger.error(f"Error fetching managed bots: {e}")
@@ -539,70 +1022,176 @@ def delete_managed_bot(bot_id: str):
         logger.error(f"Error deleting managed bot {bot_id}: {e}")
         return False
 
+def _q_get_ai_history(db, bot_id: str, user_id: int, limit: int = 10):
+    return db.table("ai_chat_history").select("*").eq("bot_id", bot_id).eq("user_id", user_id).order("created_at", desc=True).limit(limit)
+
 def get_ai_history(bot_id: str, user_id: int, limit: int = 10):
     supabase = get_supabase()
     if not supabase: return []
     try:
-        response = supabase.table("ai_chat_history").select("*").eq("bot_id", bot_id).eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
+        response = _q_get_ai_history(supabase, bot_id, user_id, limit).execute()
         # Invert to chronological order
         return sorted(response.data, key=lambda x: x['created_at']) if response.data else []
     except Exception as e:
         logger.error(f"Error fetching AI history: {e}")
         return []
 
+def _q_add_ai_history(db, bot_id: str, user_id: int, role: str, content: str):
+    return db.table("ai_chat_history").insert({
+        "bot_id": bot_id,
+        "user_id": user_id,
+        "role": role,
+        "content": content
+    })
+
 def add_ai_history(bot_id: str, user_id: int, role: str, content: str):
     supabase = get_supabase()
     if not supabase: return
     try:
-        supabase.table("ai_chat_history").insert({
-            "bot_id": bot_id,
-            "user_id": user_id,
-            "role": role,
-            "content": content
-        }).execute()
+        _q_add_ai_history(supabase, bot_id, user_id, role, content).execute()
     except Exception as e:
         logger.error(f"Error adding AI history: {e}")
 
 def update_bot_ai(bot_id: str, ai_enabled: bool, system_prompt: str):
     return update_managed_bot(bot_id, {"ai_enabled": ai_enabled, "system_prompt": system_prompt})
 
+# Atraso de cada estágio da recuperação, contado a partir do abandono.
+# next_due_at guarda quando o próximo estágio vence; o worker só lê as linhas vencidas.
+RECOVERY_STAGE_DELAYS = {1: 600, 2: 3600, 3: 86400, 4: 259200}
+RECOVERY_DUE_BATCH = 100
+# Falha passageira no envio: o estágio é tentado de novo com espera crescente
+# (next_due_at empurrado para frente, a linha sai do topo da fila) e, depois de
+# RECOVERY_MAX_ATTEMPTS tentativas seguidas, o checkout vira failed
+RECOVERY_RETRY_BASE = int(os.getenv("RECOVERY_RETRY_BASE", "60"))
+RECOVERY_RETRY_MAX = int(os.getenv("RECOVERY_RETRY_MAX", "3600"))
+RECOVERY_MAX_ATTEMPTS = int(os.getenv("RECOVERY_MAX_ATTEMPTS", "5"))
+
+def recovery_next_due(stage: int, now: Optional[datetime] = None) -> Optional[datetime]:
+    """When the stage after `stage` is due, given `stage` was reached now. None after the last one."""
+    next_stage = stage + 1
+    if next_stage not in RECOVERY_STAGE_DELAYS:
+        return None
+    gap = RECOVERY_STAGE_DELAYS[next_stage] - RECOVERY_STAGE_DELAYS.get(stage, 0)
+    return (now or datetime.now(timezone.utc)) + timedelta(seconds=gap)
+
+def recovery_retry_due(attempts: int, now: Optional[datetime] = None) -> datetime:
+    """When a stage that failed `attempts` times in a row is tried again (exponential backoff)."""
+    delay = min(RECOVERY_RETRY_MAX, RECOVERY_RETRY_BASE * 2 ** max(0, attempts - 1))
+    return (now or datetime.now(timezone.utc)) + timedelta(seconds=delay)
+
+def _abandoned_update_data(status: str = None, last_stage: int = None, retry_at: datetime = None, attempts: int = None) -> Dict[str, Any]:
+    now = datetime.now(timezone.utc)
+    data = {"updated_at": now.isoformat()}
+    if attempts is not None:
+        data["attempts"] = attempts
+    if retry_at and not status:
+        data["next_due_at"] = retry_at.isoformat()
+    if status:
+        data["status"] = status
+        data["next_due_at"] = None
+    if last_stage is not None:
+        data["last_stage"] = last_stage
+        if not status:
+            due = recovery_next_due(last_stage, now)
+            data["next_due_at"] = due.isoformat() if due else None
+    return data
+
+def _q_log_abandoned_checkout(db, user_id: int, product_id: str, bot_id: str, metadata: dict = None):
+    now = datetime.now(timezone.utc)
+    return db.table("abandoned_checkouts").insert({
+        "user_id": user_id,
+        "product_id": product_id,
+        "bot_id": bot_id,
+        "metadata": metadata,
+        "status": "pending",
+        "last_stage": 0,
+        "created_at": now.isoformat(),
+        "next_due_at": recovery_next_due(0, now).isoformat()
+    })
+
 def log_abandoned_checkout(user_id: int, product_id: str, bot_id: str, metadata: dict = None):
     supabase = get_supabase()
     if not supabase: return
     try:
-        supabase.table("abandoned_checkouts").insert({
-            "user_id": user_id,
-            "product_id": product_id,
-            "bot_id": bot_id,
-            "metadata": metadata,
-            "status": "pending",
-            "last_stage": 0
-        }).execute()
+        _q_log_abandoned_checkout(supabase, user_id, product_id, bot_id, metadata).execute()
     except Exception as e:
         logger.error(f"Error logging abandoned checkout: {e}")
 
+def _q_update_abandoned_checkout(db, user_id: int, bot_id: str, status: str = None, last_stage: int = None):
+    data = _abandoned_update_data(status, last_stage)
+    return db.table("abandoned_checkouts").update(data).eq("user_id", user_id).eq("bot_id", bot_id).eq("status", "pending")
+
 def update_abandoned_checkout(user_id: int, bot_id: str, status: str = None, last_stage: int = None):
     supabase = get_supabase()
     if not supabase: return
     try:
-        data = {"updated_at": datetime.now(timezone.utc).isoformat()}
-        if status: data["status"] = status
-        if last_stage is not None: data["last_stage"] = last_stage
-        
-        supabase.table("abandoned_checkouts").update(data).eq("user_id", user_id).eq("bot_id", bot_id).eq("status", "pending").execute()
+        _q_update_abandoned_checkout(supabase, user_id, bot_id, status, last_stage).execute()
     except Exception as e:
         logger.error(f"Error updating abandoned checkout: {e}")
 
+def _q_get_pending_abandoned(db, bot_id: str):
+    return db.table("abandoned_checkouts").select("*").eq("bot_id", bot_id).eq("status", "pending")
+
 def get_pending_abandoned(bot_id: str):
     supabase = get_supabase()
     if not supabase: return []
     try:
-        res = supabase.table("abandoned_checkouts").select("*").eq("bot_id", bot_id).eq("status", "pending").execute()
+        res = _q_get_pending_abandoned(supabase, bot_id).execute()
         return res.data if res.data else []
     except Exception as e:
         logger.error(f"Error fetching pending abandoned: {e}")
         return []
 
+def _q_get_due_abandoned(db, bot_ids: List[str], now: Optional[datetime] = None, limit: int = RECOVERY_DUE_BATCH):
+    due = _pg_ts(now or datetime.now(timezone.utc))
+    return db.table("abandoned_checkouts").select("*").in_("bot_id", list(bot_ids)).eq("status", "pending").lte("next_due_at", due).order("next_due_at").limit(limit)
+
+def get_due_abandoned(bot_ids: List[str], now: Optional[datetime] = None, limit: int = RECOVERY_DUE_BATCH):
+    """Pending checkouts of bot_ids whose next stage is due, oldest due first (migrations/0007)."""
+    supabase = get_supabase()
+    if not supabase or not bot_ids: return []
+    try:
+        res = _q_get_due_abandoned(supabase, bot_ids, now, limit).execute()
+        return res.data if res.data else []
+    except Exception as e:
+        logger.error(f"Error fetching due abandoned: {e}")
+        return []
+
+def _q_count_due_abandoned(db, bot_ids: List[str], now: Optional[datetime] = None):
+    due = _pg_ts(now or datetime.now(timezone.utc))
+    return db.table("abandoned_checkouts").select("id", count="exact").in_("bot_id", list(bot_ids)).eq("status", "pending").lte("next_due_at", due).limit(1)
+
+def count_due_abandoned(bot_ids: List[str], now: Optional[datetime] = None) -> int:
+    """Recovery backlog: how many pending checkouts of bot_ids are already due."""
+    supabase = get_supabase()
+    if not supabase or not bot_ids: return 0
+    try:
+        res = _q_count_due_abandoned(supabase, bot_ids, now).execute()
+        return res.count or 0
+    except Exception as e:
+        logger.error(f"Error counting due abandoned: {e}")
+        return 0
+
+def _q_update_abandoned_checkouts(db, ids: List[int], status: str = None, last_stage: int = None, retry_at: datetime = None, attempts: int = None):
+    data = _abandoned_update_data(status, last_stage, retry_at, attempts)
+    return db.table("abandoned_checkouts").update(data).in_("id", list(ids)).eq("status", "pending")
+
+def update_abandoned_checkouts(ids: List[int], status: str = None, last_stage: int = None, retry_at: datetime = None, attempts: int = None):
+    """
+    Bulk update_abandoned_checkout by row id (rows advancing to the same stage share next_due_at).
+    retry_at postpones the current stage instead; attempts sets the failed-attempt counter (migrations/0011).
+    Returns False when the write failed.
+    """
+    supabase = get_supabase()
+    if not supabase: return False
+    if not ids: return True
+    try:
+        _q_update_abandoned_checkouts(supabase, ids, status, last_stage, retry_at, attempts).execute()
+        return True
+    except Exception as e:
+        logger.error(f"Error updating abandoned checkouts: {e}")
+        return False
+
 def get_abandoned_checkouts(bot_id: str = None, limit: int = 50):
     supabase = get_supabase()
     if not supabase: return []
@@ -615,3 +1204,248 @@ def get_abandoned_checkouts(bot_id: str = None, limit: int = 50):
     except Exception as e:
         logger.error(f"Error fetching abandoned checkouts: {e}")
         return []
+
+# --- Reminders ---
+# Lembretes de inatividade (reminders.py): uma linha por (bot, usuário) com o
+# último estágio enviado e quando o próximo vence. Estágios e intervalos são
+# os mesmos da recuperação (RECOVERY_STAGE_DELAYS).
+REMINDER_LOAD_BATCH = 1000
+
+def _q_save_reminder(db, bot_id: str, user_id: int, chat_id: int, stage: int, due_at: datetime):
+    return db.table("reminders").upsert({
+        "bot_id": bot_id,
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "stage": stage,
+        "due_at": due_at.isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }, on_conflict="bot_id,user_id")
+
+def save_reminder(bot_id: str, user_id: int, chat_id: int, stage: int, due_at: datetime):
+    supabase = get_supabase()
+    if not supabase: return
+    try:
+        _q_save_reminder(supabase, bot_id, user_id, chat_id, stage, due_at).execute()
+    except Exception as e:
+        logger.error(f"Error saving reminder: {e}")
+
+def _q_delete_reminder(db, bot_id: str, user_id: int):
+    return db.table("reminders").delete().eq("bot_id", bot_id).eq("user_id", user_id)
+
+def delete_reminder(bot_id: str, user_id: int):
+    supabase = get_supabase()
+    if not supabase: return
+    try:
+        _q_delete_reminder(supabase, bot_id, user_id).execute()
+    except Exception as e:
+        logger.error(f"Error deleting reminder: {e}")
+
+def _q_get_reminders(db, bot_id: str, after_user_id: int = None, limit: int = REMINDER_LOAD_BATCH):
+    query = db.table("reminders").select("user_id, chat_id, stage, due_at").eq("bot_id", bot_id).order("user_id").limit(limit)
+    if after_user_id is not None:
+        query = query.gt("user_id", after_user_id)
+    return query
+
+def get_reminders(bot_id: str, after_user_id: int = None, limit: int = REMINDER_LOAD_BATCH) -> List[Dict[str, Any]]:
+    """Pending reminders of a bot ordered by user_id; pass the last user_id to get the next batch."""
+    supabase = get_supabase()
+    if not supabase: return []
+    try:
+        res = _q_get_reminders(supabase, bot_id, after_user_id, limit).execute()
+        return res.data if res.data else []
+    except Exception as e:
+        logger.error(f"Error fetching reminders: {e}")
+        return []
+
+# --- Telegram file_id cache ---
+# file_id de cada mídia já enviada, por bot e hash do conteúdo (media_cache.py)
+def _q_get_media_file_ids(db, bot_id: str):
+    return db.table("media_file_ids").select("content_hash, media_type, file_id").eq("bot_id", bot_id)
+
+def get_media_file_ids(bot_id: str) -> List[Dict[str, Any]]:
+    supabase = get_supabase()
+    if not supabase: return []
+    try:
+        res = _q_get_media_file_ids(supabase, bot_id).execute()
+        return res.data if res.data else []
+    except Exception as e:
+        logger.error(f"Error fetching media file ids: {e}")
+        return []
+
+def _q_save_media_file_id(db, bot_id: str, content_hash: str, media_type: str, file_id: str):
+    return db.table("media_file_ids").upsert({
+        "bot_id": bot_id,
+        "content_hash": content_hash,
+        "media_type": media_type,
+        "file_id": file_id,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }, on_conflict="bot_id,content_hash")
+
+def save_media_file_id(bot_id: str, content_hash: str, media_type: str, file_id: str):
+    supabase = get_supabase()
+    if not supabase: return
+    try:
+        _q_save_media_file_id(supabase, bot_id, content_hash, media_type, file_id).execute()
+    except Exception as e:
+        logger.error(f"Error saving media file id: {e}")
+
+def _q_delete_media_file_id(db, bot_id: str, content_hash: str):
+    return db.table("media_file_ids").delete().eq("bot_id", bot_id).eq("content_hash", content_hash)
+
+def delete_media_file_id(bot_id: str, content_hash: str):
+    supabase = get_supabase()
+    if not supabase: return
+    try:
+        _q_delete_media_file_id(supabase, bot_id, content_hash).execute()
+    except Exception as e:
+        logger.error(f"Error deleting media file id: {e}")
+
+# --- Keyset Pagination ---
+# Listagens por (created_at, id) decrescente. O cursor guarda a última linha
+# da página e a próxima consulta começa dali, então a página N custa o mesmo
+# que a primeira (índices em migrations/0006).
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT = 500
+PAGE_SELECTS = {
+    "transactions": "*, users(username, full_name)",
+    "users": "*",
+    "abandoned_checkouts": "*, managed_bots(name)",
+    "funnel_events": "*",
+}
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    raw = json.dumps([row.get("created_at"), row.get("id")], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor. Raises ValueError on a malformed cursor."""
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(created_at, str) or row_id is None:
+        raise ValueError("invalid cursor")
+    return created_at, row_id
+
+def page_limit(limit: Optional[int]) -> int:
+    return max(1, min(int(limit or PAGE_DEFAULT_LIMIT), PAGE_MAX_LIMIT))
+
+def page_result(rows: List[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+    """rows holds up to limit + 1 items; the extra one only signals a next page."""
+    items = rows[:limit]
+    next_cursor = encode_cursor(items[-1]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+def _keyset_page(table: str, cursor: Optional[str] = None, limit: int = PAGE_DEFAULT_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Dict[str, Any]:
+    """
+    One page of table, newest first, optionally restricted to
+    since <= created_at < until. Raises on bad cursors and database errors.
+    """
+    limit = page_limit(limit)
+    supabase = get_supabase()
+    if not supabase: return {"items": [], "next_cursor": None}
+    query = supabase.table(table).select(PAGE_SELECTS[table]).order("created_at", desc=True).order("id", desc=True).limit(limit + 1)
+    if bot_id:
+        query = query.eq("bot_id", bot_id)
+    if since:
+        query = query.gte("created_at", _pg_ts(since))
+    if until:
+        query = query.lt("created_at", _pg_ts(until))
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        ts, rid = json.dumps(created_at), json.dumps(str(row_id))
+        query = query.or_(f"created_at.lt.{ts},and(created_at.eq.{ts},id.lt.{rid})")
+    rows = query.execute().data or []
+    if table == "transactions":
+        rows = [_flatten_user(row) for row in rows]
+    return page_result(rows, limit)
+
+def _safe_page(table: str, cursor: Optional[str], limit: int, bot_id: str) -> Dict[str, Any]:
+    try:
+        return _keyset_page(table, cursor, limit, bot_id)
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching {table} page: {e}")
+        return {"items": [], "next_cursor": None}
+
+def get_transactions_page(cursor: Optional[str] = None, limit: int = PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return _safe_page("transactions", cursor, limit, bot_id)
+
+def get_users_page(cursor: Optional[str] = None, limit: int = PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return _safe_page("users", cursor, limit, bot_id)
+
+def get_abandoned_checkouts_page(cursor: Optional[str] = None, limit: int = PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return _safe_page("abandoned_checkouts", cursor, limit, bot_id)
+
+def _iter_keyset(table: str, batch_size: int, bot_id: str, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    # Erros sobem para o job em vez de encerrar a varredura em silêncio
+    cursor = None
+    while True:
+        page = _keyset_page(table, cursor, batch_size, bot_id, since, until)
+        yield from page["items"]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return
+
+def iter_transactions(batch_size: int = PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    """Every transaction, newest first, one page in memory at a time."""
+    return _iter_keyset("transactions", batch_size, bot_id, since, until)
+
+def iter_users(batch_size: int = PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    """Every user, newest first, one page in memory at a time."""
+    return _iter_keyset("users", batch_size, bot_id, since, until)
+
+def iter_abandoned_checkouts(batch_size: int = PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    """Every abandoned checkout, newest first, one page in memory at a time."""
+    return _iter_keyset("abandoned_checkouts", batch_size, bot_id, since, until)
+
+def iter_funnel_events(batch_size: int = PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    """Every funnel event, newest first, one page in memory at a time."""
+    return _iter_keyset("funnel_events", batch_size, bot_id, since, until)
+
+# --- Storage Backend Selection ---
+# Funções que formam a API de armazenamento. DATABASE_BACKEND=sqlite troca
+# todas pela engine local (database_sqlite.py); o resto do código continua
+# chamando database.* sem saber qual backend está ativo.
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", "supabase").lower()
+
+BACKEND_API = [
+    "init_db", "get_pool_stats", "close_supabase", "insert_rows", "load_related",
+    "log_user", "get_user", "log_transaction", "update_transaction_status",
+    "get_transaction_user", "get_transaction", "get_metrics", "get_all_transactions",
+    "get_all_users", "get_user_events", "get_user_transactions",
+    "get_active_products", "get_all_products_raw", "update_product",
+    "_fetch_settings", "_fetch_setting", "_store_setting",
+    "get_revenue_series", "track_event", "get_funnel_stats",
+    "get_revenue_by_utm", "get_revenue_by_source",
+    "get_bot_content", "get_content_snapshot", "update_bot_content", "get_all_content",
+    "get_products_for_content", "get_linked_content_for_product", "get_content_for_product",
+    "update_bot_content_advanced", "delete_bot_content",
+    "get_automation_rules", "update_automation_rule", "get_pending_automations",
+    "get_all_gateways", "get_active_gateway", "add_gateway", "update_gateway",
+    "activate_gateway", "delete_gateway",
+    "get_all_managed_bots", "add_managed_bot", "update_managed_bot", "delete_managed_bot",
+    "get_ai_history", "add_ai_history",
+    "log_abandoned_checkout", "update_abandoned_checkout", "get_pending_abandoned",
+    "get_due_abandoned", "count_due_abandoned", "update_abandoned_checkouts", "get_abandoned_checkouts",
+    "save_reminder", "delete_reminder", "get_reminders",
+    "get_media_file_ids", "save_media_file_id", "delete_media_file_id",
+    "get_transactions_page", "get_users_page", "get_abandoned_checkouts_page",
+    "iter_transactions", "iter_users", "iter_abandoned_checkouts", "iter_funnel_events",
+]
+
+if DATABASE_BACKEND == "sqlite":
+    import database_sqlite as _backend
+    for _name in BACKEND_API:
+        globals()[_name] = getattr(_backend, _name)
+    logger.info("Storage backend: SQLite")
+elif DATABASE_BACKEND != "supabase":
+    logger.error(f"Unknown DATABASE_BACKEND '{DATABASE_BACKEND}', using supabase")
+
+# Latência/linhas/bytes por função (db_metrics); helpers puros ficam de fora
+INSTRUMENTED_API = [name for name in BACKEND_API if name not in ("get_pool_stats", "close_supabase")] + [
+    "confirm_transaction", "get_revenue_stats", "update_bot_ai",
+    "get_setting", "set_setting", "preload_settings",
+]
+db_metrics.instrument(globals(), "database", INSTRUMENTED_API)
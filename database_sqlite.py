@@ -0,0 +1,850 @@
+import os
+import json
+import uuid
+import sqlite3
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
+from typing import Dict, Any, List, Optional, Iterator
+import database
+import db_metrics
+
+logger = logging.getLogger(__name__)
+
+# Engine local (DATABASE_BACKEND=sqlite) com as mesmas funções do database.py.
+# Um arquivo em modo WAL; init_db() cria schema e índices, sem projeto na nuvem.
+SQLITE_PATH = os.getenv("SQLITE_PATH", "kamybot.db")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    full_name TEXT,
+    created_at TEXT,
+    bot_id TEXT,
+    utm_source TEXT,
+    utm_medium TEXT,
+    utm_campaign TEXT,
+    utm_content TEXT,
+    utm_term TEXT,
+    ttclid TEXT
+);
+CREATE INDEX IF NOT EXISTS users_created_at_idx ON users (created_at, id);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    product_id TEXT,
+    amount REAL,
+    status TEXT,
+    payment_method TEXT,
+    client_email TEXT,
+    created_at TEXT,
+    confirmed_at TEXT,
+    metadata TEXT,
+    bot_id TEXT,
+    oasyfy_id TEXT
+);
+CREATE INDEX IF NOT EXISTS transactions_status_created_at_idx ON transactions (status, created_at);
+CREATE INDEX IF NOT EXISTS transactions_created_at_idx ON transactions (created_at, id);
+CREATE INDEX IF NOT EXISTS transactions_user_idx ON transactions (user_id);
+CREATE INDEX IF NOT EXISTS transactions_oasyfy_idx ON transactions (oasyfy_id);
+
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    price REAL,
+    description TEXT,
+    active INTEGER DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS funnel_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    event_type TEXT,
+    bot_id TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS funnel_events_created_at_idx ON funnel_events (created_at, event_type, user_id);
+CREATE INDEX IF NOT EXISTS funnel_events_bot_created_at_idx ON funnel_events (bot_id, created_at);
+CREATE INDEX IF NOT EXISTS funnel_events_user_idx ON funnel_events (user_id);
+
+CREATE TABLE IF NOT EXISTS bot_content (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    description TEXT,
+    button_text TEXT,
+    button_url TEXT
+);
+
+CREATE TABLE IF NOT EXISTS content_product_links (
+    content_key TEXT REFERENCES bot_content(key) ON DELETE CASCADE,
+    product_id TEXT,
+    PRIMARY KEY (content_key, product_id)
+);
+CREATE INDEX IF NOT EXISTS content_product_links_product_idx ON content_product_links (product_id);
+
+CREATE TABLE IF NOT EXISTS automation_rules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    delay_minutes INTEGER,
+    message TEXT,
+    active INTEGER DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS gateways (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    provider TEXT,
+    is_active INTEGER DEFAULT 0,
+    credentials TEXT,
+    created_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS managed_bots (
+    id TEXT PRIMARY KEY,
+    token TEXT,
+    name TEXT,
+    username TEXT,
+    is_active INTEGER DEFAULT 1,
+    ai_enabled INTEGER DEFAULT 0,
+    system_prompt TEXT,
+    created_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ai_chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bot_id TEXT,
+    user_id INTEGER,
+    role TEXT,
+    content TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS ai_chat_history_lookup_idx ON ai_chat_history (bot_id, user_id, created_at);
+
+CREATE TABLE IF NOT EXISTS abandoned_checkouts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    product_id TEXT,
+    bot_id TEXT,
+    metadata TEXT,
+    status TEXT,
+    last_stage INTEGER DEFAULT 0,
+    created_at TEXT,
+    updated_at TEXT,
+    next_due_at TEXT,
+    attempts INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS abandoned_checkouts_bot_status_idx ON abandoned_checkouts (bot_id, status);
+CREATE INDEX IF NOT EXISTS abandoned_checkouts_created_at_idx ON abandoned_checkouts (created_at, id);
+
+CREATE TABLE IF NOT EXISTS reminders (
+    bot_id TEXT,
+    user_id INTEGER,
+    chat_id INTEGER,
+    stage INTEGER DEFAULT 0,
+    due_at TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (bot_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS media_file_ids (
+    bot_id TEXT,
+    content_hash TEXT,
+    media_type TEXT,
+    file_id TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (bot_id, content_hash)
+);
+"""
+
+# Colunas guardadas como JSON em TEXT e colunas booleanas guardadas como INTEGER
+JSON_COLUMNS = {"metadata", "credentials"}
+BOOL_COLUMNS = {"managed_bots": {"is_active", "ai_enabled"}, "gateways": {"is_active"}}
+
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+_schema_ready = False
+_schema_lock = threading.Lock()
+_stats = {"queries": 0, "errors": 0}
+_generation = 0
+
+def _connect() -> sqlite3.Connection:
+    """One connection per thread; WAL lets readers run while another thread writes."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "generation", None) == _generation:
+        return conn
+    conn = sqlite3.connect(SQLITE_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    _local.conn = conn
+    _local.generation = _generation
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+def _db() -> sqlite3.Connection:
+    if not _schema_ready:
+        init_db()
+    return _connect()
+
+def _decode(row: sqlite3.Row, table: str = None) -> Dict[str, Any]:
+    data = dict(row)
+    for col in JSON_COLUMNS & data.keys():
+        if isinstance(data[col], str):
+            try:
+                data[col] = json.loads(data[col])
+            except ValueError:
+                pass
+    for col in BOOL_COLUMNS.get(table, ()):
+        if col in data and data[col] is not None:
+            data[col] = bool(data[col])
+    return data
+
+def _query(sql: str, params: tuple = (), table: str = None) -> List[Dict[str, Any]]:
+    return [_decode(r, table) for r in _execute(sql, params).fetchall()]
+
+def _execute(sql: str, params: tuple = ()) -> sqlite3.Cursor:
+    _stats["queries"] += 1
+    started = time.perf_counter()
+    error = False
+    try:
+        return _db().execute(sql, params)
+    except Exception:
+        _stats["errors"] += 1
+        error = True
+        raise
+    finally:
+        db_metrics.record_sql(sql, (time.perf_counter() - started) * 1000, error)
+
+@contextmanager
+def _transaction():
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+def _ts(value: Any = None) -> str:
+    """Normalizes timestamps to one fixed-width UTC format so text order = time order."""
+    if value is None:
+        dt = datetime.now(timezone.utc)
+    elif isinstance(value, datetime):
+        dt = value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    else:
+        dt = database._parse_ts(str(value))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+def init_db():
+    """Creates the schema and indexes (idempotent)."""
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn = _connect()
+        conn.executescript(SCHEMA)
+        # Bancos criados antes das colunas next_due_at e attempts
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(abandoned_checkouts)")}
+        if "next_due_at" not in columns:
+            conn.execute("ALTER TABLE abandoned_checkouts ADD COLUMN next_due_at TEXT")
+        if "attempts" not in columns:
+            conn.execute("ALTER TABLE abandoned_checkouts ADD COLUMN attempts INTEGER DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS abandoned_checkouts_due_idx ON abandoned_checkouts (bot_id, status, next_due_at)")
+        _schema_ready = True
+        logger.info(f"SQLite backend ready at {SQLITE_PATH}")
+
+def get_pool_stats() -> Dict[str, Any]:
+    with _connections_lock:
+        open_connections = len(_connections)
+    return {"backend": "sqlite", "path": SQLITE_PATH, "open_connections": open_connections, **_stats}
+
+def close_supabase():
+    """Closes every thread's connection (name kept for API compatibility)."""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _connections.clear()
+
+def insert_rows(table: str, rows: List[Dict[str, Any]]):
+    if not rows: return
+    cols = list(rows[0].keys())
+    sql = f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})"
+    values = [tuple(_ts(r[c]) if c == "created_at" and r[c] else _encode(r[c]) for c in cols) for r in rows]
+    _stats["queries"] += 1
+    with _transaction() as conn:
+        conn.executemany(sql, values)
+
+def load_related(parent_table: str, child_table: str, fk: str, parent_key: str = "id", child_columns: str = "*", parent_columns: str = "*") -> List[Dict[str, Any]]:
+    parents = _query(f"SELECT {parent_columns} FROM {parent_table}", table=parent_table)
+    children_by_key: Dict[Any, List[Dict[str, Any]]] = {}
+    select_cols = child_columns if child_columns == "*" else f"{child_columns}, {fk}"
+    for child in _query(f"SELECT {select_cols} FROM {child_table}", table=child_table):
+        children_by_key.setdefault(child.get(fk), []).append(child)
+    for row in parents:
+        row[child_table] = children_by_key.get(row.get(parent_key), [])
+    return parents
+
+# --- User & Transaction Helpers ---
+def log_user(user_id: int, username: str, full_name: str, tracking_data: Optional[Dict[str, Any]] = None, bot_id: str = None):
+    data = {"id": user_id, "username": username, "full_name": full_name, "created_at": _ts(), "bot_id": bot_id}
+    if tracking_data:
+        for key in ["utm_source", "utm_medium", "utm_campaign", "utm_content", "utm_term", "ttclid"]:
+            if key in tracking_data:
+                data[key] = tracking_data[key]
+    cols = list(data.keys())
+    updates = ", ".join(f"{c} = excluded.{c}" for c in cols if c != "id")
+    try:
+        _execute(f"INSERT INTO users ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)}) ON CONFLICT(id) DO UPDATE SET {updates}", tuple(data.values()))
+    except Exception as e:
+        logger.error(f"Error logging user {user_id}: {e}")
+
+def get_user(user_id: int) -> Optional[Dict[str, Any]]:
+    rows = _query("SELECT * FROM users WHERE id = ?", (user_id,))
+    return rows[0] if rows else None
+
+def log_transaction(identifier: str, user_id: int, product_id: str, amount: float, status: str = 'pending', payment_method: str = 'PIX', client_email: str = None, metadata: Optional[Dict[str, Any]] = None, created_at: str = None, bot_id: str = None):
+    _execute(
+        "INSERT INTO transactions (id, user_id, product_id, amount, status, payment_method, client_email, created_at, metadata, bot_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (identifier, user_id, product_id, amount, status, payment_method, client_email, _ts(created_at), json.dumps(metadata or {}), bot_id)
+    )
+
+def update_transaction_status(identifier: str, status: str, oasyfy_id: str = None):
+    sets, params = ["status = ?"], [status]
+    if status == 'confirmed':
+        sets.append("confirmed_at = ?"); params.append(_ts())
+    if oasyfy_id:
+        sets.append("oasyfy_id = ?"); params.append(oasyfy_id)
+        _execute(f"UPDATE transactions SET {', '.join(sets)} WHERE id = ? OR oasyfy_id = ?", tuple(params + [identifier, oasyfy_id]))
+    else:
+        _execute(f"UPDATE transactions SET {', '.join(sets)} WHERE id = ?", tuple(params + [identifier]))
+
+def get_transaction_user(identifier: str) -> Optional[int]:
+    rows = _query("SELECT user_id FROM transactions WHERE id = ?", (identifier,))
+    return rows[0]['user_id'] if rows else None
+
+def get_transaction(identifier: str) -> Optional[Dict[str, Any]]:
+    rows = _query("SELECT * FROM transactions WHERE id = ?", (identifier,))
+    return rows[0] if rows else None
+
+# --- Data Fetching for Metrics/Admin ---
+def get_metrics(estimated: bool = None):
+    try:
+        row = _query("""
+            SELECT
+                (SELECT COUNT(*) FROM users) AS total_users,
+                COUNT(*) FILTER (WHERE status = 'confirmed') AS total_sales,
+                COALESCE(SUM(amount) FILTER (WHERE status = 'confirmed'), 0) AS total_revenue,
+                COUNT(*) FILTER (WHERE status = 'pending') AS pending_pix
+            FROM transactions WHERE status IN ('confirmed', 'pending')
+        """)[0]
+        return {"total_users": row['total_users'], "total_sales": row['total_sales'], "total_revenue": float(row['total_revenue']), "pending_pix": row['pending_pix']}
+    except Exception as e:
+        logger.error(f"Error fetching metrics: {e}")
+        return {"total_users": 0, "total_sales": 0, "total_revenue": 0.0, "pending_pix": 0}
+
+def get_all_transactions(limit: int = 100):
+    try:
+        return _query("""
+            SELECT t.*, u.username AS username, u.full_name AS full_name
+            FROM transactions t LEFT JOIN users u ON u.id = t.user_id
+            ORDER BY t.created_at DESC LIMIT ?
+        """, (limit,))
+    except Exception as e:
+        logger.error(f"Error fetching transactions: {e}")
+        return []
+
+def get_all_users(limit: int = 1000):
+    try:
+        return _query("SELECT * FROM users ORDER BY created_at DESC LIMIT ?", (limit,))
+    except Exception as e:
+        logger.error(f"Error fetching users: {e}")
+        return []
+
+def get_user_events(user_id: int):
+    return _query("SELECT * FROM funnel_events WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
+
+def get_user_transactions(user_id: int):
+    return _query("SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
+
+# --- Product Management ---
+def get_active_products():
+    return {row['id']: {"name": row['name'], "price": row['price'], "desc": row['description']} for row in _query("SELECT * FROM products WHERE active = 1")}
+
+def get_all_products_raw():
+    return _query("SELECT * FROM products")
+
+def update_product(p_id: str, name: str, price: float, description: str, active: int):
+    _execute("UPDATE products SET name = ?, price = ?, description = ?, active = ? WHERE id = ?", (name, price, description, active, p_id))
+
+# --- Settings (primitivas; o cache TTL de database.py vale também aqui) ---
+def _fetch_settings() -> List[Dict[str, Any]]:
+    return _query("SELECT key, value FROM settings")
+
+def _fetch_setting(key: str) -> Any:
+    rows = _query("SELECT value FROM settings WHERE key = ?", (key,))
+    return rows[0]['value'] if rows else database._MISSING
+
+def _store_setting(key: str, value: str):
+    _execute("INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+# --- Stats for Charts ---
+def get_revenue_series(start: Optional[datetime] = None, end: Optional[datetime] = None, granularity: str = "day", tz: str = None, bot_id: str = None, product_id: str = None, periods: int = 7) -> List[Dict[str, Any]]:
+    if granularity not in database.REVENUE_GRANULARITIES:
+        raise ValueError(f"Invalid granularity: {granularity}")
+    try:
+        zone = ZoneInfo(tz or database.REPORT_TIMEZONE)
+    except Exception:
+        zone = ZoneInfo(database.REPORT_TIMEZONE)
+    step = database.REVENUE_GRANULARITIES[granularity]
+    end = (end or datetime.now(timezone.utc)).astimezone(zone)
+    if start is None:
+        start = database._truncate(end, granularity) - step * (periods - 1)
+    start = database._truncate(start.astimezone(zone), granularity)
+
+    sql = "SELECT created_at, amount FROM transactions WHERE status = 'confirmed' AND created_at >= ? AND created_at < ?"
+    params = [_ts(start), _ts(end)]
+    if bot_id:
+        sql += " AND bot_id = ?"; params.append(bot_id)
+    if product_id:
+        sql += " AND product_id = ?"; params.append(product_id)
+
+    totals: Dict[str, Dict[str, Any]] = {}
+    for row in _query(sql, tuple(params)):
+        label = database._bucket_label(database._truncate(database._parse_ts(row['created_at']).astimezone(zone), granularity), granularity)
+        bucket = totals.setdefault(label, {"total": 0.0, "sales": 0})
+        bucket["total"] += row['amount'] or 0
+        bucket["sales"] += 1
+
+    series = []
+    cursor = start
+    while cursor <= end:
+        label = database._bucket_label(cursor, granularity)
+        bucket = totals.get(label, {"total": 0.0, "sales": 0})
+        series.append({"bucket": label, "total": bucket["total"], "sales": bucket["sales"]})
+        cursor = database._truncate((cursor.replace(tzinfo=None) + step).replace(tzinfo=zone), granularity)
+    return series
+
+# --- Funnel & Analytics ---
+def track_event(user_id: int, event_type: str, bot_id: str = None):
+    try:
+        _execute("INSERT INTO funnel_events (user_id, event_type, bot_id, created_at) VALUES (?, ?, ?, ?)", (user_id, event_type, bot_id, _ts()))
+    except Exception as e:
+        logger.error(f"Error tracking event: {e}")
+
+def get_funnel_stats(start: Optional[datetime] = None, end: Optional[datetime] = None, bot_id: str = None, unique: bool = False) -> Dict[str, int]:
+    stats = {stage: 0 for stage in database.FUNNEL_STAGES}
+    sql = f"SELECT event_type, COUNT(*) AS events, COUNT(DISTINCT user_id) AS users FROM funnel_events WHERE event_type IN ({', '.join('?' for _ in database.FUNNEL_STAGES)})"
+    params = list(database.FUNNEL_STAGES)
+    if start:
+        sql += " AND created_at >= ?"; params.append(_ts(start))
+    if end:
+        sql += " AND created_at < ?"; params.append(_ts(end))
+    if bot_id:
+        sql += " AND bot_id = ?"; params.append(bot_id)
+    try:
+        for row in _query(sql + " GROUP BY event_type", tuple(params)):
+            stats[row['event_type']] = row['users'] if unique else row['events']
+    except Exception as e:
+        logger.error(f"Error fetching funnel stats: {e}")
+    return stats
+
+def get_revenue_by_utm(group_by: str = "utm_source", start_day: Optional[str] = None, end_day: Optional[str] = None, bot_id: str = None, filters: Optional[Dict[str, str]] = None) -> Optional[List[Dict[str, Any]]]:
+    # Local: agrega direto de transactions (indexado), sem tabela de rollup
+    if group_by not in database.UTM_DIMENSIONS:
+        raise ValueError(f"Invalid UTM dimension: {group_by}")
+    zone = ZoneInfo(database.REPORT_TIMEZONE)
+    expr = {dim: f"COALESCE(u.{dim}, json_extract(t.metadata, '$.{dim}'), '')" for dim in database.UTM_DIMENSIONS}
+    sql = f"SELECT {expr[group_by]} AS key, COUNT(*) AS sales, COALESCE(SUM(t.amount), 0) AS total FROM transactions t LEFT JOIN users u ON u.id = t.user_id WHERE t.status = 'confirmed'"
+    params: List[Any] = []
+    if start_day:
+        sql += " AND COALESCE(t.confirmed_at, t.created_at) >= ?"
+        params.append(_ts(datetime.fromisoformat(start_day).replace(tzinfo=zone)))
+    if end_day:
+        sql += " AND COALESCE(t.confirmed_at, t.created_at) < ?"
+        params.append(_ts(datetime.fromisoformat(end_day).replace(tzinfo=zone) + timedelta(days=1)))
+    if bot_id:
+        sql += " AND t.bot_id = ?"; params.append(bot_id)
+    for dim, value in (filters or {}).items():
+        if dim in database.UTM_DIMENSIONS and value is not None:
+            sql += f" AND {expr[dim]} = ?"
+            params.append("" if value == database.DIRECT_TRAFFIC_LABEL else value)
+    sql += " GROUP BY 1 ORDER BY total DESC"
+    try:
+        return [{"key": r['key'] or database.DIRECT_TRAFFIC_LABEL, "sales": r['sales'], "total": float(r['total'])} for r in _query(sql, tuple(params))]
+    except Exception as e:
+        logger.error(f"Error fetching UTM revenue: {e}")
+        return None
+
+def get_revenue_by_source():
+    return [{"source": g["key"], "total": g["total"]} for g in get_revenue_by_utm("utm_source") or []]
+
+# --- Bot Content ---
+def get_bot_content(key: str, default: str = "") -> str:
+    rows = _query("SELECT value FROM bot_content WHERE key = ?", (key,))
+    return rows[0]['value'] if rows else default
+
+def get_content_snapshot() -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    try:
+        return {
+            "content": _query("SELECT * FROM bot_content"),
+            "links": _query("SELECT content_key, product_id FROM content_product_links"),
+            "products": _query("SELECT * FROM products")
+        }
+    except Exception as e:
+        logger.error(f"Error loading content snapshot: {e}")
+        return None
+
+def update_bot_content(key: str, value: str):
+    try:
+        _execute("INSERT INTO bot_content (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+    except Exception as e:
+        logger.error(f"Error updating bot content {key}: {e}")
+
+def get_all_content():
+    content_list = load_related("bot_content", "content_product_links", "content_key", parent_key="key", child_columns="product_id")
+    for item in content_list:
+        item['products'] = [r['product_id'] for r in item.pop("content_product_links")]
+    return content_list
+
+def get_products_for_content(content_key: str):
+    return [r['product_id'] for r in _query("SELECT product_id FROM content_product_links WHERE content_key = ?", (content_key,))]
+
+def get_linked_content_for_product(product_id: str):
+    return _query("SELECT c.* FROM content_product_links l JOIN bot_content c ON c.key = l.content_key WHERE l.product_id = ?", (product_id,))
+
+def get_content_for_product(key: str, product_id: str, default: str = ""):
+    return get_bot_content(key, default)
+
+def update_bot_content_advanced(key: str, value: str, description: str, product_ids: List[str], button_text: str = "", button_url: str = ""):
+    with _transaction() as conn:
+        conn.execute("""
+            INSERT INTO bot_content (key, value, description, button_text, button_url) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, description = excluded.description,
+                button_text = excluded.button_text, button_url = excluded.button_url
+        """, (key, value, description, button_text, button_url))
+        conn.execute("DELETE FROM content_product_links WHERE content_key = ?", (key,))
+        conn.executemany("INSERT INTO content_product_links (content_key, product_id) VALUES (?, ?)", [(key, pid) for pid in product_ids or []])
+
+def delete_bot_content(key: str):
+    _execute("DELETE FROM bot_content WHERE key = ?", (key,))
+
+# --- Automation ---
+def get_automation_rules():
+    return _query("SELECT * FROM automation_rules")
+
+def update_automation_rule(rule_id: int, delay: int, message: str, active: int):
+    _execute("UPDATE automation_rules SET delay_minutes = ?, message = ?, active = ? WHERE id = ?", (delay, message, active, rule_id))
+
+def get_pending_automations():
+    rules = [r for r in get_automation_rules() if r['active']]
+    if not rules: return []
+    now = datetime.now(timezone.utc)
+    windows = []
+    for rule in rules:
+        newest = now - timedelta(minutes=rule['delay_minutes'])
+        oldest = now - timedelta(minutes=rule['delay_minutes'] + database.AUTOMATION_WINDOW_MINUTES)
+        windows.append((rule, _ts(oldest), _ts(newest)))
+    where = " OR ".join("(t.created_at > ? AND t.created_at <= ?)" for _ in windows)
+    params = tuple(v for _, oldest, newest in windows for v in (oldest, newest))
+    rows = _query(f"""
+        SELECT t.*, u.username AS username, u.full_name AS full_name
+        FROM transactions t JOIN users u ON u.id = t.user_id
+        WHERE t.status = 'pending' AND ({where})
+    """, params)
+    pending = []
+    for t in rows:
+        for rule, oldest, newest in windows:
+            if oldest < t['created_at'] <= newest:
+                pending.append({**t, "message": rule['message']})
+    return pending
+
+# --- Gateway Management ---
+def get_all_gateways():
+    return _query("SELECT * FROM gateways ORDER BY created_at", table="gateways")
+
+def get_active_gateway():
+    rows = _query("SELECT * FROM gateways WHERE is_active = 1 LIMIT 1", table="gateways")
+    return rows[0] if rows else None
+
+def add_gateway(gw_id: str, name: str, provider: str, credentials: dict):
+    try:
+        _execute("INSERT INTO gateways (id, name, provider, is_active, credentials, created_at) VALUES (?, ?, ?, 0, ?, ?)", (gw_id, name, provider, json.dumps(credentials or {}), _ts()))
+        return True
+    except Exception as e:
+        logger.error(f"Error adding gateway: {e}")
+        return False
+
+def update_gateway(gw_id: str, name: str = None, credentials: dict = None):
+    try:
+        if name is not None:
+            _execute("UPDATE gateways SET name = ? WHERE id = ?", (name, gw_id))
+        if credentials is not None:
+            _execute("UPDATE gateways SET credentials = ? WHERE id = ?", (json.dumps(credentials), gw_id))
+        return True
+    except Exception as e:
+        logger.error(f"Error updating gateway: {e}")
+        return False
+
+def activate_gateway(gw_id: str):
+    try:
+        with _transaction() as conn:
+            conn.execute("UPDATE gateways SET is_active = (id = ?)", (gw_id,))
+        return True
+    except Exception as e:
+        logger.error(f"Error activating gateway: {e}")
+        return False
+
+def delete_gateway(gw_id: str):
+    try:
+        _execute("DELETE FROM gateways WHERE id = ?", (gw_id,))
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting gateway: {e}")
+        return False
+
+# --- Managed Bots ---
+def get_all_managed_bots():
+    return _query("SELECT * FROM managed_bots ORDER BY created_at", table="managed_bots")
+
+def add_managed_bot(token: str, name: str, username: str = None):
+    bot_id = str(uuid.uuid4())
+    try:
+        _execute("INSERT INTO managed_bots (id, token, name, username, is_active, created_at) VALUES (?, ?, ?, ?, 1, ?)", (bot_id, token, name, username, _ts()))
+        return _query("SELECT * FROM managed_bots WHERE id = ?", (bot_id,), table="managed_bots")[0]
+    except Exception as e:
+        logger.error(f"Error adding managed bot: {e}")
+        return None
+
+def update_managed_bot(bot_id: str, data: dict):
+    if not data: return True
+    try:
+        cols = list(data.keys())
+        _execute(f"UPDATE managed_bots SET {', '.join(f'{c} = ?' for c in cols)} WHERE id = ?", tuple(_encode(data[c]) for c in cols) + (bot_id,))
+        return True
+    except Exception as e:
+        logger.error(f"Error updating managed bot {bot_id}: {e}")
+        return False
+
+def delete_managed_bot(bot_id: str):
+    try:
+        _execute("DELETE FROM managed_bots WHERE id = ?", (bot_id,))
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting managed bot {bot_id}: {e}")
+        return False
+
+def get_ai_history(bot_id: str, user_id: int, limit: int = 10):
+    rows = _query("SELECT * FROM ai_chat_history WHERE bot_id = ? AND user_id = ? ORDER BY created_at DESC LIMIT ?", (bot_id, user_id, limit))
+    return list(reversed(rows))
+
+def add_ai_history(bot_id: str, user_id: int, role: str, content: str):
+    insert_rows("ai_chat_history", [{"bot_id": bot_id, "user_id": user_id, "role": role, "content": content, "created_at": _ts()}])
+
+# --- Abandoned Checkouts ---
+def log_abandoned_checkout(user_id: int, product_id: str, bot_id: str, metadata: dict = None):
+    try:
+        now = datetime.now(timezone.utc)
+        _execute("INSERT INTO abandoned_checkouts (user_id, product_id, bot_id, metadata, status, last_stage, created_at, updated_at, next_due_at) VALUES (?, ?, ?, ?, 'pending', 0, ?, ?, ?)", (user_id, product_id, bot_id, json.dumps(metadata) if metadata is not None else None, _ts(now), _ts(now), _ts(database.recovery_next_due(0, now))))
+    except Exception as e:
+        logger.error(f"Error logging abandoned checkout: {e}")
+
+def update_abandoned_checkout(user_id: int, bot_id: str, status: str = None, last_stage: int = None):
+    data = database._abandoned_update_data(status, last_stage)
+    sets = [f"{col} = ?" for col in data]
+    params = [_ts(v) if col in ("updated_at", "next_due_at") and v else v for col, v in data.items()]
+    try:
+        _execute(f"UPDATE abandoned_checkouts SET {', '.join(sets)} WHERE user_id = ? AND bot_id = ? AND status = 'pending'", tuple(params + [user_id, bot_id]))
+    except Exception as e:
+        logger.error(f"Error updating abandoned checkout: {e}")
+
+def get_pending_abandoned(bot_id: str):
+    return _query("SELECT * FROM abandoned_checkouts WHERE bot_id = ? AND status = 'pending'", (bot_id,))
+
+def get_due_abandoned(bot_ids: List[str], now: Optional[datetime] = None, limit: int = database.RECOVERY_DUE_BATCH):
+    if not bot_ids: return []
+    marks = ", ".join("?" for _ in bot_ids)
+    try:
+        return _query(f"SELECT * FROM abandoned_checkouts WHERE bot_id IN ({marks}) AND status = 'pending' AND next_due_at <= ? ORDER BY next_due_at LIMIT ?", (*bot_ids, _ts(now), limit))
+    except Exception as e:
+        logger.error(f"Error fetching due abandoned: {e}")
+        return []
+
+def count_due_abandoned(bot_ids: List[str], now: Optional[datetime] = None) -> int:
+    if not bot_ids: return 0
+    marks = ", ".join("?" for _ in bot_ids)
+    try:
+        return _execute(f"SELECT COUNT(*) FROM abandoned_checkouts WHERE bot_id IN ({marks}) AND status = 'pending' AND next_due_at <= ?", (*bot_ids, _ts(now))).fetchone()[0]
+    except Exception as e:
+        logger.error(f"Error counting due abandoned: {e}")
+        return 0
+
+def update_abandoned_checkouts(ids: List[int], status: str = None, last_stage: int = None, retry_at: datetime = None, attempts: int = None):
+    if not ids: return True
+    data = database._abandoned_update_data(status, last_stage, retry_at, attempts)
+    sets = [f"{col} = ?" for col in data]
+    params = [_ts(v) if col in ("updated_at", "next_due_at") and v else v for col, v in data.items()]
+    marks = ", ".join("?" for _ in ids)
+    try:
+        _execute(f"UPDATE abandoned_checkouts SET {', '.join(sets)} WHERE id IN ({marks}) AND status = 'pending'", tuple(params + list(ids)))
+        return True
+    except Exception as e:
+        logger.error(f"Error updating abandoned checkouts: {e}")
+        return False
+
+def get_abandoned_checkouts(bot_id: str = None, limit: int = 50):
+    sql = "SELECT a.*, b.name AS bot_name FROM abandoned_checkouts a LEFT JOIN managed_bots b ON b.id = a.bot_id"
+    params: List[Any] = []
+    if bot_id:
+        sql += " WHERE a.bot_id = ?"; params.append(bot_id)
+    sql += " ORDER BY a.created_at DESC LIMIT ?"; params.append(limit)
+    rows = _query(sql, tuple(params))
+    for row in rows:
+        row['managed_bots'] = {"name": row.pop('bot_name')}
+    return rows
+
+# --- Reminders ---
+def save_reminder(bot_id: str, user_id: int, chat_id: int, stage: int, due_at: datetime):
+    try:
+        _execute(
+            "INSERT INTO reminders (bot_id, user_id, chat_id, stage, due_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(bot_id, user_id) DO UPDATE SET chat_id = excluded.chat_id, stage = excluded.stage, due_at = excluded.due_at, updated_at = excluded.updated_at",
+            (bot_id, user_id, chat_id, stage, _ts(due_at), _ts())
+        )
+    except Exception as e:
+        logger.error(f"Error saving reminder: {e}")
+
+def delete_reminder(bot_id: str, user_id: int):
+    try:
+        _execute("DELETE FROM reminders WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
+    except Exception as e:
+        logger.error(f"Error deleting reminder: {e}")
+
+def get_reminders(bot_id: str, after_user_id: int = None, limit: int = database.REMINDER_LOAD_BATCH) -> List[Dict[str, Any]]:
+    try:
+        return _query("SELECT user_id, chat_id, stage, due_at FROM reminders WHERE bot_id = ? AND user_id > ? ORDER BY user_id LIMIT ?", (bot_id, after_user_id if after_user_id is not None else -2**63, limit))
+    except Exception as e:
+        logger.error(f"Error fetching reminders: {e}")
+        return []
+
+# --- Telegram file_id cache ---
+def get_media_file_ids(bot_id: str) -> List[Dict[str, Any]]:
+    try:
+        return _query("SELECT content_hash, media_type, file_id FROM media_file_ids WHERE bot_id = ?", (bot_id,))
+    except Exception as e:
+        logger.error(f"Error fetching media file ids: {e}")
+        return []
+
+def save_media_file_id(bot_id: str, content_hash: str, media_type: str, file_id: str):
+    try:
+        _execute(
+            "INSERT INTO media_file_ids (bot_id, content_hash, media_type, file_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(bot_id, content_hash) DO UPDATE SET media_type = excluded.media_type, file_id = excluded.file_id, updated_at = excluded.updated_at",
+            (bot_id, content_hash, media_type, file_id, _ts())
+        )
+    except Exception as e:
+        logger.error(f"Error saving media file id: {e}")
+
+def delete_media_file_id(bot_id: str, content_hash: str):
+    try:
+        _execute("DELETE FROM media_file_ids WHERE bot_id = ? AND content_hash = ?", (bot_id, content_hash))
+    except Exception as e:
+        logger.error(f"Error deleting media file id: {e}")
+
+# --- Keyset Pagination (mesmo cursor do database.py) ---
+PAGE_SQL = {
+    "transactions": "SELECT t.*, u.username AS username, u.full_name AS full_name FROM transactions t LEFT JOIN users u ON u.id = t.user_id",
+    "users": "SELECT t.* FROM users t",
+    "abandoned_checkouts": "SELECT t.*, b.name AS bot_name FROM abandoned_checkouts t LEFT JOIN managed_bots b ON b.id = t.bot_id",
+    "funnel_events": "SELECT t.* FROM funnel_events t",
+}
+
+def _keyset_page(table: str, cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Dict[str, Any]:
+    limit = database.page_limit(limit)
+    clauses, params = [], []
+    if bot_id:
+        clauses.append("t.bot_id = ?"); params.append(bot_id)
+    if since:
+        clauses.append("t.created_at >= ?"); params.append(_ts(since))
+    if until:
+        clauses.append("t.created_at < ?"); params.append(_ts(until))
+    if cursor:
+        created_at, row_id = database.decode_cursor(cursor)
+        clauses.append("(t.created_at < ? OR (t.created_at = ? AND t.id < ?))")
+        params += [_ts(created_at), _ts(created_at), row_id]
+    sql = PAGE_SQL[table]
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY t.created_at DESC, t.id DESC LIMIT ?"
+    rows = _query(sql, tuple(params + [limit + 1]))
+    if table == "abandoned_checkouts":
+        for row in rows:
+            row['managed_bots'] = {"name": row.pop('bot_name')}
+    return database.page_result(rows, limit)
+
+def _safe_page(table: str, cursor: Optional[str], limit: int, bot_id: str) -> Dict[str, Any]:
+    try:
+        return _keyset_page(table, cursor, limit, bot_id)
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching {table} page: {e}")
+        return {"items": [], "next_cursor": None}
+
+def get_transactions_page(cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return _safe_page("transactions", cursor, limit, bot_id)
+
+def get_users_page(cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return _safe_page("users", cursor, limit, bot_id)
+
+def get_abandoned_checkouts_page(cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: str = None) -> Dict[str, Any]:
+    return _safe_page("abandoned_checkouts", cursor, limit, bot_id)
+
+def _iter_keyset(table: str, batch_size: int, bot_id: str, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    cursor = None
+    while True:
+        page = _keyset_page(table, cursor, batch_size, bot_id, since, until)
+        yield from page["items"]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return
+
+def iter_transactions(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    return _iter_keyset("transactions", batch_size, bot_id, since, until)
+
+def iter_users(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    return _iter_keyset("users", batch_size, bot_id, since, until)
+
+def iter_abandoned_checkouts(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    return _iter_keyset("abandoned_checkouts", batch_size, bot_id, since, until)
+
+def iter_funnel_events(batch_size: int = database.PAGE_MAX_LIMIT, bot_id: str = None, since: datetime = None, until: datetime = None) -> Iterator[Dict[str, Any]]:
+    return _iter_keyset("funnel_events", batch_size, bot_id, since, until)
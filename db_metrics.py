@@ -0,0 +1,267 @@
+import os
+import re
+import time
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+# Instrumentação das funções de database/adatabase: latência (histograma),
+# linhas e bytes por função e por tabela, e um log das consultas lentas com
+# os filtros usados. A função ativa fica num contextvar, então cada request
+# HTTP (ou SQL no backend SQLite) é atribuído a quem o disparou.
+DB_METRICS_ENABLED = os.getenv("DB_METRICS_ENABLED", "true").lower() == "true"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+DB_SLOW_LOG_SIZE = int(os.getenv("DB_SLOW_LOG_SIZE", "200"))
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+BOT_METRICS_KEY = "db_metrics_bot"
+
+_current_function: contextvars.ContextVar[str] = contextvars.ContextVar("db_function", default="unknown")
+_lock = threading.Lock()
+_functions: Dict[str, Dict[str, Any]] = {}
+_tables: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_slow_log: deque = deque(maxlen=DB_SLOW_LOG_SIZE)
+_started_at = time.time()
+
+def _new_entry() -> Dict[str, Any]:
+    return {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0, "bytes": 0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+
+def _observe(entry: Dict[str, Any], elapsed_ms: float, error: bool, rows: Optional[int], size: Optional[int]):
+    entry["calls"] += 1
+    entry["errors"] += int(error)
+    entry["total_ms"] += elapsed_ms
+    entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+    entry["rows"] += rows or 0
+    entry["bytes"] += size or 0
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if elapsed_ms <= bound:
+            entry["buckets"][i] += 1
+            break
+    else:
+        entry["buckets"][-1] += 1
+
+def _row_count(result: Any) -> Optional[int]:
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict) and isinstance(result.get("items"), list):
+        return len(result["items"])
+    return None
+
+# --- Function level ---
+def record_call(function: str, elapsed_ms: float, error: bool = False, rows: Optional[int] = None):
+    with _lock:
+        _observe(_functions.setdefault(function, _new_entry()), elapsed_ms, error, rows, None)
+
+@contextmanager
+def label(name: str):
+    """Attributes the queries made inside the block to `name`."""
+    token = _current_function.set(name)
+    try:
+        yield
+    finally:
+        _current_function.reset(token)
+
+def _track_iterator(name: str, iterator):
+    # Só marca a função enquanto o gerador avança; o tempo entre itens é do chamador
+    rows = 0
+    busy_ms = 0.0
+    error = False
+    try:
+        while True:
+            token = _current_function.set(name)
+            step = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except Exception:
+                error = True
+                raise
+            finally:
+                busy_ms += (time.perf_counter() - step) * 1000
+                _current_function.reset(token)
+            rows += 1
+            yield item
+    finally:
+        record_call(name, busy_ms, error, rows)
+
+def _wrap_sync(name: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_function.set(name)
+        started = time.perf_counter()
+        error = False
+        result = None
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            _current_function.reset(token)
+            if not inspect.isgenerator(result):
+                record_call(name, (time.perf_counter() - started) * 1000, error, _row_count(result))
+        # Funções que devolvem um gerador (iter_*) são medidas enquanto ele é consumido
+        return _track_iterator(name, result) if inspect.isgenerator(result) else result
+    return wrapper
+
+def _wrap_async(name: str, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _current_function.set(name)
+        started = time.perf_counter()
+        error = False
+        result = None
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        except Exception:
+            error = True
+            raise
+        finally:
+            _current_function.reset(token)
+            record_call(name, (time.perf_counter() - started) * 1000, error, _row_count(result))
+    return wrapper
+
+def instrument(namespace: Dict[str, Any], prefix: str, names: Optional[List[str]] = None):
+    """
+    Replaces the public functions in namespace (a module's globals()) with
+    timed wrappers labeled "<prefix>.<name>". names limits which ones.
+    """
+    if not DB_METRICS_ENABLED:
+        return
+    for name in names if names is not None else list(namespace):
+        func = namespace.get(name)
+        if name.startswith("_") or not inspect.isfunction(func) or getattr(func, "__instrumented__", False):
+            continue
+        label = f"{prefix}.{name}"
+        if inspect.iscoroutinefunction(func):
+            wrapped = _wrap_async(label, func)
+        else:
+            wrapped = _wrap_sync(label, func)
+        wrapped.__instrumented__ = True
+        namespace[name] = wrapped
+
+# --- Query level ---
+def record_query(table: str, method: str, elapsed_ms: float, error: bool = False, rows: Optional[int] = None, size: Optional[int] = None, filters: Optional[Dict[str, str]] = None):
+    """Records one round trip, attributed to the function in the current context."""
+    if not DB_METRICS_ENABLED:
+        return
+    function = _current_function.get()
+    with _lock:
+        _observe(_tables.setdefault((function, table), _new_entry()), elapsed_ms, error, rows, size)
+    if elapsed_ms >= DB_SLOW_QUERY_MS:
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "function": function,
+            "table": table,
+            "method": method,
+            "ms": round(elapsed_ms, 2),
+            "rows": rows,
+            "bytes": size,
+            "error": error,
+            "filters": filters or {},
+        }
+        with _lock:
+            _slow_log.append(entry)
+        logger.warning(f"Slow query {function} -> {method} {table}: {entry['ms']} ms {entry['filters']}")
+
+_CONTENT_RANGE_RE = re.compile(r"(\d+)-(\d+)/")
+
+def _rows_from_headers(headers) -> Optional[int]:
+    # PostgREST devolve Content-Range: 0-24/* (ou */0 quando vazio)
+    value = headers.get("content-range")
+    if not value:
+        return None
+    match = _CONTENT_RANGE_RE.match(value)
+    if match:
+        return int(match.group(2)) - int(match.group(1)) + 1
+    return 0 if value.startswith("*/") else None
+
+def record_http(request, response, elapsed_ms: float):
+    """Records a PostgREST request; table comes from /rest/v1/<table> or rpc/<fn>."""
+    parts = urlsplit(str(request.url))
+    path = parts.path.split("/rest/v1/", 1)[-1].strip("/") or parts.path
+    filters = {k: v[:200] for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != "select"}
+    rows = size = None
+    error = response is None or response.status_code >= 400
+    if response is not None:
+        rows = _rows_from_headers(response.headers)
+        try:
+            size = len(response.content)
+        except Exception:
+            size = None
+    record_query(path, request.method, elapsed_ms, error, rows, size, filters)
+
+_SQL_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+def record_sql(sql: str, elapsed_ms: float, error: bool = False):
+    match = _SQL_TABLE_RE.search(sql)
+    record_query(match.group(1) if match else "sql", sql.split(None, 1)[0].upper() if sql.strip() else "SQL", elapsed_ms, error, filters={"sql": " ".join(sql.split())[:300]})
+
+# --- Reporting ---
+def _percentile(buckets: List[int], q: float) -> Optional[float]:
+    total = sum(buckets)
+    if not total:
+        return None
+    target = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen >= target:
+            return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else None
+    return None
+
+def _summary(entry: Dict[str, Any]) -> Dict[str, Any]:
+    calls = entry["calls"]
+    return {
+        "calls": calls,
+        "errors": entry["errors"],
+        "total_ms": round(entry["total_ms"], 2),
+        "avg_ms": round(entry["total_ms"] / calls, 2) if calls else 0.0,
+        "max_ms": round(entry["max_ms"], 2),
+        "p50_ms": _percentile(entry["buckets"], 0.5),
+        "p95_ms": _percentile(entry["buckets"], 0.95),
+        "rows": entry["rows"],
+        "bytes": entry["bytes"],
+        "histogram": dict(zip([f"le_{b}" for b in LATENCY_BUCKETS_MS] + ["inf"], entry["buckets"])),
+    }
+
+def snapshot(function: Optional[str] = None, table: Optional[str] = None, slow_limit: int = 50) -> Dict[str, Any]:
+    """Everything recorded so far, busiest first. p50/p95 are histogram bucket upper bounds (None = above the last bucket)."""
+    with _lock:
+        functions = {name: _summary(e) for name, e in _functions.items() if not function or function in name}
+        tables = [
+            {"function": fn, "table": tb, **_summary(e)}
+            for (fn, tb), e in _tables.items()
+            if (not function or function in fn) and (not table or table == tb)
+        ]
+        slow = [
+            s for s in reversed(_slow_log)
+            if (not function or function in s["function"]) and (not table or table == s["table"])
+        ][:slow_limit]
+    return {
+        "enabled": DB_METRICS_ENABLED,
+        "since": datetime.fromtimestamp(_started_at, timezone.utc).isoformat(),
+        "slow_query_ms": DB_SLOW_QUERY_MS,
+        "buckets_ms": list(LATENCY_BUCKETS_MS),
+        "functions": dict(sorted(functions.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)),
+        "tables": sorted(tables, key=lambda t: t["total_ms"], reverse=True),
+        "slow_queries": slow,
+    }
+
+def reset():
+    global _started_at
+    with _lock:
+        _functions.clear()
+        _tables.clear()
+        _slow_log.clear()
+        _started_at = time.time()
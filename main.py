@@ -1,19 +1,29 @@
 import os
 import logging
 import asyncio
-import qrcode
-import io
 import random
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, InputFile
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from openai import OpenAI
 import httpx
 from api import gateway, utmfy, tiktok
 from datetime import datetime, timezone
+import hmac
 import secrets
 import string
 import database
+import adatabase
+import content
+import write_buffer
+import bot_registry
+import db_metrics
+import reminders
+import recovery
+import media_cache
+import media_store
+import qr_render
+import update_processor
 import json
 from typing import Dict, Any, List, Optional
 
@@ -31,27 +41,17 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Track pending reminders: {bot_id: {user_id: asyncio.Task}}
-pending_reminders = {}
-
-# Media cache: {bot_id: {key: file_id}}
-media_cache = {}
-
 def get_media_source(key, default_rel_path):
-    """Safely gets media path from DB or fallback to default."""
+    """Safely gets media path from the content snapshot in memory or fallback to default."""
     try:
-        custom_path = database.get_bot_content(key)
-        if custom_path and custom_path.startswith("/media/"):
-            full_path = os.path.join("painel", custom_path.lstrip("/"))
-            if os.path.exists(full_path):
-                return full_path
+        return content.snapshot().media_path(key, default_rel_path)
     except Exception as e:
         logger.error(f"get_media_source error: {e}")
     return default_rel_path
 
 # --- Product Data ---
 def get_products():
-    return database.get_active_products()
+    return content.snapshot().products
 
 # --- Inactivity Reminder Data ---
 INACTIVITY_TEXT = (
@@ -91,21 +91,24 @@ IMAGINA_KEYBOARD = [
 
 async def get_ai_response(bot_id: str, user_id: int, user_message: str):
     """Generates a response using OpenAI based on bot-specific personality."""
-    api_key = database.get_setting("openai_api_key")
+    api_key = await adatabase.get_setting("openai_api_key")
     if not api_key:
         logger.warning("OpenAI API Key not configured.")
         return None
     
     # Get bot config for prompt and enablement
-    all_bots = database.get_all_managed_bots()
-    bot_config = next((b for b in all_bots if b['id'] == bot_id), None)
+    bot_config = bot_registry.get(bot_id)
     
     if not bot_config or not bot_config.get("ai_enabled"):
         return None
     
     try:
         client = OpenAI(api_key=api_key)
-        history = database.get_ai_history(bot_id, user_id)
+        history = await adatabase.get_ai_history(bot_id, user_id)
+        # Mensagens ainda no write-buffer não estão no banco
+        buffered = write_buffer.pending_rows("ai_chat_history", bot_id=bot_id, user_id=user_id)
+        if buffered:
+            history = sorted(history + buffered, key=lambda x: x['created_at'])[-10:]
         
         system_prompt = bot_config.get("system_prompt", "Você é a Kamylinha, uma vendedora carismática.")
         
@@ -116,7 +119,7 @@ async def get_ai_response(bot_id: str, user_id: int, user_message: str):
         messages.append({"role": "user", "content": user_message})
         
         # Save user message to history
-        database.add_ai_history(bot_id, user_id, "user", user_message)
+        write_buffer.add_ai_history(bot_id, user_id, "user", user_message)
         
         response = await asyncio.to_thread(
             client.chat.completions.create,
@@ -129,7 +132,7 @@ async def get_ai_response(bot_id: str, user_id: int, user_message: str):
         ai_reply = response.choices[0].message.content
         
         # Save AI reply to history
-        database.add_ai_history(bot_id, user_id, "assistant", ai_reply)
+        write_buffer.add_ai_history(bot_id, user_id, "assistant", ai_reply)
         
         return ai_reply
     except Exception as e:
@@ -154,7 +157,7 @@ async def handle_ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass
 
 async def check_maintenance(update: Update):
-    is_maintenance = database.get_setting("maintenance_mode", "false").lower() == "true"
+    is_maintenance = (await adatabase.get_setting("maintenance_mode", "false")).lower() == "true"
     if is_maintenance:
         msg = "🛠 **MODO MANUTENÇÃO**\n\nEstamos fazendo algumas melhorias rápidas. Voltamos em instantes! 😘"
         if update.callback_query:
@@ -164,107 +167,41 @@ async def check_maintenance(update: Update):
         return True
     return False
 
-async def run_reminder(user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE, bot_id: str, product_id: str = None):
-    """Smart CRM Multi-stage recovery."""
-    try:
-        # Stage 1: 10 Minutes - Video Objeção/Curiosidade
-        await asyncio.sleep(600) # 10 min
-        database.update_abandoned_checkout(user_id, bot_id, last_stage=1)
-        
-        custom_v1 = get_media_source("recovery_v10m", "imgs/videokamyrebo.mp4")
-        c_bot = media_cache.setdefault(bot_id, {})
-        cached_id = c_bot.get(custom_v1)
-
-        await context.bot.send_video(
-            chat_id=chat_id,
-            video=cached_id or open(custom_v1, 'rb'),
-            caption="🔥 **NÃO VAI EMBORA!**\n\nVi que você quase liberou seu acesso... preparei um presente especial: **15% de DESCONTO** exclusivo pra você hoje! 🎁🎬",
-            reply_markup=InlineKeyboardMarkup(INACTIVITY_KEYBOARD),
-            parse_mode='Markdown'
-        )
-
-        # Stage 2: 1 Hour - Áudio Real (Conversa)
-        await asyncio.sleep(3000) # + 50 min = 1 hour total
-        database.update_abandoned_checkout(user_id, bot_id, last_stage=2)
-        
-        audio_path = get_media_source("recovery_audio_1h", "imgs/audio_venda.ogg") # Supondo existir
-        if os.path.exists(audio_path):
-            await context.bot.send_voice(chat_id=chat_id, voice=open(audio_path, 'rb'), caption="Escuta esse áudio que gravei pra você... ❤️")
-        else:
-            await context.bot.send_message(chat_id=chat_id, text="Ainda tá aí? Quero muito te ver lá dentro do VIP... chama o suporte se tiver dúvida! 💬")
-
-        # Stage 3: 24 Hours - Cupom 50% OFF (Oportunidade Única)
-        await asyncio.sleep(82800) # + 23 hours = 24h total
-        database.update_abandoned_checkout(user_id, bot_id, last_stage=3)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="🚨 **ÚLTIMA CHANCE: 50% DE DESCONTO** 🚨\n\nNão quero que você fique de fora. Só pelas próximas 2h, liberei o acesso pela METADE do preço. Aproveita agora ou perca pra sempre! 👇",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔥 LIBERAR 50% OFF AGORA", callback_data='buy_vip_vital_disc_50')]])
-        )
-
-        # Stage 4: 3 Days - Retargeting "Saudade"
-        await asyncio.sleep(172800) # + 2 days = 3 days total
-        database.update_abandoned_checkout(user_id, bot_id, last_stage=4)
-        await context.bot.send_message(chat_id=chat_id, text="Sumido(a)... 👀\n\nPassando pra dizer que postei conteúdos novos que você ia AMAR. Volta aqui? ❤️")
-
-    except asyncio.CancelledError: pass
-    except Exception as e: logger.error(f"Reminder error: {e}")
-    finally:
-        if bot_id in pending_reminders and user_id in pending_reminders[bot_id]:
-            del pending_reminders[bot_id][user_id]
-
 # --- CRM Recovery Configuration ---
 RECOVERY_STAGES = {
-    1: {"delay": 600, "type": "video", "media_key": "recovery_v10m", "default_media": "imgs/videokamyrebo.mp4", "caption": "🔥 **NÃO VAI EMBORA!**\n\nVi que você quase liberou seu acesso... preparei um presente especial: **15% de DESCONTO** exclusivo pra você hoje! 🎁🎬", "markup": INACTIVITY_KEYBOARD},
-    2: {"delay": 3600, "type": "voice", "media_key": "recovery_audio_1h", "default_media": "imgs/audio_venda.ogg", "caption": "Escuta esse áudio que gravei pra você... ❤️"},
-    3: {"delay": 86400, "type": "text", "content": "🚨 **ÚLTIMA CHANCE: 50% DE DESCONTO** 🚨\n\nNão quero que você fique de fora. Só pelas próximas 2h, liberei o acesso pela METADE do preço. Aproveita agora ou perca pra sempre! 👇", "markup": InlineKeyboardMarkup([[InlineKeyboardButton("🔥 LIBERAR 50% OFF AGORA", callback_data='buy_vip_vital_disc_50')]])},
-    4: {"delay": 259200, "type": "text", "content": "Sumido(a)... 👀\n\nPassando pra dizer que postei conteúdos novos que você ia AMAR. Volta aqui? ❤️"}
+    1: {"delay": database.RECOVERY_STAGE_DELAYS[1], "type": "video", "media_key": "recovery_v10m", "default_media": "imgs/videokamyrebo.mp4", "caption": "🔥 **NÃO VAI EMBORA!**\n\nVi que você quase liberou seu acesso... preparei um presente especial: **15% de DESCONTO** exclusivo pra você hoje! 🎁🎬", "markup": INACTIVITY_KEYBOARD},
+    2: {"delay": database.RECOVERY_STAGE_DELAYS[2], "type": "voice", "media_key": "recovery_audio_1h", "default_media": "imgs/audio_venda.ogg", "caption": "Escuta esse áudio que gravei pra você... ❤️"},
+    3: {"delay": database.RECOVERY_STAGE_DELAYS[3], "type": "text", "content": "🚨 **ÚLTIMA CHANCE: 50% DE DESCONTO** 🚨\n\nNão quero que você fique de fora. Só pelas próximas 2h, liberei o acesso pela METADE do preço. Aproveita agora ou perca pra sempre! 👇", "markup": InlineKeyboardMarkup([[InlineKeyboardButton("🔥 LIBERAR 50% OFF AGORA", callback_data='buy_vip_vital_disc_50')]])},
+    4: {"delay": database.RECOVERY_STAGE_DELAYS[4], "type": "text", "content": "Sumido(a)... 👀\n\nPassando pra dizer que postei conteúdos novos que você ia AMAR. Volta aqui? ❤️"}
 }
 
-async def run_recovery_worker(bot_id: str, app):
-    """Background worker to check and send persistent recovery messages."""
-    logger.info(f"Recovery worker started for bot {bot_id}")
-    while True:
-        try:
-            pending = await asyncio.to_thread(database.get_pending_abandoned, bot_id)
-            for rec in pending:
-                now = datetime.now(timezone.utc)
-                created_at = datetime.fromisoformat(rec['created_at'].replace('Z', '+00:00'))
-                seconds_since = (now - created_at).total_seconds()
-                
-                next_stage = rec['last_stage'] + 1
-                if next_stage in RECOVERY_STAGES:
-                    stage_cfg = RECOVERY_STAGES[next_stage]
-                    if seconds_since >= stage_cfg['delay']:
-                        try:
-                            user_id = rec['user_id']
-                            chat_id = user_id # Assuming DM
-                            
-                            if stage_cfg['type'] == 'video':
-                                media = get_media_source(stage_cfg['media_key'], stage_cfg['default_media'])
-                                await app.bot.send_video(chat_id=chat_id, video=open(media, 'rb'), caption=stage_cfg['caption'], reply_markup=stage_cfg['markup'], parse_mode='Markdown')
-                            elif stage_cfg['type'] == 'voice':
-                                media = get_media_source(stage_cfg['media_key'], stage_cfg['default_media'])
-                                if os.path.exists(media):
-                                    await app.bot.send_voice(chat_id=chat_id, voice=open(media, 'rb'), caption=stage_cfg['caption'])
-                                else:
-                                    await app.bot.send_message(chat_id=chat_id, text="Ainda tá aí? Quero muito te ver lá dentro do VIP... ❤️")
-                            elif stage_cfg['type'] == 'text':
-                                await app.bot.send_message(chat_id=chat_id, text=stage_cfg['content'], reply_markup=stage_cfg.get('markup'), parse_mode='Markdown')
-                            
-                            # Update DB
-                            await asyncio.to_thread(database.update_abandoned_checkout, user_id, bot_id, last_stage=next_stage)
-                            logger.info(f"Recovery Stage {next_stage} sent to {user_id} for bot {bot_id}")
-                            
-                        except Exception as e:
-                            logger.error(f"Error sending recovery to {rec['user_id']}: {e}")
-                            if "Forbidden" in str(e) or "blocked" in str(e).lower():
-                                await asyncio.to_thread(database.update_abandoned_checkout, rec['user_id'], bot_id, status="failed")
-
-            await asyncio.sleep(60) # Scan every minute
-        except Exception as e:
-            logger.error(f"Recovery worker error for bot {bot_id}: {e}")
-            await asyncio.sleep(60)
+async def send_recovery_stage(bot_id: str, bot, chat_id: int, stage: int):
+    """Sends one recovery/reminder stage. Raises on Telegram errors."""
+    stage_cfg = RECOVERY_STAGES.get(stage)
+    if not stage_cfg:
+        return
+    # Atualiza o snapshot fora do loop se mudou; get_media_source só lê da memória
+    await content.load()
+    if stage_cfg['type'] == 'video':
+        media = get_media_source(stage_cfg['media_key'], stage_cfg['default_media'])
+        await media_cache.send_media(bot, bot_id, chat_id, media, "video", caption=stage_cfg['caption'], reply_markup=stage_cfg['markup'], parse_mode='Markdown')
+    elif stage_cfg['type'] == 'voice':
+        media = get_media_source(stage_cfg['media_key'], stage_cfg['default_media'])
+        if os.path.exists(media):
+            await media_cache.send_media(bot, bot_id, chat_id, media, "voice", caption=stage_cfg['caption'])
+        else:
+            await bot.send_message(chat_id=chat_id, text="Ainda tá aí? Quero muito te ver lá dentro do VIP... ❤️")
+    elif stage_cfg['type'] == 'text':
+        await bot.send_message(chat_id=chat_id, text=stage_cfg['content'], reply_markup=stage_cfg.get('markup'), parse_mode='Markdown')
+
+async def mapped_media() -> List[tuple]:
+    """Every media asset the bot sends, as (path, media_type), for the file_id warm-up."""
+    snap = await content.load()
+    assets = [(snap.welcome.media_path, None)]
+    for stage_cfg in RECOVERY_STAGES.values():
+        if stage_cfg.get('media_key'):
+            assets.append((snap.media_path(stage_cfg['media_key'], stage_cfg['default_media']), stage_cfg['type']))
+    return [(path, media_type) for path, media_type in assets if path and os.path.exists(path)]
 
 def parse_start_payload(payload: str) -> Dict[str, str]:
     tracking = {}
@@ -287,53 +224,30 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bot_id = context.application.bot_data.get("bot_id")
     
     tracking_data = parse_start_payload(context.args[0]) if context.args else {}
-    asyncio.create_task(asyncio.to_thread(database.log_user, user.id, user.username, user.full_name, tracking_data, bot_id=bot_id))
-    asyncio.create_task(asyncio.to_thread(database.track_event, user.id, 'start', bot_id=bot_id))
+    asyncio.create_task(adatabase.log_user(user.id, user.username, user.full_name, tracking_data, bot_id=bot_id))
+    write_buffer.track_event(user.id, 'start', bot_id=bot_id)
     
     user_info = {"full_name": user.full_name, "username": user.username, "tracking_data": tracking_data}
     asyncio.create_task(tiktok.send_tiktok_event("Contact", user.id, user_info))
 
-    welcome_text = await asyncio.to_thread(database.get_bot_content, "welcome_text", "Olá! Escolha seu plano e comece agora:")
-    keyboard = []
-    linked_prod_ids = await asyncio.to_thread(database.get_products_for_content, "welcome_text")
-    if linked_prod_ids:
-        all_prods = await asyncio.to_thread(database.get_active_products)
-        for prod_id in linked_prod_ids:
-            product = all_prods.get(prod_id)
-            if product:
-                btn_label = f"🔥 {product['name']} POR R${product['price']:.2f}"
-                keyboard.append([InlineKeyboardButton(btn_label, callback_data=f"buy_{prod_id}")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-    photo_path = get_media_source("welcome_photo", os.path.join("imgs", "3banner.mp4"))
+    screen = (await content.load()).welcome
+    welcome_text, reply_markup, photo_path = screen.text, screen.reply_markup, screen.media_path
     
-    c_bot = media_cache.setdefault(bot_id, {})
-    cached_id = c_bot.get("banner")
-
     if os.path.exists(photo_path):
         try:
-            if photo_path.lower().endswith(('.mp4', '.mov', '.avi')):
-                msg = await update.message.reply_video(video=cached_id or open(photo_path, 'rb'), caption=welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
-                if not cached_id and msg.video: c_bot["banner"] = msg.video.file_id
-            else:
-                msg = await update.message.reply_photo(photo=cached_id or open(photo_path, 'rb'), caption=welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
-                if not cached_id and msg.photo: c_bot["banner"] = msg.photo[-1].file_id
+            # Vídeo pela extensão, senão foto (file_id em cache por bot e conteúdo)
+            media_type = "video" if photo_path.lower().endswith(media_cache.VIDEO_EXTENSIONS) else "photo"
+            await media_cache.send_media(context.bot, bot_id, update.effective_chat.id, photo_path, media_type, caption=welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
         except Exception as e:
             await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
     else:
         await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
     
-    b_reminders = pending_reminders.setdefault(bot_id, {})
-    if user.id in b_reminders: b_reminders[user.id].cancel()
-    b_reminders[user.id] = asyncio.create_task(run_reminder(user.id, update.effective_chat.id, context, bot_id))
+    reminders.schedule(bot_id, user.id, update.effective_chat.id)
 
 async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = []
-    products = get_products()
-    for pid, details in products.items():
-        keyboard.append([InlineKeyboardButton(f"{details['name']} - R${details['price']:.2f}", callback_data=f'prod_{pid}')])
-    keyboard.append([InlineKeyboardButton("🔙 Voltar ao Menu", callback_data='main_menu')])
-    await update.callback_query.edit_message_text(text="🔥 **Catálogo de Conteúdos** 🔥", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    screen = (await content.load()).catalog
+    await update.callback_query.edit_message_text(text=screen.text, reply_markup=screen.reply_markup, parse_mode='Markdown')
 
 async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: str):
     if await check_maintenance(update): return
@@ -341,15 +255,11 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, pr
     user = update.effective_user
     bot_id = context.application.bot_data.get("bot_id")
     
-    product = get_products().get(product_id)
+    product = (await content.load()).products.get(product_id)
     if not product: return await query.answer("Produto não encontrado.", show_alert=True)
 
-    b_reminders = pending_reminders.get(bot_id, {})
-    if user.id in b_reminders:
-        b_reminders[user.id].cancel()
-        del b_reminders[user.id]
-        
-    db_user = await asyncio.to_thread(database.get_user, user.id)
+    # O lembrete de inatividade já foi cancelado no button_handler; daqui em diante a recuperação do checkout assume
+    db_user = await adatabase.get_user(user.id)
     tracking_data = {k: db_user[k] for k in ["ttclid", "utm_source", "utm_medium", "utm_campaign", "utm_content", "utm_term"] if db_user and db_user.get(k)}
 
     await query.message.reply_text("Gerando seu Pix...")
@@ -358,18 +268,16 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, pr
     
     asyncio.create_task(utmfy.send_order(identifier, "waiting_payment", {"id": user.id, "full_name": user.full_name, "ip": None}, {"id": product_id, "name": product['name'], "price": product['price']}, tracking_data, {"created_at": order_ts}))
     
-    # Log Abandonment & Start Smart Recovery
-    asyncio.create_task(asyncio.to_thread(database.log_abandoned_checkout, user.id, product_id, bot_id, metadata=tracking_data))
-    b_reminders[user.id] = asyncio.create_task(run_reminder(user.id, query.message.chat_id, context, bot_id, product_id))
+    # Log Abandonment (o despachante em recovery.py envia os estágios)
+    asyncio.create_task(adatabase.log_abandoned_checkout(user.id, product_id, bot_id, metadata=tracking_data))
 
     pix_data = await gateway.create_payment(identifier, product['price'], user.full_name or "Cliente", f"u{user.id}@tg.com", "(11)999999999", "12345678909", product['name'], tracking_data)
 
     if pix_data:
-        database.log_transaction(identifier, user.id, product_id, product['price'], 'pending', metadata=tracking_data, created_at=order_ts, bot_id=bot_id)
+        await adatabase.log_transaction(identifier, user.id, product_id, product['price'], 'pending', metadata=tracking_data, created_at=order_ts, bot_id=bot_id)
         pix_key = pix_data['pix']['code']
-        qr = qrcode.make(pix_key)
-        bio = io.BytesIO(); bio.name = 'qr.png'; qr.save(bio, 'PNG'); bio.seek(0)
-        await query.message.reply_photo(bio, caption="Seu QR Code 🚀")
+        qr_png = await qr_render.render(pix_key)
+        await query.message.reply_photo(InputFile(qr_png, filename='qr.png'), caption="Seu QR Code 🚀")
         await query.message.reply_text(f"`{pix_key}`", parse_mode='Markdown')
         await query.message.reply_text("Aguardando confirmação...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Confirmar", callback_data=f'confirm_pay_{product_id}_{identifier}')]]))
     else:
@@ -381,33 +289,60 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     data, user_id, bot_id = query.data, update.effective_user.id, context.application.bot_data.get("bot_id")
     
-    b_reminders = pending_reminders.get(bot_id, {})
-    if user_id in b_reminders:
-        b_reminders[user_id].cancel()
-        del b_reminders[user_id]
+    reminders.cancel(bot_id, user_id)
 
     if data == 'main_menu': await start(update, context) # Simplied fallback
     elif data == 'list_products': await show_products(update, context)
     elif data.startswith('prod_'):
         pid = data.split('_')[1]
-        product = get_products().get(pid)
-        if product:
-            btn = [[InlineKeyboardButton("💳 Comprar", callback_data=f'buy_{pid}')], [InlineKeyboardButton("🔙 Voltar", callback_data='list_products')]]
-            await query.edit_message_text(f"🔞 **{product['name']}**\n\n{product['desc']}\n💰 R${product['price']:.2f}", reply_markup=InlineKeyboardMarkup(btn), parse_mode='Markdown')
+        screen = (await content.load()).product_screens.get(pid)
+        if screen:
+            await query.edit_message_text(screen.text, reply_markup=screen.reply_markup, parse_mode='Markdown')
     elif data == "ver_planos":
-        asyncio.create_task(asyncio.to_thread(database.track_event, user_id, 'view_plans', bot_id=bot_id))
+        write_buffer.track_event(user_id, 'view_plans', bot_id=bot_id)
         await show_products(update, context)
     elif data.startswith('buy_'):
         pid = data.replace('buy_', '', 1)
-        asyncio.create_task(asyncio.to_thread(database.track_event, user_id, 'checkout', bot_id=bot_id))
+        write_buffer.track_event(user_id, 'checkout', bot_id=bot_id)
         await handle_purchase(update, context, pid)
     elif data.startswith('confirm_pay_'):
         ident = data.split('_')[3]
-        database.confirm_transaction(ident)
+        await adatabase.confirm_transaction(ident)
         await query.edit_message_text("✅ Pagamento informado! Enviando conteúdo...")
 
+# BOT_MODE=webhook: em vez de um long polling por bot, o Telegram entrega os
+# updates em POST /tg/{bot_id} do painel, que os põe na update_queue do bot.
+# Os bots rodam então dentro do processo do painel (uvicorn painel.main:app);
+# cada webhook é registrado na partida do bot com um secret_token aleatório.
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").rstrip("/")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+webhook_bots: Dict[str, tuple] = {}  # bot_id -> (Application, secret_token)
+
+def webhook_mode() -> bool:
+    return BOT_MODE == "webhook" and bool(WEBHOOK_BASE_URL)
+
+async def feed_webhook(bot_id: str, secret_token: Optional[str], payload: Dict[str, Any]) -> int:
+    """Queues a webhook update on its bot. Returns the HTTP status for Telegram."""
+    entry = webhook_bots.get(bot_id)
+    if entry is None:
+        return 404
+    app, secret = entry
+    if not secret_token or not hmac.compare_digest(secret_token, secret):
+        return 403
+    update = Update.de_json(payload, app.bot)
+    if update is None:
+        return 400
+    await app.update_queue.put(update)
+    return 200
+
 async def setup_bot(bot_token: str, bot_id: str):
-    app = ApplicationBuilder().token(bot_token).build()
+    # Chats diferentes em paralelo, cada chat em ordem (update_processor.py)
+    builder = ApplicationBuilder().token(bot_token).concurrent_updates(update_processor.ChatOrderedProcessor(bot_id))
+    if webhook_mode():
+        # Sem Updater: nenhum getUpdates nem o pool HTTP dele
+        builder = builder.updater(None)
+    app = builder.build()
     app.bot_data["bot_id"] = bot_id
     
     app.add_handler(CommandHandler('start', start))
@@ -422,45 +357,104 @@ async def setup_bot(bot_token: str, bot_id: str):
     
     return app
 
+async def stop_bot_instance(bot_id: str, app):
+    """Tears down what run_bot_instance started; every step runs even if an earlier one fails."""
+    recovery.detach(bot_id)
+    reminders.detach(bot_id)
+    if app is None:
+        return
+    steps = []
+    # Sem a entrada o /tg/{bot_id} já responde 404; o webhook sai do Telegram
+    if webhook_bots.pop(bot_id, None):
+        steps.append(("delete_webhook", app.bot.delete_webhook))
+    if app.updater and app.updater.running:
+        steps.append(("updater.stop", app.updater.stop))
+    if app.running:
+        steps.append(("stop", app.stop))
+    steps.append(("shutdown", app.shutdown))
+    for name, step in steps:
+        try:
+            await step()
+        except Exception as e:
+            logger.error(f"Error in {name} for bot {bot_id}: {e}")
+
 async def run_bot_instance(bot_config):
+    bot_id = bot_config['id']
     while True:
+        app = None
+        warm_task = None
         try:
-            app = await setup_bot(bot_config['token'], bot_config['id'])
+            app = await setup_bot(bot_config['token'], bot_id)
             logger.info(f"Starting bot: {bot_config['username']} ({bot_config['name']})")
             await app.initialize()
             await app.start()
             
-            # Start Recovery Worker
-            recovery_task = asyncio.create_task(run_recovery_worker(bot_config['id'], app))
+            # file_ids salvos antes de qualquer envio; o pré-upload do que falta roda em paralelo
+            await media_cache.load(bot_id)
+            warm_task = asyncio.create_task(media_cache.warm(app.bot, bot_id, await mapped_media()))
+
+            # Recuperação e lembretes passam a enviar por este bot
+            recovery.attach(bot_id, app.bot)
+            await reminders.attach(bot_id, app.bot)
             
-            # Manual polling loop to handle conflicts gracefully
-            updater = app.updater
-            await updater.start_polling(drop_pending_updates=True)
+            if webhook_mode():
+                secret = secrets.token_urlsafe(32)
+                webhook_bots[bot_id] = (app, secret)
+                await app.bot.set_webhook(
+                    url=f"{WEBHOOK_BASE_URL}/tg/{bot_id}",
+                    secret_token=secret,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    drop_pending_updates=True,
+                )
+            else:
+                # Manual polling loop to handle conflicts gracefully
+                await app.updater.start_polling(drop_pending_updates=True)
             # Keep running until cancelled or bot is deactivated
+            seen = bot_registry.version()
             while True:
-                await asyncio.sleep(10)
-                # Check if bot still active in DB
-                all_bots = await asyncio.to_thread(database.get_all_managed_bots)
-                current = next((b for b in all_bots if b['id'] == bot_config['id']), None)
+                current = bot_registry.get(bot_id)
                 if not current or not current['is_active']:
                     logger.info(f"Bot {bot_config['name']} deactivated, stopping...")
-                    recovery_task.cancel()
-                    await updater.stop()
-                    await app.stop()
-                    await app.shutdown()
                     return
+                seen = await bot_registry.wait_for_change(seen)
         except Exception as e:
             logger.error(f"Error in bot {bot_config['name']}: {e}")
-            if 'recovery_task' in locals(): recovery_task.cancel()
-            await asyncio.sleep(10)
+        finally:
+            # Desativado, com erro ou cancelado pelo main() (bot removido): tudo é desfeito
+            if warm_task:
+                warm_task.cancel()
+            await stop_bot_instance(bot_id, app)
+        await asyncio.sleep(10)
+
+# Métricas deste processo, publicadas para o painel (/api/db_metrics?source=bot, /api/media/stats, /api/updates/stats)
+DB_METRICS_PUBLISH_INTERVAL = float(os.getenv("DB_METRICS_PUBLISH_INTERVAL", "60"))
+
+async def publish_stats():
+    while True:
+        await asyncio.sleep(DB_METRICS_PUBLISH_INTERVAL)
+        try:
+            if db_metrics.DB_METRICS_ENABLED:
+                await adatabase.set_setting(db_metrics.BOT_METRICS_KEY, json.dumps(db_metrics.snapshot(slow_limit=20)))
+            await adatabase.set_setting(media_store.MEDIA_STATS_KEY, json.dumps(media_store.stats()))
+            await adatabase.set_setting(update_processor.UPDATE_STATS_KEY, json.dumps(update_processor.stats()))
+        except Exception as e:
+            logger.error(f"Error publishing stats: {e}")
 
 async def main():
     managed_tasks = {} # {bot_id: Task}
+    if BOT_MODE == "webhook" and not WEBHOOK_BASE_URL:
+        logger.error("BOT_MODE=webhook needs WEBHOOK_BASE_URL (or RENDER_EXTERNAL_URL); falling back to polling")
+    await adatabase.preload_settings()
+    await gateway.refresh()
+    await bot_registry.start()
+    reminders.start(send_recovery_stage)
+    recovery.start(send_recovery_stage)
+    asyncio.create_task(publish_stats())
+    seen = bot_registry.version()
     
     while True:
         try:
-            active_bots = await asyncio.to_thread(database.get_all_managed_bots)
-            active_bots = [b for b in active_bots if b['is_active']]
+            active_bots = bot_registry.active()
             
             # Start new bots
             for bot in active_bots:
@@ -482,15 +476,31 @@ async def main():
                     res = await client.get(f"https://api.telegram.org/bot{token}/getMe")
                     info = res.json()
                     if info.get("ok"):
-                        database.add_managed_bot(token, "Default Bot", "@" + info["result"]["username"])
+                        await adatabase.add_managed_bot(token, "Default Bot", "@" + info["result"]["username"])
+                        await bot_registry.invalidate()
 
         except Exception as e:
             logger.error(f"Main loop error: {e}")
         
-        await asyncio.sleep(30)
+        seen = await bot_registry.wait_for_change(seen, timeout=30)
+
+async def run():
+    try:
+        await main()
+    finally:
+        await bot_registry.stop()
+        await recovery.stop()
+        await reminders.stop()
+        qr_render.shutdown()
+        await write_buffer.drain()
+        await adatabase.close_supabase()
 
 if __name__ == '__main__':
+    if BOT_MODE == "webhook":
+        # Os bots sobem junto com o painel, que recebe os updates
+        logger.error("BOT_MODE=webhook: run the panel (uvicorn painel.main:app) to serve the bots")
+        raise SystemExit(1)
     try:
-        asyncio.run(main())
+        asyncio.run(run())
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,129 @@
+import os
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+from telegram.error import BadRequest
+import adatabase
+import media_store
+
+logger = logging.getLogger(__name__)
+
+# file_id do Telegram por (bot_id, hash do conteúdo), persistido em
+# media_file_ids. Depois do primeiro upload (ou do pré-aquecimento na partida
+# do bot) cada envio é só a referência ao file_id, sem banda de upload.
+# A chave é o conteúdo e não o caminho: remapear uma mídia no painel gera um
+# hash novo, e o mesmo arquivo em caminhos diferentes reaproveita o id.
+MEDIA_WARMUP_CHAT_KEY = "media_warmup_chat_id"
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi')
+VOICE_EXTENSIONS = ('.ogg', '.oga')
+HASH_CHUNK = 1024 * 1024
+
+_hashes: Dict[str, Tuple[int, int, str]] = {}  # path -> (mtime_ns, size, sha256)
+_file_ids: Dict[Tuple[str, str], Tuple[str, str]] = {}  # (bot_id, hash) -> (media_type, file_id)
+
+def media_type_for(path: str) -> str:
+    lower = path.lower()
+    if lower.endswith(VIDEO_EXTENSIONS):
+        return "video"
+    if lower.endswith(VOICE_EXTENSIONS):
+        return "voice"
+    return "photo"
+
+def _digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+async def content_hash(path: str) -> Optional[str]:
+    """sha256 of the file, recomputed only when its mtime or size changes."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    memo = _hashes.get(path)
+    if memo and memo[0] == st.st_mtime_ns and memo[1] == st.st_size:
+        return memo[2]
+    digest = await asyncio.to_thread(_digest, path)
+    _hashes[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+async def load(bot_id: str):
+    """Loads the persisted file_ids of a bot."""
+    for row in await adatabase.get_media_file_ids(bot_id):
+        _file_ids[(bot_id, row['content_hash'])] = (row['media_type'], row['file_id'])
+
+def _message_file_id(message, media_type: str) -> Optional[str]:
+    if media_type == "photo":
+        return message.photo[-1].file_id if message.photo else None
+    media = getattr(message, media_type, None)
+    return media.file_id if media else None
+
+def _remember(bot_id: str, digest: str, media_type: str, file_id: Optional[str]):
+    if not file_id or _file_ids.get((bot_id, digest)) == (media_type, file_id):
+        return
+    _file_ids[(bot_id, digest)] = (media_type, file_id)
+    asyncio.create_task(adatabase.save_media_file_id(bot_id, digest, media_type, file_id))
+
+async def _forget(bot_id: str, digest: str):
+    # Aguardado: o delete não pode cair depois do save do id novo
+    if _file_ids.pop((bot_id, digest), None):
+        await adatabase.delete_media_file_id(bot_id, digest)
+
+async def send_media(bot, bot_id: str, chat_id: int, path: str, media_type: Optional[str] = None, **kwargs):
+    """
+    Sends path as photo/video/voice, by cached file_id when there is one,
+    uploading (and caching the new id) otherwise. Raises on Telegram errors.
+    """
+    media_type = media_type or media_type_for(path)
+    send = getattr(bot, f"send_{media_type}")
+    digest = await content_hash(path)
+    cached = _file_ids.get((bot_id, digest)) if digest else None
+    if cached and cached[0] == media_type:
+        try:
+            return await send(chat_id=chat_id, **{media_type: cached[1]}, **kwargs)
+        except BadRequest as e:
+            # Só erro de file_id (id revogado, bot recriado) cai para o upload
+            if "file" not in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id rejected for {path} on bot {bot_id}: {e}")
+            await _forget(bot_id, digest)
+    async with media_store.open_input(path) as f:
+        message = await send(chat_id=chat_id, **{media_type: f}, **kwargs)
+    if digest:
+        _remember(bot_id, digest, media_type, _message_file_id(message, media_type))
+    return message
+
+async def warm(bot, bot_id: str, assets: List[Tuple[str, Optional[str]]]):
+    """
+    Uploads every asset without a cached file_id once, to the chat in the
+    media_warmup_chat_id setting (or MEDIA_WARMUP_CHAT_ID), deleting the
+    message afterwards. Without that chat, ids are cached on first send.
+    """
+    chat_id = await adatabase.get_setting(MEDIA_WARMUP_CHAT_KEY) or os.getenv("MEDIA_WARMUP_CHAT_ID")
+    if not chat_id:
+        return
+    uploaded = 0
+    for path, media_type in dict.fromkeys(assets):
+        media_type = media_type or media_type_for(path)
+        digest = await content_hash(path)
+        if not digest:
+            continue
+        cached = _file_ids.get((bot_id, digest))
+        if cached and cached[0] == media_type:
+            continue
+        try:
+            async with media_store.open_input(path) as f:
+                message = await getattr(bot, f"send_{media_type}")(chat_id=chat_id, **{media_type: f}, disable_notification=True)
+            _remember(bot_id, digest, media_type, _message_file_id(message, media_type))
+            uploaded += 1
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            except Exception:
+                pass
+        except Exception as e:
+            logger.error(f"Media warm-up failed for {path} on bot {bot_id}: {e}")
+    if uploaded:
+        logger.info(f"Pre-uploaded {uploaded} media assets for bot {bot_id}")
@@ -0,0 +1,186 @@
+import io
+import os
+import mmap
+import time
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional
+from telegram import InputFile
+import adatabase
+
+logger = logging.getLogger(__name__)
+
+# Mídias de saída mapeadas em memória: cada arquivo é aberto e mapeado uma
+# vez e os envios leem fatias da mesma página de cache, sem um open() por
+# envio (que vazava descritores) nem reler o arquivo do disco.
+# O número de arquivos mapeados é limitado (LRU); um arquivo ainda em upload
+# só é desmapeado quando o último leitor fecha. O painel grava
+# "media_version" em settings ao remapear mídia e os processos descartam os
+# mapeamentos antigos na próxima leitura.
+MEDIA_STORE_MAX_ASSETS = int(os.getenv("MEDIA_STORE_MAX_ASSETS", "32"))
+MEDIA_VERSION_KEY = "media_version"
+MEDIA_STATS_KEY = "media_store_bot"
+
+class _Asset:
+    __slots__ = ("path", "map", "view", "size", "stamp", "readers", "retired", "sends")
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self.size = st.st_size
+            # mmap guarda o próprio descritor; o arquivo pode fechar já
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else None
+        self.view = memoryview(self.map) if self.map is not None else memoryview(b"")
+        self.readers = 0
+        self.retired = False
+        self.sends = 0
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Alguma fatia de read() ainda viva (ex.: presa num traceback):
+                # o mapeamento é desfeito quando ela for coletada
+                pass
+
+class MediaReader(io.RawIOBase):
+    """Read-only, seekable file over a mapped asset. read() hands out memoryview slices of the mapping."""
+
+    def __init__(self, asset: _Asset):
+        super().__init__()
+        self._asset = asset
+        self._pos = 0
+        self.name = os.path.basename(asset.path)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> memoryview:
+        # Fatia da memoryview do mapeamento, sem cópia para um bytes intermediário:
+        # o multipart do httpx repassa o pedaço como veio e a única cópia é a do
+        # h11/TLS montando o que vai para o socket (sendfile não serve com TLS).
+        view = self._asset.view
+        end = len(view) if size is None or size < 0 else min(len(view), self._pos + size)
+        chunk = view[self._pos:max(end, self._pos)]
+        self._pos += len(chunk)
+        _stats["bytes_served"] += len(chunk)
+        return chunk
+
+    def readall(self) -> memoryview:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        view = self._asset.view
+        n = max(0, min(len(buffer), len(view) - self._pos))
+        buffer[:n] = view[self._pos:self._pos + n]
+        self._pos += n
+        _stats["bytes_served"] += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._asset.size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            _release(self._asset)
+        super().close()
+
+_assets: "OrderedDict[str, _Asset]" = OrderedDict()
+_retired: Dict[int, _Asset] = {}
+_version: Optional[str] = None
+_stats: Dict[str, Any] = {"maps": 0, "hits": 0, "evictions": 0, "invalidations": 0, "bytes_served": 0}
+
+def _retire(asset: _Asset):
+    asset.retired = True
+    if asset.readers:
+        _retired[id(asset)] = asset
+    else:
+        asset.close()
+
+def _release(asset: _Asset):
+    asset.readers -= 1
+    if asset.retired and not asset.readers:
+        _retired.pop(id(asset), None)
+        asset.close()
+
+def _evict():
+    while len(_assets) > MEDIA_STORE_MAX_ASSETS:
+        _, asset = _assets.popitem(last=False)
+        _stats["evictions"] += 1
+        _retire(asset)
+
+def drop(path: Optional[str] = None):
+    """Unmaps path (or everything); assets still being read close with their last reader."""
+    for key in [path] if path else list(_assets):
+        asset = _assets.pop(key, None)
+        if asset:
+            _retire(asset)
+
+def _asset(path: str) -> _Asset:
+    asset = _assets.get(path)
+    if asset is not None:
+        st = os.stat(path)
+        # Arquivo substituído no disco (upload com o mesmo nome): mapeia de novo
+        if asset.stamp == (st.st_ino, st.st_mtime_ns, st.st_size):
+            _assets.move_to_end(path)
+            _stats["hits"] += 1
+            return asset
+        drop(path)
+    asset = _Asset(path)
+    _assets[path] = asset
+    _stats["maps"] += 1
+    _evict()
+    return asset
+
+async def _check_version():
+    global _version
+    version = await adatabase.get_setting(MEDIA_VERSION_KEY)
+    if version != _version:
+        if _version is not None:
+            _stats["invalidations"] += 1
+            drop()
+        _version = version
+
+@asynccontextmanager
+async def open_input(path: str, filename: Optional[str] = None):
+    """InputFile streaming path from its mapping; the mapping is pinned until the block exits."""
+    await _check_version()
+    asset = _asset(path)
+    asset.readers += 1
+    asset.sends += 1
+    reader = MediaReader(asset)
+    try:
+        # read_file_handle=False: o cliente HTTP lê em pedaços em vez de um read() do arquivo inteiro
+        yield InputFile(reader, filename=filename or reader.name, read_file_handle=False)
+    finally:
+        reader.close()
+
+async def invalidate():
+    """Called by the panel after media remaps: every process drops its mappings on next use."""
+    drop()
+    await adatabase.set_setting(MEDIA_VERSION_KEY, str(time.time_ns()))
+
+def stats() -> Dict[str, Any]:
+    live = list(_assets.values()) + list(_retired.values())
+    return {
+        **_stats,
+        "mapped_assets": len(_assets),
+        "retired_pending": len(_retired),
+        "open_handles": sum(1 for a in live if a.map is not None),
+        "open_readers": sum(a.readers for a in live),
+        "mapped_bytes": sum(a.size for a in live),
+        "assets": {a.path: {"size": a.size, "sends": a.sends, "readers": a.readers} for a in _assets.values()},
+    }
@@ -0,0 +1,48 @@
+-- Dashboard metrics in one round trip (used by database.get_metrics).
+-- Apply in the Supabase SQL editor or with `supabase db push`.
+
+-- Covers the status filters below and lets SUM(amount) run as an index-only scan.
+create index if not exists transactions_status_amount_idx
+    on public.transactions (status) include (amount);
+
+create or replace function public.dashboard_metrics(estimated boolean default false)
+returns json
+language sql
+stable
+as $$
+    with tx as (
+        select
+            count(*) filter (where status = 'confirmed')               as total_sales,
+            coalesce(sum(amount) filter (where status = 'confirmed'), 0) as total_revenue,
+            count(*) filter (where status = 'pending')                 as pending_pix
+        from public.transactions
+        where status in ('confirmed', 'pending')
+    ),
+    -- Estimated mode: planner statistics instead of counting rows.
+    -- Requires ANALYZE (autovacuum keeps it fresh on busy tables).
+    rel as (
+        select relname, greatest(reltuples, 0) as reltuples
+        from pg_class
+        where oid in ('public.users'::regclass, 'public.transactions'::regclass)
+    ),
+    status_freq as (
+        select v.val, v.freq
+        from pg_stats s
+        cross join lateral unnest(s.most_common_vals::text::text[], s.most_common_freqs) as v(val, freq)
+        where s.schemaname = 'public' and s.tablename = 'transactions' and s.attname = 'status'
+    )
+    select json_build_object(
+        'total_users', case when estimated
+            then (select reltuples::bigint from rel where relname = 'users')
+            else (select count(*) from public.users) end,
+        'total_sales', case when estimated
+            then coalesce((select round(f.freq * r.reltuples)::bigint from status_freq f, rel r
+                           where f.val = 'confirmed' and r.relname = 'transactions'), 0)
+            else (select total_sales from tx) end,
+        'total_revenue', (select total_revenue from tx),
+        'pending_pix', case when estimated
+            then coalesce((select round(f.freq * r.reltuples)::bigint from status_freq f, rel r
+                           where f.val = 'pending' and r.relname = 'transactions'), 0)
+            else (select pending_pix from tx) end
+    );
+$$;
@@ -0,0 +1,32 @@
+-- Bucketed revenue time series (used by database.get_revenue_series).
+
+-- Confirmed sales by date: the range scan below never touches pending/failed rows.
+create index if not exists transactions_confirmed_created_at_idx
+    on public.transactions (created_at) include (amount, bot_id, product_id)
+    where status = 'confirmed';
+
+create or replace function public.revenue_series(
+    p_start timestamptz,
+    p_end timestamptz,
+    p_granularity text default 'day',
+    p_tz text default 'America/Sao_Paulo',
+    p_bot_id text default null,
+    p_product_id text default null
+)
+returns table (bucket timestamp, total numeric, sales bigint)
+language sql
+stable
+as $$
+    select
+        date_trunc(p_granularity, t.created_at at time zone p_tz) as bucket,
+        coalesce(sum(t.amount), 0) as total,
+        count(*) as sales
+    from public.transactions t
+    where t.status = 'confirmed'
+      and t.created_at >= p_start
+      and t.created_at < p_end
+      and (p_bot_id is null or t.bot_id::text = p_bot_id)
+      and (p_product_id is null or t.product_id = p_product_id)
+    group by 1
+    order by 1;
+$$;
@@ -0,0 +1,29 @@
+-- Funnel stages in one grouped query (used by database.get_funnel_stats).
+
+create index if not exists funnel_events_created_at_idx
+    on public.funnel_events (created_at) include (event_type, user_id, bot_id);
+
+create index if not exists funnel_events_bot_created_at_idx
+    on public.funnel_events (bot_id, created_at) include (event_type, user_id);
+
+create or replace function public.funnel_stats(
+    p_stages text[],
+    p_start timestamptz default null,
+    p_end timestamptz default null,
+    p_bot_id text default null
+)
+returns table (event_type text, events bigint, users bigint)
+language sql
+stable
+as $$
+    select
+        e.event_type::text,
+        count(*) as events,
+        count(distinct e.user_id) as users
+    from public.funnel_events e
+    where e.event_type = any(p_stages)
+      and (p_start is null or e.created_at >= p_start)
+      and (p_end is null or e.created_at < p_end)
+      and (p_bot_id is null or e.bot_id::text = p_bot_id)
+    group by e.event_type;
+$$;
@@ -0,0 +1,3 @@
+-- Pending Pix lookups by age (database.get_pending_automations).
+create index if not exists transactions_status_created_at_idx
+    on public.transactions (status, created_at);
@@ -0,0 +1,85 @@
+-- Revenue attribution rollup: day x bot x utm_source x utm_medium x utm_campaign.
+-- Kept up to date by a trigger on transactions, so the status update done by
+-- database.update_transaction_status() also moves the sale into (or out of)
+-- the rollup in the same statement. Read by database.get_revenue_by_utm().
+
+create table if not exists public.utm_revenue_daily (
+    day date not null,
+    bot_id text not null default '',
+    utm_source text not null default '',
+    utm_medium text not null default '',
+    utm_campaign text not null default '',
+    sales bigint not null default 0,
+    revenue numeric not null default 0,
+    primary key (day, bot_id, utm_source, utm_medium, utm_campaign)
+);
+
+create index if not exists utm_revenue_daily_bot_day_idx
+    on public.utm_revenue_daily (bot_id, day);
+
+create or replace function public.utm_rollup_apply()
+returns trigger
+language plpgsql
+as $$
+declare
+    v_sign int;
+    v_tx public.transactions;
+    v_user record;
+begin
+    if tg_op = 'UPDATE' and new.status = 'confirmed' and old.status is distinct from 'confirmed' then
+        v_sign := 1; v_tx := new;
+    elsif tg_op = 'UPDATE' and old.status = 'confirmed' and new.status is distinct from 'confirmed' then
+        v_sign := -1; v_tx := old;
+    elsif tg_op = 'INSERT' and new.status = 'confirmed' then
+        v_sign := 1; v_tx := new;
+    else
+        return new;
+    end if;
+
+    select u.utm_source, u.utm_medium, u.utm_campaign into v_user
+    from public.users u where u.id = v_tx.user_id;
+
+    insert into public.utm_revenue_daily as r (day, bot_id, utm_source, utm_medium, utm_campaign, sales, revenue)
+    values (
+        (coalesce(v_tx.confirmed_at, v_tx.created_at, now()) at time zone 'America/Sao_Paulo')::date,
+        coalesce(v_tx.bot_id::text, ''),
+        coalesce(v_user.utm_source, v_tx.metadata->>'utm_source', ''),
+        coalesce(v_user.utm_medium, v_tx.metadata->>'utm_medium', ''),
+        coalesce(v_user.utm_campaign, v_tx.metadata->>'utm_campaign', ''),
+        v_sign,
+        v_sign * coalesce(v_tx.amount, 0)
+    )
+    on conflict (day, bot_id, utm_source, utm_medium, utm_campaign) do update
+        set sales = r.sales + excluded.sales,
+            revenue = r.revenue + excluded.revenue;
+    return new;
+end;
+$$;
+
+drop trigger if exists transactions_utm_rollup on public.transactions;
+create trigger transactions_utm_rollup
+    after insert or update of status on public.transactions
+    for each row execute function public.utm_rollup_apply();
+
+-- Full recompute (initial backfill, or to repair drift).
+create or replace function public.rebuild_utm_rollup()
+returns void
+language sql
+as $$
+    delete from public.utm_revenue_daily;
+    insert into public.utm_revenue_daily (day, bot_id, utm_source, utm_medium, utm_campaign, sales, revenue)
+    select
+        (coalesce(t.confirmed_at, t.created_at) at time zone 'America/Sao_Paulo')::date,
+        coalesce(t.bot_id::text, ''),
+        coalesce(u.utm_source, t.metadata->>'utm_source', ''),
+        coalesce(u.utm_medium, t.metadata->>'utm_medium', ''),
+        coalesce(u.utm_campaign, t.metadata->>'utm_campaign', ''),
+        count(*),
+        coalesce(sum(t.amount), 0)
+    from public.transactions t
+    left join public.users u on u.id = t.user_id
+    where t.status = 'confirmed'
+    group by 1, 2, 3, 4, 5;
+$$;
+
+select public.rebuild_utm_rollup();
@@ -0,0 +1,19 @@
+-- Keyset pagination on (created_at, id) (database.get_*_page / iter_*).
+
+create index if not exists transactions_created_at_id_idx
+    on public.transactions (created_at desc, id desc);
+
+create index if not exists transactions_bot_created_at_id_idx
+    on public.transactions (bot_id, created_at desc, id desc);
+
+create index if not exists users_created_at_id_idx
+    on public.users (created_at desc, id desc);
+
+create index if not exists users_bot_created_at_id_idx
+    on public.users (bot_id, created_at desc, id desc);
+
+create index if not exists abandoned_checkouts_created_at_id_idx
+    on public.abandoned_checkouts (created_at desc, id desc);
+
+create index if not exists abandoned_checkouts_bot_created_at_id_idx
+    on public.abandoned_checkouts (bot_id, created_at desc, id desc);
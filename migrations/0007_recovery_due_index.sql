@@ -0,0 +1,18 @@
+-- Due-time scheduling for abandoned-checkout recovery (database.get_due_abandoned).
+-- Stage delays mirror database.RECOVERY_STAGE_DELAYS: 10 min, 1 h, 24 h, 3 days.
+
+alter table public.abandoned_checkouts
+    add column if not exists next_due_at timestamptz;
+
+update public.abandoned_checkouts
+set next_due_at = created_at + case last_stage
+        when 0 then interval '10 minutes'
+        when 1 then interval '1 hour'
+        when 2 then interval '24 hours'
+        when 3 then interval '3 days'
+    end
+where status = 'pending' and next_due_at is null;
+
+create index if not exists abandoned_checkouts_due_idx
+    on public.abandoned_checkouts (bot_id, next_due_at)
+    where status = 'pending';
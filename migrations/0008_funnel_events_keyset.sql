@@ -0,0 +1,7 @@
+-- Keyset scans over funnel_events for streaming exports (database.iter_funnel_events).
+
+create index if not exists funnel_events_created_at_id_idx
+    on public.funnel_events (created_at desc, id desc);
+
+create index if not exists funnel_events_bot_created_at_id_idx
+    on public.funnel_events (bot_id, created_at desc, id desc);
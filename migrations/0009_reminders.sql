@@ -0,0 +1,12 @@
+-- Persisted inactivity reminders (reminders.py / database.save_reminder).
+-- One row per (bot, user): last stage sent and when the next one is due.
+
+create table if not exists public.reminders (
+    bot_id text not null,
+    user_id bigint not null,
+    chat_id bigint not null,
+    stage integer not null default 0,
+    due_at timestamptz not null,
+    updated_at timestamptz not null default now(),
+    primary key (bot_id, user_id)
+);
@@ -0,0 +1,11 @@
+-- Telegram file_id per (bot, media content hash) (media_cache.py).
+-- file_ids are only valid for the bot that uploaded the file.
+
+create table if not exists public.media_file_ids (
+    bot_id text not null,
+    content_hash text not null,
+    media_type text not null,
+    file_id text not null,
+    updated_at timestamptz not null default now(),
+    primary key (bot_id, content_hash)
+);
@@ -0,0 +1,8 @@
+-- Failed-attempt counter for abandoned-checkout recovery (database.update_abandoned_checkouts).
+-- A transient send failure postpones next_due_at with exponential backoff
+-- (database.recovery_retry_due) and bumps attempts; after
+-- database.RECOVERY_MAX_ATTEMPTS in a row the checkout is marked failed, so
+-- rows that keep failing do not stay at the head of get_due_abandoned.
+
+alter table public.abandoned_checkouts
+    add column if not exists attempts integer not null default 0;
@@ -8,19 +8,32 @@ if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
 from fastapi import FastAPI, Request, Form, Depends, HTTPException, status, Body, File, UploadFile
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 
 # Agora importa do diretório pai corretamente
 import database
+import adatabase
+import content
+import write_buffer
+import bot_registry
+import db_metrics
+import recovery
+import media_store
+import update_processor
 import main as bot_main
-from api import utmfy, tiktok
+from api import utmfy, tiktok, gateway
+import io
+import csv
+import json
+import zlib
 import logging
 import asyncio
 import threading
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from typing import Optional
+from zoneinfo import ZoneInfo
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -59,6 +72,10 @@ async def startup_event():
     if RENDER_URL:
         asyncio.create_task(keep_alive())
     
+    await adatabase.preload_settings()
+    # Modo webhook: os bots rodam neste processo e recebem updates em /tg/{bot_id}
+    if bot_main.BOT_MODE == "webhook":
+        app.state.bot_task = asyncio.create_task(bot_main.run())
     logger.info("Painel Administrativo iniciado com sucesso.")
 
 @app.on_event("shutdown")
@@ -69,6 +86,13 @@ async def shutdown_event():
         await app.state.bot_app.stop()
         await app.state.bot_app.shutdown()
         logger.info("Bot Telegram desligado com sucesso.")
+    if hasattr(app.state, "bot_task"):
+        app.state.bot_task.cancel()
+        await asyncio.gather(app.state.bot_task, return_exceptions=True)
+        logger.info("Bots (webhook) desligados com sucesso.")
+    await write_buffer.drain()
+    await adatabase.close_supabase()
+    database.close_supabase()
 
 # Initialize database
 database.init_db()
@@ -113,14 +137,19 @@ async def logout(request: Request):
     authenticated_users.discard(request.client.host)
     return RedirectResponse(url="/")
 
+async def load_funnel(days: Optional[int] = None, bot_id: Optional[str] = None, unique: bool = False):
+    """Shared funnel loader for /dashboard, /funil and /api/stats/funnel."""
+    start = datetime.now(timezone.utc) - timedelta(days=days) if days else None
+    return await adatabase.get_funnel_stats(start=start, bot_id=bot_id or None, unique=unique)
+
 # Dashboard
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request):
+async def dashboard(request: Request, days: Optional[int] = None, bot_id: Optional[str] = None, unique: bool = False):
     if not get_current_user(request): return RedirectResponse(url="/")
     try:
-        metrics = database.get_metrics()
-        recent = database.get_all_transactions(10)
-        funnel = database.get_funnel_stats()
+        metrics = await adatabase.get_metrics()
+        recent = await adatabase.get_all_transactions(10)
+        funnel = await load_funnel(days, bot_id, unique)
         return templates.TemplateResponse("dashboard.html", {"request": request, "metrics": metrics, "recent": recent, "funnel": funnel, "active_page": "dashboard"})
     except Exception as e:
         import traceback
@@ -129,38 +158,38 @@ async def dashboard(request: Request):
         return HTMLResponse(content=f"<h1>Erro Interno 500</h1><pre>{e}</pre>", status_code=500)
 
 @app.get("/funil", response_class=HTMLResponse)
-async def funnel_page(request: Request):
+async def funnel_page(request: Request, days: Optional[int] = None, bot_id: Optional[str] = None, unique: bool = False):
     if not get_current_user(request): return RedirectResponse(url="/")
-    stats = database.get_funnel_stats()
+    stats = await load_funnel(days, bot_id, unique)
     return templates.TemplateResponse("funil.html", {"request": request, "stats": stats, "active_page": "funil"})
 
 @app.get("/bots", response_class=HTMLResponse)
 async def bots_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    bots = database.get_all_managed_bots()
+    bots = await adatabase.get_all_managed_bots()
     return templates.TemplateResponse("bots.html", {"request": request, "bots": bots, "active_page": "bots"})
 
 # Vendas Page
 @app.get("/vendas", response_class=HTMLResponse)
 async def vendas(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    transactions = database.get_all_transactions(100)
+    transactions = await adatabase.get_all_transactions(100)
     return templates.TemplateResponse("vendas.html", {"request": request, "transactions": transactions, "active_page": "vendas"})
 
 @app.get("/usuarios", response_class=HTMLResponse)
 async def usuarios(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    users = database.get_all_users(1000)
+    users = await adatabase.get_all_users(1000)
     return templates.TemplateResponse("usuarios.html", {"request": request, "users": users, "active_page": "usuarios"})
 
 @app.get("/usuarios/{user_id}", response_class=HTMLResponse)
 async def user_detail(request: Request, user_id: int):
     if not get_current_user(request): return RedirectResponse(url="/")
-    user = database.get_user(user_id)
+    user = await adatabase.get_user(user_id)
     if not user: raise HTTPException(status_code=404, detail="Usuário não encontrado")
     
-    events = database.get_user_events(user_id)
-    transactions = database.get_user_transactions(user_id)
+    events = await adatabase.get_user_events(user_id)
+    transactions = await adatabase.get_user_transactions(user_id)
     
     return templates.TemplateResponse("usuario_detalhe.html", {
         "request": request, 
@@ -174,13 +203,14 @@ async def user_detail(request: Request, user_id: int):
 @app.get("/produtos", response_class=HTMLResponse)
 async def list_products(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    prods = database.get_all_products_raw()
+    prods = await adatabase.get_all_products_raw()
     return templates.TemplateResponse("produtos.html", {"request": request, "products": prods, "active_page": "produtos"})
 
 @app.post("/produtos/update")
 async def update_product_route(request: Request, p_id: str = Form(...), name: str = Form(...), price: float = Form(...), desc: str = Form(...), active: int = Form(...)):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.update_product(p_id, name, price, desc, active)
+    await adatabase.update_product(p_id, name, price, desc, active)
+    await asyncio.to_thread(content.invalidate)
     return RedirectResponse(url="/produtos", status_code=status.HTTP_303_SEE_OTHER)
 
 # **NOVO: Recuperação de Vendas**
@@ -188,8 +218,8 @@ async def update_product_route(request: Request, p_id: str = Form(...), name: st
 async def recovery_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
     # All pending transactions
-    txs = [t for t in database.get_all_transactions(100) if t['status'] == 'pending']
-    recovery_msg = database.get_setting("recovery_message")
+    txs = [t for t in await adatabase.get_all_transactions(100) if t['status'] == 'pending']
+    recovery_msg = await adatabase.get_setting("recovery_message")
     return templates.TemplateResponse("recuperacao.html", {"request": request, "transactions": txs, "recovery_msg": recovery_msg, "active_page": "recuperacao"})
 
 @app.post("/recuperar")
@@ -204,7 +234,7 @@ async def trigger_recovery(request: Request, user_id: int = Form(...), tx_id: st
 @app.get("/comunicacao", response_class=HTMLResponse)
 async def comms_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    user_count = database.get_metrics()['total_users']
+    user_count = (await adatabase.get_metrics())['total_users']
     return templates.TemplateResponse("comunicacao.html", {"request": request, "user_count": user_count, "active_page": "comunicacao"})
 
 @app.post("/api/broadcast")
@@ -217,9 +247,7 @@ async def api_broadcast(
 ):
     if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
     
-    # Get all users for this bot
-    users = database.get_all_users() # Or filter by bot if tracked
-    bot_config = next((b for b in database.get_all_managed_bots() if b['id'] == bot_id), None)
+    bot_config = next((b for b in await adatabase.get_all_managed_bots() if b['id'] == bot_id), None)
     
     if not bot_config:
         return JSONResponse({"error": "Bot não encontrado"}, status_code=404)
@@ -247,11 +275,16 @@ async def api_broadcast(
             logger.error(f"Broadcast fail for user {u_id}: {e}")
             fail_count += 1
 
-    # Chunking to avoid rate limits/timeouts
-    for i in range(0, len(users), 20):
-        chunk = users[i:i+20]
-        await asyncio.gather(*(send_to_user(u['id']) for u in chunk))
-        await asyncio.sleep(1) # Small pause
+    # Percorre todos os usuários por cursor, em blocos de 20 (rate limit)
+    chunk = []
+    async for u in adatabase.iter_users():
+        chunk.append(u['id'])
+        if len(chunk) == 20:
+            await asyncio.gather(*(send_to_user(u_id) for u_id in chunk))
+            chunk = []
+            await asyncio.sleep(1) # Small pause
+    if chunk:
+        await asyncio.gather(*(send_to_user(u_id) for u_id in chunk))
     
     return JSONResponse({
         "status": "ok", 
@@ -263,8 +296,8 @@ async def api_broadcast(
 @app.get("/conteudo", response_class=HTMLResponse)
 async def content_editor(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    content_list = database.get_all_content()
-    products = database.get_all_products_raw()
+    content_list = await adatabase.get_all_content()
+    products = await adatabase.get_all_products_raw()
     return templates.TemplateResponse("conteudo.html", {
         "request": request, 
         "content_list": content_list, 
@@ -275,64 +308,184 @@ async def content_editor(request: Request):
 @app.post("/conteudo/add")
 async def add_content(request: Request, key: str = Form(...), value: str = Form(...), description: str = Form(...), btn_text: str = Form(""), btn_url: str = Form("")):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.update_bot_content_advanced(key, value, description, [], btn_text, btn_url)
+    await adatabase.update_bot_content_advanced(key, value, description, [], btn_text, btn_url)
+    await asyncio.to_thread(content.invalidate)
     return RedirectResponse(url="/conteudo", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.post("/conteudo/update")
 async def update_content(request: Request, key: str = Form(...), value: str = Form(...), description: str = Form(...), products: list = Form([]), btn_text: str = Form(""), btn_url: str = Form("")):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.update_bot_content_advanced(key, value, description, products, btn_text, btn_url)
+    await adatabase.update_bot_content_advanced(key, value, description, products, btn_text, btn_url)
+    await asyncio.to_thread(content.invalidate)
     return RedirectResponse(url="/conteudo", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.post("/conteudo/delete")
 async def delete_content(request: Request, key: str = Form(...)):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.delete_bot_content(key)
+    await adatabase.delete_bot_content(key)
+    await asyncio.to_thread(content.invalidate)
     return RedirectResponse(url="/conteudo", status_code=status.HTTP_303_SEE_OTHER)
 
 # **NOVO V3: Automação**
 @app.get("/automacao", response_class=HTMLResponse)
 async def automation_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    rules = database.get_automation_rules()
+    rules = await adatabase.get_automation_rules()
     return templates.TemplateResponse("automacao.html", {"request": request, "rules": rules, "active_page": "automacao"})
 
 @app.post("/automacao/update")
 async def update_automation(request: Request, rule_id: int = Form(...), delay: int = Form(...), message: str = Form(...), active: int = Form(...)):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.update_automation_rule(rule_id, delay, message, active)
+    await adatabase.update_automation_rule(rule_id, delay, message, active)
     return RedirectResponse(url="/automacao", status_code=status.HTTP_303_SEE_OTHER)
 
 # **NOVO: Stats API para Gráficos**
 @app.get("/api/stats/revenue")
-async def get_chart_data():
-    data = database.get_revenue_stats(7)
-    # Reverse for chronological order
-    data.reverse()
-    labels = [d['day'] for d in data]
+async def get_chart_data(periods: int = 7, granularity: str = "day", tz: Optional[str] = None, bot_id: Optional[str] = None, product_id: Optional[str] = None):
+    if granularity not in database.REVENUE_GRANULARITIES:
+        return JSONResponse({"error": "granularity deve ser hour, day ou week"}, status_code=400)
+    periods = max(1, min(periods, 366))
+    data = await adatabase.get_revenue_series(granularity=granularity, tz=tz, bot_id=bot_id, product_id=product_id, periods=periods)
+    # Already in chronological order
+    labels = [d['bucket'] for d in data]
     values = [d['total'] for d in data]
     return JSONResponse({"labels": labels, "values": values})
 
 @app.get("/api/stats/sources")
-async def get_source_data():
-    data = database.get_revenue_by_source()
-    labels = [d['source'] for d in data]
+async def get_source_data(group_by: str = "utm_source", days: Optional[int] = None, bot_id: Optional[str] = None, utm_source: Optional[str] = None, utm_medium: Optional[str] = None):
+    if group_by not in database.UTM_DIMENSIONS:
+        return JSONResponse({"error": "group_by inválido"}, status_code=400)
+    if group_by == "utm_source" and not (days or bot_id):
+        data = [{"key": d['source'], "total": d['total']} for d in await adatabase.get_revenue_by_source()]
+    else:
+        start_day = (datetime.now(timezone.utc) - timedelta(days=days)).date().isoformat() if days else None
+        filters = {"utm_source": utm_source, "utm_medium": utm_medium}
+        data = await adatabase.get_revenue_by_utm(group_by, start_day, None, bot_id, filters) or []
+    labels = [d['key'] for d in data]
     values = [d['total'] for d in data]
     return JSONResponse({"labels": labels, "values": values})
 
 @app.get("/api/stats/funnel")
-async def api_funnel_stats():
-    # In a real app, this could support date filters. For now, total lifetime.
-    stats = database.get_funnel_stats()
+async def api_funnel_stats(days: Optional[int] = None, bot_id: Optional[str] = None, unique: bool = False):
+    # Sem days = total desde o início
+    stats = await load_funnel(days, bot_id, unique)
     return JSONResponse(stats)
 
+# **Listagens paginadas (cursor em created_at,id)**
+PAGE_LOADERS = {
+    "transactions": adatabase.get_transactions_page,
+    "users": adatabase.get_users_page,
+    "abandoned_checkouts": adatabase.get_abandoned_checkouts_page,
+}
+
+@app.get("/api/list/{table}")
+async def api_list_page(table: str, request: Request, cursor: Optional[str] = None, limit: int = database.PAGE_DEFAULT_LIMIT, bot_id: Optional[str] = None):
+    if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    loader = PAGE_LOADERS.get(table)
+    if not loader:
+        return JSONResponse({"error": "Tabela inválida"}, status_code=404)
+    try:
+        page = await loader(cursor=cursor, limit=limit, bot_id=bot_id)
+    except ValueError:
+        return JSONResponse({"error": "cursor inválido"}, status_code=400)
+    return JSONResponse(page)
+
+# **Exportação (CSV / NDJSON em streaming)**
+# Percorre a tabela com os iteradores de keyset e manda cada lote direto na
+# resposta (chunked), então a memória não cresce com o tamanho da exportação.
+EXPORT_SOURCES = {
+    "transactions": adatabase.iter_transactions,
+    "users": adatabase.iter_users,
+    "funnel_events": adatabase.iter_funnel_events,
+    "abandoned_checkouts": adatabase.iter_abandoned_checkouts,
+}
+EXPORT_FLUSH_ROWS = 500
+
+def _parse_export_date(value: Optional[str], end: bool = False) -> Optional[datetime]:
+    """ISO date or datetime (naive = REPORT_TIMEZONE). A bare date as `until` covers that whole day."""
+    if not value:
+        return None
+    dt = database._parse_ts(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo(database.REPORT_TIMEZONE))
+    if end and len(value) == 10:
+        dt += timedelta(days=1)
+    return dt
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return value
+
+async def _export_stream(rows, fmt: str, compress: bool):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits 31 = formato gzip
+    buffer = io.StringIO()
+    writer = None
+    pending = 0
+
+    def take() -> bytes:
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    try:
+        async for row in rows:
+            if fmt == "csv":
+                if writer is None:
+                    # Colunas da primeira linha; as tabelas têm esquema fixo
+                    writer = csv.DictWriter(buffer, fieldnames=list(row), extrasaction="ignore")
+                    writer.writeheader()
+                writer.writerow({k: _csv_value(v) for k, v in row.items()})
+            else:
+                buffer.write(json.dumps(row, ensure_ascii=False, default=str))
+                buffer.write("\n")
+            pending += 1
+            if pending >= EXPORT_FLUSH_ROWS:
+                pending = 0
+                chunk = take()
+                if chunk:
+                    yield chunk
+    except Exception as e:
+        # Cabeçalhos já foram enviados: derruba a conexão para o arquivo não chegar truncado como se estivesse completo
+        logger.error(f"Export aborted: {e}")
+        raise
+    tail = take()
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
+
+@app.get("/api/export/{table}")
+async def api_export(table: str, request: Request, format: str = "csv", gzip: bool = False, bot_id: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None):
+    if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    source = EXPORT_SOURCES.get(table)
+    if not source:
+        return JSONResponse({"error": "Tabela inválida"}, status_code=404)
+    if format not in ("csv", "ndjson"):
+        return JSONResponse({"error": "Formato inválido (csv ou ndjson)"}, status_code=400)
+    try:
+        since_dt = _parse_export_date(since)
+        until_dt = _parse_export_date(until, end=True)
+    except ValueError:
+        return JSONResponse({"error": "Data inválida (use AAAA-MM-DD ou ISO 8601)"}, status_code=400)
+
+    filename = f"{table}_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson")
+    rows = source(bot_id=bot_id, since=since_dt, until=until_dt)
+    return StreamingResponse(
+        _export_stream(rows, format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"},
+    )
+
 @app.get("/api/dashboard/layout")
 async def get_dashboard_layout(request: Request):
     user = get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
     
     # We use a key like dashboard_layout_username
-    layout = database.get_setting(f"dashboard_layout_{user}", "{}")
+    layout = await adatabase.get_setting(f"dashboard_layout_{user}", "{}")
     return JSONResponse({"layout": layout})
 
 @app.post("/api/dashboard/layout")
@@ -342,7 +495,7 @@ async def save_dashboard_layout(request: Request, data: dict = Body(...)):
     
     layout = data.get("layout")
     if layout:
-        database.set_setting(f"dashboard_layout_{user}", layout)
+        await adatabase.set_setting(f"dashboard_layout_{user}", layout)
         return JSONResponse({"status": "ok"})
     return JSONResponse({"error": "Missing layout"}, status_code=400)
 
@@ -366,7 +519,8 @@ async def add_bot(request: Request, data: dict = Body(...)):
                 return JSONResponse({"error": "Token inválido ou bot não encontrado"}, status_code=400)
             
             username = "@" + bot_info["result"]["username"]
-            bot = database.add_managed_bot(token, name, username)
+            bot = await adatabase.add_managed_bot(token, name, username)
+            await bot_registry.invalidate()
             return JSONResponse({"status": "ok", "bot": bot})
         except Exception as e:
             return JSONResponse({"error": f"Erro ao validar token: {e}"}, status_code=500)
@@ -376,7 +530,8 @@ async def toggle_bot(bot_id: str, request: Request, data: dict = Body(...)):
     if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
     
     is_active = data.get("is_active")
-    if database.update_managed_bot(bot_id, {"is_active": is_active}):
+    if await adatabase.update_managed_bot(bot_id, {"is_active": is_active}):
+        await bot_registry.invalidate()
         return JSONResponse({"status": "ok"})
     return JSONResponse({"error": "Falha ao atualizar"}, status_code=500)
 
@@ -384,7 +539,8 @@ async def toggle_bot(bot_id: str, request: Request, data: dict = Body(...)):
 async def delete_bot(bot_id: str, request: Request):
     if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
     
-    if database.delete_managed_bot(bot_id):
+    if await adatabase.delete_managed_bot(bot_id):
+        await bot_registry.invalidate()
         return JSONResponse({"status": "ok"})
     return JSONResponse({"error": "Falha ao deletar"}, status_code=500)
 
@@ -395,7 +551,8 @@ async def update_bot_ai(bot_id: str, request: Request, data: dict = Body(...)):
     ai_enabled = data.get("ai_enabled")
     system_prompt = data.get("system_prompt")
     
-    if database.update_bot_ai(bot_id, ai_enabled, system_prompt):
+    if await adatabase.update_bot_ai(bot_id, ai_enabled, system_prompt):
+        await bot_registry.invalidate()
         return JSONResponse({"status": "ok"})
     return JSONResponse({"error": "Falha ao atualizar configurações de IA"}, status_code=500)
 
@@ -413,10 +570,10 @@ async def media_manager(request: Request):
     
     # Get current mapping from DB
     mapping = {
-        "welcome_photo": database.get_bot_content("welcome_photo"),
-        "inactivity_video_1": database.get_bot_content("inactivity_video_1"),
-        "inactivity_video_2": database.get_bot_content("inactivity_video_2"),
-        "inactivity_video_3": database.get_bot_content("inactivity_video_3"),
+        "welcome_photo": await adatabase.get_bot_content("welcome_photo"),
+        "inactivity_video_1": await adatabase.get_bot_content("inactivity_video_1"),
+        "inactivity_video_2": await adatabase.get_bot_content("inactivity_video_2"),
+        "inactivity_video_3": await adatabase.get_bot_content("inactivity_video_3"),
     }
     
     return templates.TemplateResponse("midia.html", {
@@ -464,7 +621,10 @@ async def map_media(request: Request, key: str = Form(...), filename: str = Form
     if not get_current_user(request): return RedirectResponse(url="/")
     
     url = f"/media/{filename}"
-    database.update_bot_content(key, url)
+    await adatabase.update_bot_content(key, url)
+    await asyncio.to_thread(content.invalidate)
+    # O bot desmapeia a mídia antiga na próxima leitura
+    await media_store.invalidate()
     
     return RedirectResponse(url="/midia", status_code=status.HTTP_303_SEE_OTHER)
 
@@ -473,10 +633,10 @@ async def map_media(request: Request, key: str = Form(...), filename: str = Form
 async def settings_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
     settings = {
-        "webhook_token": database.get_setting("webhook_token"),
-        "maintenance_mode": database.get_setting("maintenance_mode", "false"),
-        "support_user": database.get_setting("support_user"),
-        "recovery_message": database.get_setting("recovery_message")
+        "webhook_token": await adatabase.get_setting("webhook_token"),
+        "maintenance_mode": await adatabase.get_setting("maintenance_mode", "false"),
+        "support_user": await adatabase.get_setting("support_user"),
+        "recovery_message": await adatabase.get_setting("recovery_message")
     }
     return templates.TemplateResponse("configuracoes.html", {"request": request, "settings": settings, "active_page": "settings"})
 
@@ -488,7 +648,7 @@ async def monitoramento_page(request: Request):
 @app.get("/crm", response_class=HTMLResponse)
 async def crm_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    checkouts = database.get_abandoned_checkouts()
+    checkouts = await adatabase.get_abandoned_checkouts()
     return templates.TemplateResponse("crm.html", {
         "request": request,
         "active_page": "crm",
@@ -498,10 +658,10 @@ async def crm_page(request: Request):
 @app.get("/integracoes")
 async def integrations_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    utmfy_token = database.get_setting("utmfy_api_token")
-    tiktok_token = database.get_setting("tiktok_api_token")
-    tiktok_pixel = database.get_setting("tiktok_pixel_id")
-    openai_token = database.get_setting("openai_api_key")
+    utmfy_token = await adatabase.get_setting("utmfy_api_token")
+    tiktok_token = await adatabase.get_setting("tiktok_api_token")
+    tiktok_pixel = await adatabase.get_setting("tiktok_pixel_id")
+    openai_token = await adatabase.get_setting("openai_api_key")
     
     return templates.TemplateResponse("integracoes.html", {
         "request": request, 
@@ -522,15 +682,15 @@ async def update_integration(
     if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
     
     if type == "utmfy":
-        database.set_setting("utmfy_api_token", api_token)
+        await adatabase.set_setting("utmfy_api_token", api_token)
         logger.info(f"UTMFY Token updated via painel.")
     elif type == "tiktok":
-        database.set_setting("tiktok_api_token", api_token)
+        await adatabase.set_setting("tiktok_api_token", api_token)
         if pixel_id:
-            database.set_setting("tiktok_pixel_id", pixel_id)
+            await adatabase.set_setting("tiktok_pixel_id", pixel_id)
         logger.info(f"TikTok Settings updated via painel.")
     elif type == "openai":
-        database.set_setting("openai_api_key", api_token)
+        await adatabase.set_setting("openai_api_key", api_token)
         logger.info(f"OpenAI API Key updated via painel.")
     
     return RedirectResponse(url="/integracoes", status_code=303)
@@ -560,10 +720,10 @@ async def advanced_health_check():
 
     # Check Bot (Internal Status)
     # We now check if the bot logged a heart-beat in the last 2 minutes
-    last_seen = database.get_setting("bot_last_heartbeat", "0")
+    last_seen = await adatabase.get_setting("bot_last_heartbeat", "0")
     if time.time() - float(last_seen) < 120:
         results["bot"]["status"] = "online"
-        results["bot"]["username"] = database.get_setting("bot_username", "KamyBot")
+        results["bot"]["username"] = await adatabase.get_setting("bot_username", "KamyBot")
     else:
         results["bot"]["status"] = "offline"
 
@@ -575,9 +735,60 @@ async def advanced_health_check():
 
     # Check Supabase
     results["supabase"]["status"] = "online" # If we got here, DB is likely up as we use it for metrics
+    results["supabase"]["pool"] = database.get_pool_stats()
+    results["supabase"]["async_pool"] = adatabase.get_pool_stats()
+    results["supabase"]["write_buffer"] = write_buffer.get_stats()
 
     return results
 
+@app.get("/api/db_metrics")
+async def api_db_metrics(request: Request, source: str = "panel", function: Optional[str] = None, table: Optional[str] = None, slow_limit: int = 50):
+    if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    if source == "bot":
+        # O bot roda em outro processo e publica o snapshot em settings a cada minuto
+        raw = await adatabase.get_setting(db_metrics.BOT_METRICS_KEY)
+        try:
+            return JSONResponse(json.loads(raw) if raw else {})
+        except ValueError:
+            return JSONResponse({})
+    return JSONResponse(db_metrics.snapshot(function, table, max(0, min(slow_limit, db_metrics.DB_SLOW_LOG_SIZE))))
+
+@app.post("/api/db_metrics/reset")
+async def api_db_metrics_reset(request: Request):
+    if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    db_metrics.reset()
+    return JSONResponse({"status": "ok"})
+
+@app.get("/api/media/stats")
+async def api_media_stats(request: Request):
+    if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    # Publicado pelo processo do bot junto com as métricas de banco (media_store.py)
+    raw = await adatabase.get_setting(media_store.MEDIA_STATS_KEY)
+    try:
+        return JSONResponse(json.loads(raw) if raw else {})
+    except ValueError:
+        return JSONResponse({})
+
+@app.get("/api/updates/stats")
+async def api_updates_stats(request: Request):
+    if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    # Fila e espera dos updates por bot, publicadas pelo processo do bot (update_processor.py)
+    raw = await adatabase.get_setting(update_processor.UPDATE_STATS_KEY)
+    try:
+        return JSONResponse(json.loads(raw) if raw else {})
+    except ValueError:
+        return JSONResponse({})
+
+@app.get("/api/recovery/stats")
+async def api_recovery_stats(request: Request):
+    if not get_current_user(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    # Publicado pelo despachante de recuperação do processo do bot (recovery.py)
+    raw = await adatabase.get_setting(recovery.RECOVERY_STATS_KEY)
+    try:
+        return JSONResponse(json.loads(raw) if raw else {})
+    except ValueError:
+        return JSONResponse({})
+
 @app.get("/go", response_class=HTMLResponse)
 async def bridge_page(request: Request):
     """Bridge page to catch TikTok Pixel then redirect to Telegram."""
@@ -586,17 +797,17 @@ async def bridge_page(request: Request):
 @app.post("/configuracoes")
 async def save_settings(request: Request, webhook_token: str = Form(...), maintenance_mode: str = Form(...), support_user: str = Form(...), recovery_message: str = Form(...)):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.set_setting("webhook_token", webhook_token)
-    database.set_setting("maintenance_mode", maintenance_mode)
-    database.set_setting("support_user", support_user)
-    database.set_setting("recovery_message", recovery_message)
+    await adatabase.set_setting("webhook_token", webhook_token)
+    await adatabase.set_setting("maintenance_mode", maintenance_mode)
+    await adatabase.set_setting("support_user", support_user)
+    await adatabase.set_setting("recovery_message", recovery_message)
     return RedirectResponse(url="/configuracoes", status_code=status.HTTP_303_SEE_OTHER)
 
 # --- Gateway Management Routes ---
 @app.get("/gateways", response_class=HTMLResponse)
 async def gateways_page(request: Request):
     if not get_current_user(request): return RedirectResponse(url="/")
-    gateways = database.get_all_gateways()
+    gateways = await adatabase.get_all_gateways()
     return templates.TemplateResponse("gateways.html", {
         "request": request, "active_page": "gateways", "gateways": gateways
     })
@@ -616,7 +827,8 @@ async def add_gateway(request: Request):
             credentials[key.replace("cred_", "")] = val
 
     if gw_id and name:
-        database.add_gateway(gw_id, name, provider, credentials)
+        await adatabase.add_gateway(gw_id, name, provider, credentials)
+        await gateway.invalidate()
     return RedirectResponse(url="/gateways", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.post("/gateways/{gw_id}/update")
@@ -630,22 +842,37 @@ async def update_gateway(request: Request, gw_id: str):
         if key.startswith("cred_") and val:
             credentials[key.replace("cred_", "")] = val
 
-    database.update_gateway(gw_id, name=name if name else None, credentials=credentials if credentials else None)
+    await adatabase.update_gateway(gw_id, name=name if name else None, credentials=credentials if credentials else None)
+    await gateway.invalidate()
     return RedirectResponse(url="/gateways", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.post("/gateways/{gw_id}/activate")
 async def activate_gateway(request: Request, gw_id: str):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.activate_gateway(gw_id)
+    await adatabase.activate_gateway(gw_id)
+    await gateway.invalidate()
     return RedirectResponse(url="/gateways", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.post("/gateways/{gw_id}/delete")
 async def delete_gateway_route(request: Request, gw_id: str):
     if not get_current_user(request): return RedirectResponse(url="/")
-    database.delete_gateway(gw_id)
+    await adatabase.delete_gateway(gw_id)
+    await gateway.invalidate()
     return RedirectResponse(url="/gateways", status_code=status.HTTP_303_SEE_OTHER)
 
 # --- Webhook Endpoint ---
+@app.post("/tg/{bot_id}")
+async def telegram_webhook(bot_id: str, request: Request):
+    """Telegram updates for a managed bot (BOT_MODE=webhook)."""
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    status_code = await bot_main.feed_webhook(bot_id, request.headers.get("X-Telegram-Bot-Api-Secret-Token"), payload)
+    if status_code != 200:
+        return JSONResponse({"error": "Rejected"}, status_code=status_code)
+    return {"ok": True}
+
 @app.post("/webhook")
 async def receive_webhook(request: Request, data: dict = Body(...)):
     logger.info(f"Received webhook: {data.get('type') or 'update'}")
@@ -671,9 +898,9 @@ async def receive_webhook(request: Request, data: dict = Body(...)):
     if status == 'paid': 
         local_status = 'confirmed'
         # Track conversion success
-        user_id = database.get_transaction_user(identifier)
+        user_id = await adatabase.get_transaction_user(identifier)
         if user_id:
-             database.track_event(user_id, 'payment_success')
+             write_buffer.track_event(user_id, 'payment_success')
     elif status in ['refused', 'canceled', 'failed', 'expired']: 
         local_status = 'failed'
     elif status == 'refunded': 
@@ -682,20 +909,20 @@ async def receive_webhook(request: Request, data: dict = Body(...)):
         local_status = 'refunded' # Or handle specifically if needed
 
     logger.info(f"Updating transaction {identifier} to status {local_status} (Babylon ID: {babylon_id})")
-    database.update_transaction_status(identifier=identifier, status=local_status, oasyfy_id=babylon_id)
+    await adatabase.update_transaction_status(identifier=identifier, status=local_status, oasyfy_id=babylon_id)
     
     # NEW: UTMfy "Purchase" event tracking
     if local_status == 'confirmed':
         try:
             # Get full transaction and user data
-            tx = database.get_transaction(identifier)
+            tx = await adatabase.get_transaction(identifier)
             if tx:
                 user_id = tx.get("user_id")
-                db_user = database.get_user(user_id) if user_id else None
+                db_user = await adatabase.get_user(user_id) if user_id else None
                 # Mark as recovered for CRM tracking
                 bot_id = tx.get("bot_id")
                 if user_id and bot_id:
-                    database.update_abandoned_checkout(user_id, bot_id, status="recovered")
+                    await adatabase.update_abandoned_checkout(user_id, bot_id, status="recovered")
                 
                 if db_user:
                     # Tracking data is in tx['metadata']
@@ -770,24 +997,24 @@ async def receive_oasyfy_webhook(request: Request, data: dict = Body(...)):
     local_status = 'pending'
     if oasyfy_status in ['OK', 'PAID', 'APPROVED']:
         local_status = 'confirmed'
-        user_id = database.get_transaction_user(identifier)
+        user_id = await adatabase.get_transaction_user(identifier)
         if user_id:
-            database.track_event(user_id, 'payment_success')
+            write_buffer.track_event(user_id, 'payment_success')
     elif oasyfy_status in ['FAILED', 'REJECTED', 'CANCELED', 'EXPIRED']:
         local_status = 'failed'
     elif oasyfy_status == 'REFUNDED':
         local_status = 'refunded'
 
     logger.info(f"Oasyfy: Updating transaction {identifier} to {local_status}")
-    database.update_transaction_status(identifier=identifier, status=local_status, oasyfy_id=data.get("transactionId"))
+    await adatabase.update_transaction_status(identifier=identifier, status=local_status, oasyfy_id=data.get("transactionId"))
 
     # UTMfy + TikTok tracking on confirmed
     if local_status == 'confirmed':
         try:
-            tx = database.get_transaction(identifier)
+            tx = await adatabase.get_transaction(identifier)
             if tx:
                 user_id = tx.get("user_id")
-                db_user = database.get_user(user_id) if user_id else None
+                db_user = await adatabase.get_user(user_id) if user_id else None
 
                 if db_user:
                     tracking_data = tx.get("metadata", {})
@@ -840,24 +1067,24 @@ async def receive_genesys_webhook(request: Request, data: dict = Body(...)):
     local_status = 'pending'
     if genesys_status in ['PAID', 'APPROVED', 'COMPLETED']:
         local_status = 'confirmed'
-        user_id = database.get_transaction_user(identifier)
+        user_id = await adatabase.get_transaction_user(identifier)
         if user_id:
-            database.track_event(user_id, 'payment_success')
+            write_buffer.track_event(user_id, 'payment_success')
     elif genesys_status in ['FAILED', 'REJECTED', 'CANCELED', 'EXPIRED']:
         local_status = 'failed'
     elif genesys_status == 'REFUNDED':
         local_status = 'refunded'
 
     logger.info(f"Genesys: Updating transaction {identifier} to {local_status}")
-    database.update_transaction_status(identifier=identifier, status=local_status, oasyfy_id=data.get("id"))
+    await adatabase.update_transaction_status(identifier=identifier, status=local_status, oasyfy_id=data.get("id"))
 
     # UTMfy + TikTok tracking on confirmed
     if local_status == 'confirmed':
         try:
-            tx = database.get_transaction(identifier)
+            tx = await adatabase.get_transaction(identifier)
             if tx:
                 user_id = tx.get("user_id")
-                db_user = database.get_user(user_id) if user_id else None
+                db_user = await adatabase.get_user(user_id) if user_id else None
 
                 if db_user:
                     tracking_data = tx.get("metadata", {})
@@ -0,0 +1,96 @@
+import io
+import os
+import asyncio
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+import qrcode
+from qrcode.constants import ERROR_CORRECT_M
+
+logger = logging.getLogger(__name__)
+
+# QR Code do Pix renderizado fora do event loop. Numa thread o loop ainda
+# divide o GIL com o qrcode, mas em fatias de poucos ms em vez de ~40 ms
+# bloqueado por QR. QR_EXECUTOR=process usa um pool de processos (spawn), que
+# reimporta o script principal em cada worker: só vale com muitos QRs por
+# segundo. O PNG pronto fica num LRU pelo código Pix: reenvio ou nova
+# tentativa do mesmo Pix não renderiza de novo.
+QR_EXECUTOR = os.getenv("QR_EXECUTOR", "thread").lower()
+QR_WORKERS = int(os.getenv("QR_WORKERS", "2"))
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "256"))
+# 8 px por módulo e borda de 4 módulos: o código Pix (~version 8) sai com ~500 px,
+# legível depois da recompressão JPEG do Telegram; PNG de 1 bit fica com poucos KB
+QR_BOX_SIZE = int(os.getenv("QR_BOX_SIZE", "8"))
+QR_BORDER = 4
+QR_COMPRESS_LEVEL = 6
+
+_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_inflight: Dict[str, asyncio.Future] = {}
+_executor: Optional[Executor] = None
+
+def render_png(code: str) -> bytes:
+    """Renders code as a 1-bit PNG. Runs inside the worker pool."""
+    qr = qrcode.QRCode(error_correction=ERROR_CORRECT_M, box_size=QR_BOX_SIZE, border=QR_BORDER)
+    qr.add_data(code)
+    qr.make(fit=True)
+    img = qr.make_image().get_image()
+    bio = io.BytesIO()
+    img.save(bio, "PNG", compress_level=QR_COMPRESS_LEVEL)
+    return bio.getvalue()
+
+def _pool() -> Executor:
+    global _executor
+    if _executor is None:
+        if QR_EXECUTOR == "process":
+            # spawn: o processo do bot tem threads (to_thread, httpx) e fork com threads não é seguro
+            _executor = ProcessPoolExecutor(max_workers=QR_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            _executor = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix="qr")
+    return _executor
+
+async def _render(code: str) -> bytes:
+    global _executor
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_pool(), render_png, code)
+    except BrokenProcessPool:
+        # Worker morreu (OOM, kill): recria o pool uma vez
+        logger.error("QR worker pool broken, restarting it")
+        _executor = None
+        return await loop.run_in_executor(_pool(), render_png, code)
+
+async def render(code: str) -> bytes:
+    """PNG bytes of the QR code for code, from the LRU or rendered off the event loop."""
+    png = _cache.get(code)
+    if png is not None:
+        _cache.move_to_end(code)
+        return png
+    # Mesmo código pedido duas vezes ao mesmo tempo: uma renderização só
+    pending = _inflight.get(code)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    future = asyncio.get_running_loop().create_future()
+    _inflight[code] = future
+    try:
+        png = await _render(code)
+        future.set_result(png)
+    except Exception as e:
+        future.set_exception(e)
+        # Quem não esperava por ele não deve gerar "exception was never retrieved"
+        future.exception()
+        raise
+    finally:
+        del _inflight[code]
+    _cache[code] = png
+    while len(_cache) > QR_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return png
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
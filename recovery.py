@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+import database
+import adatabase
+
+logger = logging.getLogger(__name__)
+
+# Despachante único da recuperação de checkouts para todos os bots do processo.
+# Busca os checkouts vencidos de todos os bots num lote só, envia em paralelo
+# com limite por bot (vagas + espaçamento entre envios, abaixo do limite do
+# Telegram) e grava os resultados em poucos updates em massa. Um RetryAfter
+# pausa só o bot que levou o flood control; as linhas dele são adiadas para o
+# fim da pausa. Falha passageira adia a linha com backoff e conta a tentativa
+# (database.RECOVERY_MAX_ATTEMPTS). Nenhuma linha fica vencida no topo da fila
+# barrando as mais novas.
+# Antes de enviar, o lote é reservado (next_due_at adiado por RECOVERY_CLAIM_TTL)
+# e o avanço de estágio das linhas enviadas é gravado em blocos de
+# RECOVERY_RECORD_CHUNK logo após os envios: uma queda no meio do lote reenvia
+# no máximo um bloco, e só depois do TTL.
+RECOVERY_BATCH_SIZE = int(os.getenv("RECOVERY_BATCH_SIZE", "200"))
+RECOVERY_BOT_CONCURRENCY = int(os.getenv("RECOVERY_BOT_CONCURRENCY", "8"))
+RECOVERY_BOT_RATE = float(os.getenv("RECOVERY_BOT_RATE", "20"))  # envios/s por bot
+RECOVERY_IDLE_SLEEP = float(os.getenv("RECOVERY_IDLE_SLEEP", "30"))
+RECOVERY_CLAIM_TTL = float(os.getenv("RECOVERY_CLAIM_TTL", "900"))
+RECOVERY_RECORD_CHUNK = int(os.getenv("RECOVERY_RECORD_CHUNK", "20"))
+RECOVERY_STATS_INTERVAL = float(os.getenv("RECOVERY_STATS_INTERVAL", "60"))
+RECOVERY_STATS_KEY = "recovery_stats"
+
+# Erros que não passam com o tempo: o checkout é marcado como failed
+PERMANENT_ERRORS = ("forbidden", "blocked", "chat not found", "user is deactivated")
+
+# RETRY: o envio falhou e conta como tentativa; DEFER: nem foi tentado (bot pausado ou fora)
+SENT, FAILED, RETRY, DEFER = "sent", "failed", "retry", "defer"
+
+Sender = Callable[[str, Any, int, int], Awaitable[None]]
+
+class _Lane:
+    """Per-bot send limits and counters."""
+    __slots__ = ("bot", "slots", "next_send", "paused_until", "sent", "failed", "retried", "deferred")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.slots = asyncio.Semaphore(RECOVERY_BOT_CONCURRENCY)
+        self.next_send = 0.0
+        self.paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.deferred = 0
+
+    async def pace(self):
+        # Espaça os envios do bot em 1/RECOVERY_BOT_RATE segundos
+        now = time.monotonic()
+        start = max(now, self.next_send)
+        self.next_send = start + 1 / RECOVERY_BOT_RATE
+        if start > now:
+            await asyncio.sleep(start - now)
+
+_lanes: Dict[str, _Lane] = {}
+_sender: Optional[Sender] = None
+_wakeup: Optional[asyncio.Event] = None
+_runner: Optional[asyncio.Task] = None
+_sent_log: deque = deque()  # (monotonic, enviados) do último minuto, para a vazão
+_stats: Dict[str, Any] = {"batches": 0, "sent": 0, "failed": 0, "retried": 0, "deferred": 0, "backlog": None, "backlog_at": None}
+
+def attach(bot_id: str, bot):
+    _lanes[bot_id] = _Lane(bot)
+    if _wakeup:
+        _wakeup.set()
+
+def detach(bot_id: str):
+    _lanes.pop(bot_id, None)
+
+async def _dispatch(row: Dict[str, Any]) -> str:
+    lane = _lanes.get(row['bot_id'])
+    if lane is None:
+        return DEFER
+    stage = row['last_stage'] + 1
+    async with lane.slots:
+        if lane.paused_until > time.monotonic():
+            return DEFER
+        await lane.pace()
+        try:
+            await _sender(row['bot_id'], lane.bot, row['user_id'], stage)  # chat_id = user_id (DM)
+            return SENT
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None:
+                seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                lane.paused_until = max(lane.paused_until, time.monotonic() + seconds)
+                logger.warning(f"Recovery paused for bot {row['bot_id']}: flood control, retry in {seconds:.0f}s")
+                return DEFER
+            logger.error(f"Error sending recovery to {row['user_id']}: {e}")
+            return FAILED if any(err in str(e).lower() for err in PERMANENT_ERRORS) else RETRY
+
+class _Advances:
+    """Stage advances of sent rows, written in chunks while the batch is still sending."""
+
+    def __init__(self):
+        self.by_stage: Dict[int, List[int]] = {}
+        self.pending = 0
+
+    def add(self, row: Dict[str, Any]):
+        self.by_stage.setdefault(row['last_stage'] + 1, []).append(row['id'])
+        self.pending += 1
+
+    async def flush(self):
+        # Troca antes de gravar: envios que terminam durante o await vão para o próximo bloco
+        by_stage, self.by_stage, self.pending = self.by_stage, {}, 0
+        # Linhas que avançam para o mesmo estágio recebem o mesmo next_due_at: um update por estágio
+        for stage, ids in by_stage.items():
+            await adatabase.update_abandoned_checkouts(ids, last_stage=stage, attempts=0)
+
+async def _send(row: Dict[str, Any], advances: _Advances) -> str:
+    result = await _dispatch(row)
+    if result == SENT:
+        advances.add(row)
+        if advances.pending >= RECOVERY_RECORD_CHUNK:
+            # shield: um cancelamento não pode perder um bloco já retirado de advances
+            await asyncio.shield(advances.flush())
+    return result
+
+async def _claim(rows: List[Dict[str, Any]]) -> bool:
+    # Adia o lote antes de enviar: se o processo cair no meio, as linhas só voltam depois do TTL
+    until = datetime.now(timezone.utc) + timedelta(seconds=RECOVERY_CLAIM_TTL)
+    return await adatabase.update_abandoned_checkouts([row['id'] for row in rows], retry_at=until)
+
+async def _send_batch(rows: List[Dict[str, Any]]) -> List[str]:
+    advances = _Advances()
+    try:
+        return await asyncio.gather(*(_send(row, advances) for row in rows))
+    finally:
+        await asyncio.shield(advances.flush())
+
+def _defer_until(bot_id: str) -> datetime:
+    # Fim da pausa do bot (ou o próximo ciclo, se não está pausado / saiu)
+    lane = _lanes.get(bot_id)
+    wait = lane.paused_until - time.monotonic() if lane else 0
+    return datetime.now(timezone.utc) + timedelta(seconds=max(wait, RECOVERY_IDLE_SLEEP))
+
+async def _record(rows: List[Dict[str, Any]], results: List[str]) -> int:
+    """Bulk-writes the outcome of the rows that were not sent (sent ones are written by _Advances). Returns how many were attempted."""
+    sent = 0
+    by_attempt: Dict[int, List[int]] = {}
+    by_bot: Dict[str, List[int]] = {}
+    failed: List[int] = []
+    for row, result in zip(rows, results):
+        lane = _lanes.get(row['bot_id'])
+        if result == RETRY:
+            attempts = (row.get('attempts') or 0) + 1
+            if attempts >= database.RECOVERY_MAX_ATTEMPTS:
+                logger.error(f"Recovery for {row['user_id']} gave up after {attempts} attempts")
+                result = FAILED
+            else:
+                by_attempt.setdefault(attempts, []).append(row['id'])
+        if result == SENT:
+            sent += 1
+        elif result == FAILED:
+            failed.append(row['id'])
+        elif result == DEFER:
+            by_bot.setdefault(row['bot_id'], []).append(row['id'])
+        if lane:
+            lane.sent += result == SENT
+            lane.failed += result == FAILED
+            lane.retried += result == RETRY
+            lane.deferred += result == DEFER
+    if failed:
+        await adatabase.update_abandoned_checkouts(failed, status="failed")
+    # Mesmo número de tentativas, mesmo backoff: um update por contagem
+    for attempts, ids in by_attempt.items():
+        await adatabase.update_abandoned_checkouts(ids, retry_at=database.recovery_retry_due(attempts), attempts=attempts)
+    for bot_id, ids in by_bot.items():
+        await adatabase.update_abandoned_checkouts(ids, retry_at=_defer_until(bot_id))
+
+    retried = sum(len(ids) for ids in by_attempt.values())
+    _stats["batches"] += 1
+    _stats["sent"] += sent
+    _stats["failed"] += len(failed)
+    _stats["retried"] += retried
+    _stats["deferred"] += len(rows) - sent - len(failed) - retried
+    _sent_log.append((time.monotonic(), sent))
+    return sent + len(failed) + retried
+
+def snapshot() -> Dict[str, Any]:
+    """Counters, last-minute throughput and the last measured backlog."""
+    horizon = time.monotonic() - 60
+    while _sent_log and _sent_log[0][0] < horizon:
+        _sent_log.popleft()
+    now = time.monotonic()
+    return {
+        **_stats,
+        "sent_last_minute": sum(count for _, count in _sent_log),
+        "bots": {
+            bot_id: {
+                "sent": lane.sent,
+                "failed": lane.failed,
+                "retried": lane.retried,
+                "deferred": lane.deferred,
+                "paused_for": round(max(0.0, lane.paused_until - now), 1),
+            }
+            for bot_id, lane in _lanes.items()
+        },
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+async def _publish_stats():
+    _stats["backlog"] = await adatabase.count_due_abandoned(list(_lanes))
+    _stats["backlog_at"] = datetime.now(timezone.utc).isoformat()
+    stats = snapshot()
+    logger.info(f"Recovery: {stats['sent_last_minute']} sent/min, backlog {stats['backlog']}")
+    # O painel lê daqui (/api/recovery/stats)
+    await adatabase.set_setting(RECOVERY_STATS_KEY, json.dumps(stats))
+
+async def _idle():
+    # Dorme até o próximo ciclo, um bot novo ou o fim da pausa mais próxima
+    now = time.monotonic()
+    pauses = [lane.paused_until - now for lane in _lanes.values() if lane.paused_until > now]
+    _wakeup.clear()
+    try:
+        await asyncio.wait_for(_wakeup.wait(), min([RECOVERY_IDLE_SLEEP] + pauses))
+    except asyncio.TimeoutError:
+        pass
+
+async def _run():
+    last_stats = 0.0
+    while True:
+        try:
+            now = time.monotonic()
+            ready = [bot_id for bot_id, lane in _lanes.items() if lane.paused_until <= now]
+            due = await adatabase.get_due_abandoned(ready, limit=RECOVERY_BATCH_SIZE) if ready else []
+            progressed = 0
+            if due and await _claim(due):
+                results = await _send_batch(due)
+                progressed = await _record(due, results)
+            if _lanes and time.monotonic() - last_stats >= RECOVERY_STATS_INTERVAL:
+                last_stats = time.monotonic()
+                await _publish_stats()
+            # Lote cheio e andando: ainda há vencidos, segue sem esperar (só adiados: espera a pausa)
+            if len(due) >= RECOVERY_BATCH_SIZE and progressed:
+                continue
+            await _idle()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Recovery dispatcher error: {e}")
+            await asyncio.sleep(RECOVERY_IDLE_SLEEP)
+
+def start(sender: Sender):
+    """Starts the dispatcher. sender(bot_id, bot, chat_id, stage) sends one stage and raises on failure."""
+    global _sender, _wakeup, _runner
+    _sender = sender
+    if _runner is None or _runner.done():
+        _wakeup = asyncio.Event()
+        _runner = asyncio.create_task(_run())
+
+async def stop():
+    global _runner
+    if _runner:
+        _runner.cancel()
+        _runner = None
@@ -0,0 +1,211 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from datetime import timezone
+from typing import Dict, Any, Optional, Callable, Awaitable, Tuple
+import database
+import adatabase
+
+logger = logging.getLogger(__name__)
+
+# Agendador único de lembretes de inatividade para todos os bots do processo.
+# Em vez de uma task dormindo por usuário, um heap de (vencimento, seq) e um
+# único loop que dorme até o próximo vencimento. Cada entrada também fica na
+# tabela reminders, então a fila volta inteira quando o bot reinicia.
+# Cancelar só marca a entrada (remoção preguiçosa, como na receita do heapq);
+# o heap é compactado quando metade dele vira lixo.
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "20"))
+REMINDER_COMPACT_MIN = 1024
+
+# Entrada do heap: [due_ts, seq, bot_id, user_id, chat_id, stage]; bot_id None = cancelada
+DUE, SEQ, BOT, USER, CHAT, STAGE = range(6)
+
+Key = Tuple[str, int]
+Sender = Callable[[str, Any, int, int], Awaitable[None]]
+
+_heap: list = []
+_entries: Dict[Key, list] = {}
+_firing: Dict[Key, list] = {}
+_removed = 0
+_seq = itertools.count()
+_bots: Dict[str, Any] = {}
+_writes: Dict[Key, asyncio.Task] = {}
+_sender: Optional[Sender] = None
+_wakeup: Optional[asyncio.Event] = None
+_slots: Optional[asyncio.Semaphore] = None
+_runner: Optional[asyncio.Task] = None
+
+def _compact():
+    global _heap, _removed
+    _heap = [entry for entry in _heap if entry[BOT] is not None]
+    heapq.heapify(_heap)
+    _removed = 0
+
+def _discard(key: Key) -> bool:
+    global _removed
+    entry = _entries.pop(key, None)
+    if entry is not None:
+        entry[BOT] = None
+        _removed += 1
+        if _removed > REMINDER_COMPACT_MIN and _removed * 2 > len(_heap):
+            _compact()
+        return True
+    # Já saiu do heap e está sendo enviada: o envio termina, mas não reagenda
+    entry = _firing.get(key)
+    if entry is not None and entry[BOT] is not None:
+        entry[BOT] = None
+        return True
+    return False
+
+def _push(bot_id: str, user_id: int, chat_id: int, stage: int, due_ts: float):
+    _discard((bot_id, user_id))
+    entry = [due_ts, next(_seq), bot_id, user_id, chat_id, stage]
+    _entries[(bot_id, user_id)] = entry
+    heapq.heappush(_heap, entry)
+    if _wakeup and _heap[0] is entry:
+        _wakeup.set()
+
+def _write(key: Key, make: Callable[[], Awaitable[None]]):
+    # Gravações da mesma chave em ordem: um delete não pode passar à frente do upsert anterior
+    previous = _writes.get(key)
+
+    async def run():
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        await make()
+
+    task = asyncio.create_task(run())
+    _writes[key] = task
+    task.add_done_callback(lambda t: _writes.pop(key) if _writes.get(key) is t else None)
+
+def schedule(bot_id: str, user_id: int, chat_id: int):
+    """(Re)starts the reminder sequence for a user; stage 1 is due after RECOVERY_STAGE_DELAYS[1]."""
+    due = database.recovery_next_due(0)
+    _push(bot_id, user_id, chat_id, 0, due.timestamp())
+    _write((bot_id, user_id), lambda: adatabase.save_reminder(bot_id, user_id, chat_id, 0, due))
+
+def cancel(bot_id: str, user_id: int) -> bool:
+    """Drops the user's pending reminders. Returns False if there were none."""
+    if not _discard((bot_id, user_id)):
+        return False
+    _write((bot_id, user_id), lambda: adatabase.delete_reminder(bot_id, user_id))
+    return True
+
+def pending() -> int:
+    return len(_entries)
+
+async def attach(bot_id: str, bot):
+    """Registers a running bot and loads its persisted reminders into the heap."""
+    _bots[bot_id] = bot
+    restored = 0
+    after = None
+    while True:
+        rows = await adatabase.get_reminders(bot_id, after_user_id=after)
+        for row in rows:
+            key = (bot_id, row['user_id'])
+            # Agendado depois do attach começar: o da memória é mais novo
+            if key in _entries or key in _firing:
+                continue
+            due = database._parse_ts(row['due_at']) if isinstance(row['due_at'], str) else row['due_at']
+            if due.tzinfo is None:
+                due = due.replace(tzinfo=timezone.utc)
+            _push(bot_id, row['user_id'], row['chat_id'], row['stage'], due.timestamp())
+            restored += 1
+        if len(rows) < database.REMINDER_LOAD_BATCH:
+            break
+        after = rows[-1]['user_id']
+    if restored:
+        logger.info(f"Restored {restored} reminders for bot {bot_id}")
+
+def detach(bot_id: str):
+    """Stops firing for a bot. Its rows stay in the database for the next attach."""
+    global _removed
+    _bots.pop(bot_id, None)
+    for key in [key for key in _entries if key[0] == bot_id]:
+        _entries.pop(key)[BOT] = None
+        _removed += 1
+    _compact()
+
+async def _fire(entry: list):
+    bot_id, user_id, chat_id, stage = entry[BOT], entry[USER], entry[CHAT], entry[STAGE] + 1
+    key = (bot_id, user_id)
+    try:
+        bot = _bots.get(bot_id)
+        if bot is None:
+            return
+        try:
+            await _sender(bot_id, bot, chat_id, stage)
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None and entry[BOT] is not None and key not in _entries:
+                # Flood control do Telegram: mesmo estágio depois do intervalo pedido
+                retry = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                _push(bot_id, user_id, chat_id, entry[STAGE], time.time() + retry)
+                return
+            logger.error(f"Reminder error for {user_id} on bot {bot_id}: {e}")
+            if entry[BOT] is not None and key not in _entries:
+                _write(key, lambda: adatabase.delete_reminder(bot_id, user_id))
+            return
+
+        # Cancelado ou reagendado durante o envio
+        if entry[BOT] is None or key in _entries:
+            return
+        due = database.recovery_next_due(stage)
+        if due:
+            _push(bot_id, user_id, chat_id, stage, due.timestamp())
+            _write(key, lambda: adatabase.save_reminder(bot_id, user_id, chat_id, stage, due))
+        else:
+            _write(key, lambda: adatabase.delete_reminder(bot_id, user_id))
+    finally:
+        if _firing.get(key) is entry:
+            del _firing[key]
+        _slots.release()
+
+async def _run():
+    global _removed
+    while True:
+        _wakeup.clear()
+        while _heap and _heap[0][BOT] is None:
+            heapq.heappop(_heap)
+            _removed -= 1
+        if not _heap:
+            await _wakeup.wait()
+            continue
+        delay = _heap[0][DUE] - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _slots.acquire()
+        # O heap pode ter mudado enquanto esperava uma vaga
+        if not _heap or _heap[0][BOT] is None or _heap[0][DUE] > time.time():
+            _slots.release()
+            continue
+        entry = heapq.heappop(_heap)
+        key = (entry[BOT], entry[USER])
+        del _entries[key]
+        _firing[key] = entry
+        asyncio.create_task(_fire(entry))
+
+def start(sender: Sender):
+    """Starts the scheduler loop. sender(bot_id, bot, chat_id, stage) sends one stage and raises on failure."""
+    global _sender, _wakeup, _slots, _runner
+    _sender = sender
+    if _runner is None or _runner.done():
+        _wakeup = asyncio.Event()
+        _slots = asyncio.Semaphore(REMINDER_CONCURRENCY)
+        _runner = asyncio.create_task(_run())
+
+async def stop():
+    global _runner
+    if _runner:
+        _runner.cancel()
+        _runner = None
+    # Termina as gravações pendentes para a fila persistida refletir a memória
+    if _writes:
+        await asyncio.gather(*list(_writes.values()), return_exceptions=True)
@@ -0,0 +1,57 @@
+import asyncio
+import sqlite3
+import write_buffer
+
+class FakeStore:
+    """insert_rows stand-in: rejects any batch containing a bad row, like a constraint violation."""
+
+    def __init__(self, outage: int = 0):
+        self.rows = []
+        self.calls = 0
+        self.outage = outage
+
+    async def insert_rows(self, table, rows):
+        self.calls += 1
+        if self.outage:
+            self.outage -= 1
+            raise ConnectionError("network down")
+        if any(row.get("bad") for row in rows):
+            raise sqlite3.IntegrityError("FOREIGN KEY constraint failed")
+        self.rows.extend(rows)
+
+def _run(store, rows, cycles):
+    async def main():
+        write_buffer._queues.clear()
+        write_buffer._retries.clear()
+        for row in rows:
+            write_buffer.add("funnel_events", row)
+        for _ in range(cycles):
+            await write_buffer.flush()
+        await write_buffer.drain()
+
+    original = write_buffer.adatabase.insert_rows
+    write_buffer.adatabase.insert_rows = store.insert_rows
+    try:
+        asyncio.run(main())
+    finally:
+        write_buffer.adatabase.insert_rows = original
+
+def test_bad_row_does_not_block_the_batch():
+    store = FakeStore()
+    rows = [{"user_id": i, "event_type": "start", "bad": i == 37} for i in range(500)]
+    rejected = write_buffer._stats["rejected"]
+    _run(store, rows, cycles=write_buffer.WRITE_BUFFER_MAX_ATTEMPTS + 1)
+
+    written = sorted(row["user_id"] for row in store.rows)
+    assert written == [i for i in range(500) if i != 37]
+    assert write_buffer._stats["rejected"] == rejected + 1
+    assert write_buffer.pending_rows("funnel_events") == []
+
+def test_outage_keeps_rows_without_counting_attempts():
+    store = FakeStore(outage=10)
+    rows = [{"user_id": i, "event_type": "start"} for i in range(50)]
+    rejected = write_buffer._stats["rejected"]
+    _run(store, rows, cycles=12)
+
+    assert sorted(row["user_id"] for row in store.rows) == list(range(50))
+    assert write_buffer._stats["rejected"] == rejected
@@ -0,0 +1,115 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Awaitable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Processamento concorrente dos updates de cada bot: updates de chats
+# diferentes rodam em paralelo (até BOT_CONCURRENT_UPDATES por bot), os do
+# mesmo chat um depois do outro, na ordem de chegada. Um comprador esperando o
+# gateway ou a OpenAI não trava mais os outros usuários do bot.
+# O semáforo do BaseUpdateProcessor (acquire antes do do_process_update) só
+# limita quantos updates ficam em memória (BOT_UPDATE_QUEUE_LIMIT): se ele
+# fosse o limite de execução, updates do mesmo chat esperando a vez ocupariam
+# vagas e um chat com rajada de cliques seguraria o bot inteiro.
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "16"))
+BOT_UPDATE_QUEUE_LIMIT = int(os.getenv("BOT_UPDATE_QUEUE_LIMIT", "1024"))
+UPDATE_STATS_KEY = "update_processor_bot"
+WAIT_SAMPLES = 1000
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Runs updates of different chats concurrently and updates of the same chat in arrival order."""
+
+    def __init__(self, bot_id: str, limit: int = BOT_CONCURRENT_UPDATES, queue_limit: int = BOT_UPDATE_QUEUE_LIMIT):
+        super().__init__(max(queue_limit, limit, 2))
+        self.bot_id = bot_id
+        self.limit = limit
+        self._slots = asyncio.Semaphore(limit)
+        self._tails: Dict[int, asyncio.Future] = {}  # chat_id -> fim do último update do chat
+        self._waits: deque = deque(maxlen=WAIT_SAMPLES)  # segundos até começar, dos últimos updates
+        self.queued = 0
+        self.running = 0
+        self.processed = 0
+        self.peak_queued = 0
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        arrived = time.monotonic()
+        key = self._chat_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        started = False
+        try:
+            if previous is not None:
+                # shield: cancelar este update não pode cancelar o fim do anterior
+                await asyncio.shield(previous)
+            async with self._slots:
+                self.queued -= 1
+                self.running += 1
+                started = True
+                self._waits.append(time.monotonic() - arrived)
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+                    self.processed += 1
+        finally:
+            if not started:
+                self.queued -= 1
+                # Cancelado antes de rodar (shutdown): fecha a corrotina sem "never awaited"
+                coroutine.close()
+            if previous is not None and not previous.done():
+                # O próximo do chat ainda espera o anterior terminar
+                previous.add_done_callback(lambda _: done.set_result(None))
+            else:
+                done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def initialize(self) -> None:
+        _processors[self.bot_id] = self
+
+    async def shutdown(self) -> None:
+        if _processors.get(self.bot_id) is self:
+            del _processors[self.bot_id]
+
+    def snapshot(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "chats": len(self._tails),
+            "processed": self.processed,
+            "wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+_processors: Dict[str, ChatOrderedProcessor] = {}
+
+def stats() -> Dict[str, Any]:
+    """Per-bot queue depth and wait times (last WAIT_SAMPLES updates) of the running bots."""
+    return {
+        "bots": {bot_id: processor.snapshot() for bot_id, processor in _processors.items()},
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
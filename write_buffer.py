@@ -0,0 +1,162 @@
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+import database
+import adatabase
+
+logger = logging.getLogger(__name__)
+
+# Write-behind para inserts de alto volume (funnel_events, ai_chat_history).
+# As linhas ficam em fila por tabela e vão para o Supabase em lote quando a
+# fila atinge WRITE_BUFFER_MAX_ROWS ou a cada WRITE_BUFFER_FLUSH_INTERVAL segundos.
+WRITE_BUFFER_MAX_ROWS = int(os.getenv("WRITE_BUFFER_MAX_ROWS", "200"))
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv("WRITE_BUFFER_FLUSH_INTERVAL", "2"))
+WRITE_BUFFER_MAX_PENDING = int(os.getenv("WRITE_BUFFER_MAX_PENDING", "20000"))
+# Lote recusado pelo banco (FK, constraint, tipo): tentado de novo inteiro uma
+# vez, depois dividido ao meio até isolar as linhas ruins; uma linha sozinha
+# é descartada (e logada) depois de WRITE_BUFFER_MAX_ATTEMPTS recusas.
+# Falha de rede/banco fora do ar não conta tentativa: o lote espera inteiro.
+WRITE_BUFFER_MAX_ATTEMPTS = int(os.getenv("WRITE_BUFFER_MAX_ATTEMPTS", "3"))
+
+_queues: Dict[str, deque] = {}
+_retries: Dict[str, deque] = {}  # table -> deque de (linhas, tentativas) recusadas, antes da fila
+_stats = {"flushes": 0, "rows_flushed": 0, "failures": 0, "dropped": 0, "rejected": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0}
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_flusher: Optional[asyncio.Task] = None
+_wakeup: Optional[asyncio.Event] = None
+_flush_lock: Optional[asyncio.Lock] = None
+
+def _ensure_flusher(loop: asyncio.AbstractEventLoop):
+    global _loop, _flusher, _wakeup, _flush_lock
+    if _loop is not loop:
+        _loop = loop
+        _wakeup = asyncio.Event()
+        _flush_lock = asyncio.Lock()
+        _flusher = None
+    if _flusher is None or _flusher.done():
+        _flusher = loop.create_task(_run())
+
+async def _run():
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=WRITE_BUFFER_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"Write buffer flush error: {e}")
+
+def add(table: str, row: Dict[str, Any]):
+    """Queues a row for bulk insert. Outside an event loop it is written directly."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        try:
+            database.insert_rows(table, [row])
+        except Exception as e:
+            logger.error(f"Error inserting into {table}: {e}")
+        return
+
+    _ensure_flusher(loop)
+    queue = _queues.setdefault(table, deque())
+    if len(queue) >= WRITE_BUFFER_MAX_PENDING:
+        queue.popleft()
+        _stats["dropped"] += 1
+    queue.append(row)
+    if len(queue) >= WRITE_BUFFER_MAX_ROWS:
+        _wakeup.set()
+
+def _is_data_error(e: Exception) -> bool:
+    """The database rejected the rows themselves (SQLSTATE 22/23/42, SQLite integrity/type errors)."""
+    code = str(getattr(e, "code", "") or "")
+    if code[:2] in ("22", "23", "42"):
+        return True
+    return isinstance(e, (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.ProgrammingError, sqlite3.InterfaceError, ValueError, TypeError))
+
+def _next_batch(table: str, queue: deque) -> Tuple[List[Dict[str, Any]], int]:
+    retry = _retries.get(table)
+    if retry:
+        return retry.popleft()
+    return [queue.popleft() for _ in range(min(len(queue), WRITE_BUFFER_MAX_ROWS))], 0
+
+async def flush():
+    """Writes everything queued so far, one bulk insert per table and batch."""
+    if _flush_lock is None:
+        return
+    async with _flush_lock:
+        for table, queue in list(_queues.items()):
+            retry = _retries.setdefault(table, deque())
+            later = []  # recusados que só voltam no próximo ciclo
+            while queue or retry:
+                batch, attempts = _next_batch(table, queue)
+                started = time.perf_counter()
+                try:
+                    await adatabase.insert_rows(table, batch)
+                except Exception as e:
+                    _stats["failures"] += 1
+                    if not _is_data_error(e):
+                        # Rede ou banco indisponível: o lote volta inteiro, sem contar tentativa
+                        logger.error(f"Bulk insert into {table} failed ({len(batch)} rows): {e}")
+                        retry.appendleft((batch, attempts))
+                        break
+                    attempts += 1
+                    if len(batch) == 1 and attempts >= WRITE_BUFFER_MAX_ATTEMPTS:
+                        _stats["rejected"] += 1
+                        logger.error(f"Dropping row rejected {attempts} times by {table}: {batch[0]} ({e})")
+                    elif attempts == 1 or len(batch) == 1:
+                        logger.error(f"Bulk insert into {table} rejected ({len(batch)} rows, attempt {attempts}): {e}")
+                        later.append((batch, attempts))
+                    else:
+                        # Recusa repetida: divide e tenta as metades já, isolando as linhas ruins
+                        mid = len(batch) // 2
+                        retry.appendleft((batch[mid:], attempts))
+                        retry.appendleft((batch[:mid], attempts))
+                    continue
+                elapsed = (time.perf_counter() - started) * 1000
+                _stats["flushes"] += 1
+                _stats["rows_flushed"] += len(batch)
+                _stats["last_flush_ms"] = round(elapsed, 2)
+                _stats["max_flush_ms"] = max(_stats["max_flush_ms"], round(elapsed, 2))
+                _stats["total_flush_ms"] += elapsed
+            retry.extend(later)
+
+async def drain():
+    """Stops the background flusher and writes whatever is still queued."""
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except (asyncio.CancelledError, Exception):
+            pass
+        _flusher = None
+    await flush()
+
+def get_stats() -> Dict[str, Any]:
+    stats = {k: v for k, v in _stats.items() if k != "total_flush_ms"}
+    stats["avg_flush_ms"] = round(_stats["total_flush_ms"] / _stats["flushes"], 2) if _stats["flushes"] else 0.0
+    stats["depth"] = {table: len(queue) + sum(len(rows) for rows, _ in _retries.get(table, ())) for table, queue in _queues.items()}
+    return stats
+
+def pending_rows(table: str, **match) -> List[Dict[str, Any]]:
+    """Rows still waiting in the buffer (retries first) that match every given column value."""
+    rows = [row for batch, _ in list(_retries.get(table, ())) for row in batch] + list(_queues.get(table, ()))
+    return [row for row in rows if all(row.get(k) == v for k, v in match.items())]
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+# --- Buffered counterparts of database.track_event / database.add_ai_history ---
+def track_event(user_id: int, event_type: str, bot_id: str = None):
+    add("funnel_events", {"user_id": user_id, "event_type": event_type, "bot_id": bot_id, "created_at": _now()})
+
+def add_ai_history(bot_id: str, user_id: int, role: str, content: str):
+    add("ai_chat_history", {"bot_id": bot_id, "user_id": user_id, "role": role, "content": content, "created_at": _now()})